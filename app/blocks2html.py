@@ -3,13 +3,20 @@ The main goal is to provide all block translatable text as "tag text" so that it
 It should also be possible to convert this HTML back to Volto blocks, using the html2content.py module
 """
 
+import hashlib
 import json
 import logging
+from contextvars import ContextVar
 from copy import deepcopy
+from itertools import chain
+from typing import Optional
 
 from lxml.html import builder as E
 
-from .slate2html import elements_to_text, slate_to_elements
+from . import metrics
+from .cache import LRUMemo, cache_key
+from .config import BLOCK_FRAGMENT_CACHE_SIZE, STABLE_BLOCK_IDS
+from .slate2html import elements_to_text, slate_to_elements, slate_to_html
 
 logger = logging.getLogger()
 
@@ -17,17 +24,60 @@ TABLE_CELLS = {"header": E.TH, "data": E.TD}
 TEASER_FIELDS = ["title", "head_title", "description"]
 HERO_FIELDS = ["buttonLabel", "copyright"]
 CALLTOACTION_FIELDS = ["label"]
+# the translated fields of the blocks serialized by generic_block_converter
+GENERIC_FIELDS = {
+    "listing": ["headline"],
+    "nextCloudVideo": ["title"],
+    "layoutSettings": [],
+    "callToActionBlock": ["text"],
+    "searchlib": ["searchInputPlaceholder"],
+}
+
+# the serialized blocks, by the hash of their json: ("elements", key) holds
+# the lxml elements, ("html", key) the html fragment of a top level block
+fragments_memo = LRUMemo(BLOCK_FRAGMENT_CACHE_SIZE)
+
+# the metadata of the blocks, by reference, when it is sent next to the html
+_sidecar: ContextVar[Optional[dict]] = ContextVar("sidecar", default=None)
+# write the block ids in the html for this conversion, even without STABLE_BLOCK_IDS
+_keep_uids = ContextVar("keep_uids", default=False)
+# set while a block renders its elements, the calls inside are nested blocks
+_nested = ContextVar("nested", default=False)
+
+
+def dump_metadata(data):
+    """The json of the block metadata, or a reference to it in the sidecar
+
+    The references are derived from the json, the blocks with the same
+    metadata share it.
+    """
+
+    text = json.dumps(data)
+    sidecar = _sidecar.get()
+    if sidecar is None:
+        return text
+
+    ref = hashlib.sha1(text.encode("utf-8")).hexdigest()[:10]
+    sidecar[ref] = data
+    return ref
+
+
+def without(data, *keys):
+    """A shallow copy of the data, without the given keys
+
+    The serializers treat the block data as read-only, they never pop from it.
+    """
+
+    return {k: v for k, v in data.items() if k not in keys}
 
 
 def serialize_slate(block_data):
-    data = deepcopy(block_data)
-    _type = data.pop("@type")
-    data.pop("value", None)
-    data.pop("plaintext", "")
+    data = without(block_data, "@type", "value", "plaintext")
+    _type = block_data["@type"]
 
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(data),
+        "data-volto-block": dump_metadata(data),
     }
 
     if "value" in block_data:
@@ -40,13 +90,49 @@ def serialize_slate(block_data):
         return E.P()
 
 
+def keep_uids():
+    return STABLE_BLOCK_IDS or _keep_uids.get()
+
+
+def with_uid(elements, uid):
+    """Keeps the block id in the html, with STABLE_BLOCK_IDS"""
+
+    if keep_uids() and uid:
+        for el in elements:
+            el.set("data-block-uid", uid)
+    return elements
+
+
+def serialize_slate_to_html(block_data, uid=None):
+    """Writes a slate block straight to html, the same as serialize_slate
+
+    Returns None if the block has no elements, like a value with only voltoblocks
+    """
+
+    value = block_data["value"]
+    if all("text" not in child and child.get("type") == "voltoblock" for child in value):
+        return None
+
+    data = without(block_data, "@type", "value", "plaintext")
+    attributes = []
+    if data:
+        attributes = [
+            ("data-block-type", block_data["@type"]),
+            ("data-volto-block", dump_metadata(data)),
+        ]
+    if keep_uids() and uid:
+        attributes.append(("data-block-uid", uid))
+
+    return slate_to_html(value, attributes)
+
+
 def serialize_slate_table(block_data):
-    _type = block_data.pop("@type")
-    data = block_data.pop("table")
-    rows = data.pop("rows")
+    _type = block_data["@type"]
+    data = block_data["table"]
+    rows = data["rows"]
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(data),
+        "data-volto-block": dump_metadata(without(data, "rows")),
     }
     children = []
     for row in rows:
@@ -64,22 +150,22 @@ def serialize_slate_table(block_data):
 
 
 def serialize_statistics_block(block_data):
-    _type = block_data.pop("@type")
-    items = block_data.pop("items", [])
+    _type = block_data["@type"]
+    items = block_data.get("items", [])
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(without(block_data, "@type", "items")),
     }
     children = []
     for item in items:
-        label = item.pop("label", [])
-        value = item.pop("value", [])
+        label = item.get("label", [])
+        value = item.get("value", [])
 
         labeldiv = E.DIV(*slate_to_elements(label), {"fieldname": "label"})
         valuediv = E.DIV(*slate_to_elements(value), {"fieldname": "value"})
 
         itemdiv = E.DIV(labeldiv, valuediv, {
-                        "volto-data-item": json.dumps(item)})
+                        "volto-data-item": dump_metadata(without(item, "label", "value"))})
         children.append(itemdiv)
 
     ediv = E.DIV(*children, **attributes)
@@ -95,38 +181,38 @@ def iterate_blocks(data):
 
 
 def get_blockscontainer_data(data):
-    data = deepcopy(data)
-    if "blocks" in data:
-        del data["blocks"]
-    if "blocks_layout" in data:
-        del data["blocks_layout"]
+    return without(data, "blocks", "blocks_layout")
 
-    return data
+
+def layout_block_settings(block_data):
+    """The block data, without its type and the blocks stored in its data"""
+
+    settings = without(block_data, "@type")
+    settings["data"] = get_blockscontainer_data(block_data["data"])
+    return settings
 
 
 def serialize_layout_block(block_data):
     """Serializes a block that contains other blocks, such as column or tabs"""
 
-    _type = block_data.pop("@type")
-    data = {
-        "blocks": block_data["data"].pop("blocks"),
-        "blocks_layout": block_data["data"].pop("blocks_layout"),
-    }
+    _type = block_data["@type"]
+    data = block_data["data"]
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(layout_block_settings(block_data)),
     }
 
     children = []
-    for _, coldata in iterate_blocks(data):
+    for coluid, coldata in iterate_blocks(data):
         # if "settings" in coldata:
         #     __import__("pdb").set_trace()
         colelements = []
-        for _, block in iterate_blocks(coldata):
-            colelements.extend(convert_block_to_elements(block))
+        for uid, block in iterate_blocks(coldata):
+            colelements.extend(with_uid(convert_block_to_elements(block), uid))
         colsettings = get_blockscontainer_data(coldata)
-        colattributes = {"data-volto-column-data": json.dumps(colsettings)}
+        colattributes = {"data-volto-column-data": dump_metadata(colsettings)}
         column = E.DIV(*colelements, **colattributes)
+        with_uid([column], coluid)
         children.append(column)
 
     div = E.DIV(*children, **attributes)
@@ -137,34 +223,30 @@ def serialize_layout_block(block_data):
 def serialize_layout_block_with_titles(block_data):
     """Serializes a block that contains other blocks, such as column or tabs"""
 
-    _type = block_data.pop("@type")
-    data = {
-        "blocks": block_data["data"].pop("blocks"),
-        "blocks_layout": block_data["data"].pop("blocks_layout"),
-    }
+    _type = block_data["@type"]
+    data = block_data["data"]
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(layout_block_settings(block_data)),
     }
 
     children = []
-    for _, coldata in iterate_blocks(data):
+    for coluid, coldata in iterate_blocks(data):
         colelements = []
-        colblocksdata = {
-            "blocks": coldata.pop("blocks"),
-            "blocks_layout": coldata.pop("blocks_layout"),
-        }
         translate_fields = ["title"]
         metatags = [
-            E.DIV(coldata.pop(name, ""), **{"data-fieldname": name})
+            E.DIV(coldata.get(name, ""), **{"data-fieldname": name})
             for name in translate_fields
         ]
+        colsettings = without(
+            coldata, "blocks", "blocks_layout", *translate_fields)
         metacol = E.DIV(
-            *metatags, **{"data-volto-column": json.dumps(coldata)})
+            *metatags, **{"data-volto-column": dump_metadata(colsettings)})
 
-        for _, block in iterate_blocks(colblocksdata):
-            colelements.extend(convert_block_to_elements(block))
+        for uid, block in iterate_blocks(coldata):
+            colelements.extend(with_uid(convert_block_to_elements(block), uid))
         column = E.DIV(metacol, *colelements)
+        with_uid([column], coluid)
         children.append(column)
 
     div = E.DIV(*children, **attributes)
@@ -174,17 +256,18 @@ def serialize_layout_block_with_titles(block_data):
 
 def generic_block_converter(translate_fields):
     def converter(block_data):
-        _type = block_data.pop("@type")
+        _type = block_data["@type"]
 
         fv = {}
         for name in translate_fields:
-            value = block_data.pop(name, None)
+            value = block_data.get(name, None)
             if value is not None:
                 fv[name] = value
 
         attributes = {
             "data-block-type": _type,
-            "data-volto-block": json.dumps(block_data),
+            "data-volto-block": dump_metadata(
+                without(block_data, "@type", *translate_fields)),
         }
 
         children = [
@@ -198,11 +281,11 @@ def generic_block_converter(translate_fields):
 
 
 def serialize_quote(block_data):
-    value = block_data.pop("value", [])
-    _type = block_data.pop("@type")
+    value = block_data.get("value", [])
+    _type = block_data["@type"]
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(without(block_data, "value", "@type")),
     }
     children = slate_to_elements(value)
     div = E.DIV(*children, **attributes)
@@ -211,11 +294,11 @@ def serialize_quote(block_data):
 
 def generic_slate_block(fieldname):
     def convertor(block_data):
-        value = block_data.pop(fieldname, [])
-        _type = block_data.pop("@type")
+        value = block_data.get(fieldname, [])
+        _type = block_data["@type"]
         attributes = {
             "data-block-type": _type,
-            "data-volto-block": json.dumps(block_data),
+            "data-volto-block": dump_metadata(without(block_data, fieldname, "@type")),
         }
         children = slate_to_elements(value)
         div = E.DIV(*children, **attributes)
@@ -234,16 +317,16 @@ def generic_slate_block(fieldname):
 
 
 def serialize_group_block(block_data):
-    _type = block_data.pop("@type")
-    data = block_data.pop("data")
+    _type = block_data["@type"]
+    data = block_data["data"]
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(without(block_data, "@type", "data")),
     }
 
     children = []
-    for _, block in iterate_blocks(data):
-        children.extend(convert_block_to_elements(block))
+    for uid, block in iterate_blocks(data):
+        children.extend(with_uid(convert_block_to_elements(block), uid))
 
     div = E.DIV(*children, **attributes)
     return [div]
@@ -251,11 +334,11 @@ def serialize_group_block(block_data):
 
 def serialize_teaserGrid(block_data):
     # __import__("pdb").set_trace()
-    _type = block_data.pop("@type")
-    columns = block_data.pop("columns")
+    _type = block_data["@type"]
+    columns = block_data["columns"]
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(without(block_data, "@type", "columns")),
     }
     children = []
     for teaser in columns:
@@ -266,24 +349,28 @@ def serialize_teaserGrid(block_data):
 
 
 def serialize_itemModel(item_model):
-    model_type = item_model.pop("@type")
-    callToAction = item_model.pop("callToAction", None)
+    model_type = item_model["@type"]
+    callToAction = item_model.get("callToAction", None)
     model_children = []
 
     if callToAction:
         children = []
         for fname in CALLTOACTION_FIELDS:
-            fv = callToAction.pop("label", "")
+            fv = callToAction.get(fname, "")
             if fv is not None:
                 children.append(E.DIV(fv, **{"data-fieldname": fname}))
 
-        callAttributes = {"data-volto-calltoaction": json.dumps(callToAction)}
+        callAttributes = {
+            "data-volto-calltoaction": dump_metadata(
+                without(callToAction, *CALLTOACTION_FIELDS))
+        }
         call_div = E.DIV(*children, **callAttributes)
         model_children.append(call_div)
 
     model_attributes = {
         "data-model-type": model_type,
-        "data-volto-block": json.dumps(item_model),
+        "data-volto-block": dump_metadata(
+            without(item_model, "@type", "callToAction")),
     }
     model_div = E.DIV(*model_children, **model_attributes)
     return model_div
@@ -291,20 +378,22 @@ def serialize_itemModel(item_model):
 
 def serialize_teaser(block_data):
     # serialized = generic_block_converter(TEASER_FIELDS)(block_data)
-    _type = block_data.pop("@type")
+    _type = block_data["@type"]
     children = []
     for name in TEASER_FIELDS:
-        value = block_data.pop(name, None)
+        value = block_data.get(name, None)
         if value is not None:
             cdiv = E.DIV(value, **{"data-fieldname": name})
             children.append(cdiv)
 
+    # the itemModel is kept in the block data too
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(
+            without(block_data, "@type", *TEASER_FIELDS)),
     }
 
-    item_model = block_data.pop("itemModel", None)
+    item_model = block_data.get("itemModel", None)
     if item_model:
         model_div = serialize_itemModel(item_model)
         children.append(model_div)
@@ -315,29 +404,31 @@ def serialize_teaser(block_data):
 
 
 def serialize_hero(block_data):
-    _type = block_data.pop("@type")
+    _type = block_data["@type"]
 
     # Extract translated fields
     children = []
     for name in HERO_FIELDS:
-        value = block_data.pop(name, None)
+        value = block_data.get(name, None)
         if value is not None:
             cdiv = E.DIV(value, **{"data-fieldname": name})
             children.append(cdiv)
 
     # Handle nested blocks
-    data_container = block_data.pop("data", {})
+    data_container = block_data.get("data", {})
     if data_container:
         container_children = []
-        for _, block in iterate_blocks(data_container):
-            container_children.extend(convert_block_to_elements(block))
+        for uid, block in iterate_blocks(data_container):
+            container_children.extend(
+                with_uid(convert_block_to_elements(block), uid))
 
         blocks_div = E.DIV(*container_children, **{"data-volto-section": "blocks"})
         children.append(blocks_div)
 
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(
+            without(block_data, "@type", "data", *HERO_FIELDS)),
     }
 
     div = E.DIV(*children, **attributes)
@@ -345,40 +436,41 @@ def serialize_hero(block_data):
 
 
 def serialize_grid_block(block_data):
-    _type = block_data.pop("@type")
+    _type = block_data["@type"]
     
     # gridBlock has 'blocks' and 'blocks_layout' directly at the root, 
     # unlike other blocks where it might be under 'data'.
     # We create a temporary structure to reuse iterate_blocks
     temp_data = {
-        "blocks": block_data.pop("blocks", {}),
-        "blocks_layout": block_data.pop("blocks_layout", {"items": []})
+        "blocks": block_data.get("blocks", {}),
+        "blocks_layout": block_data.get("blocks_layout", {"items": []})
     }
     
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(
+            without(block_data, "@type", "blocks", "blocks_layout")),
     }
 
     children = []
-    for _, block in iterate_blocks(temp_data):
-        children.extend(convert_block_to_elements(block))
+    for uid, block in iterate_blocks(temp_data):
+        children.extend(with_uid(convert_block_to_elements(block), uid))
 
     div = E.DIV(*children, **attributes)
     return [div]
 
 
 def serialize_title_block(block_data):
-    _type = block_data.pop("@type")
+    _type = block_data["@type"]
     translate_fields = ["subtitle"]
 
     fv = {}
     for name in translate_fields:
-        value = block_data.pop(name, None)
+        value = block_data.get(name, None)
         if value is not None:
             fv[name] = value
 
-    info = block_data.pop("info", [])
+    info = block_data.get("info", [])
     infoel = E.DIV(
         *[E.DIV(bit.get("description", ""), id=bit["@id"]) for bit in info],
         **{"data-fieldname": "info"},
@@ -386,7 +478,8 @@ def serialize_title_block(block_data):
 
     attributes = {
         "data-block-type": _type,
-        "data-volto-block": json.dumps(block_data),
+        "data-volto-block": dump_metadata(
+            without(block_data, "@type", "info", *translate_fields)),
     }
 
     children = [infoel] + [
@@ -410,11 +503,11 @@ converters = {
     "quote": generic_slate_block("value"),
     "item": generic_slate_block("description"),
     # generics
-    "listing": generic_block_converter(["headline"]),
-    "nextCloudVideo": generic_block_converter(["title"]),
-    "layoutSettings": generic_block_converter([]),
-    "callToActionBlock": generic_block_converter(["text"]),
-    "searchlib": generic_block_converter(["searchInputPlaceholder"]),
+    "listing": generic_block_converter(GENERIC_FIELDS["listing"]),
+    "nextCloudVideo": generic_block_converter(GENERIC_FIELDS["nextCloudVideo"]),
+    "layoutSettings": generic_block_converter(GENERIC_FIELDS["layoutSettings"]),
+    "callToActionBlock": generic_block_converter(GENERIC_FIELDS["callToActionBlock"]),
+    "searchlib": generic_block_converter(GENERIC_FIELDS["searchlib"]),
     "statistic_block": serialize_statistics_block,
     # teaserGrid and teasers support (including the card)
     "teaserGrid": serialize_teaserGrid,
@@ -425,7 +518,7 @@ converters = {
 }
 
 
-def convert_block_to_elements(block_data):
+def block_to_elements(block_data):
     _type = block_data.get("@type", None)
 
     if _type is None:
@@ -438,19 +531,152 @@ def convert_block_to_elements(block_data):
     return converters[_type](block_data)
 
 
-def convert_blocks_to_html(data):
+def memoized(key, render):
+    """The memoized result of render(), with the metadata it put in the sidecar"""
+
+    sidecar = _sidecar.get()
+    key = key + (sidecar is not None, keep_uids())
+    entry = fragments_memo.get(key)
+    if entry is None:
+        token = _sidecar.set({} if sidecar is not None else None)
+        try:
+            entry = (render(), _sidecar.get())
+        finally:
+            _sidecar.reset(token)
+        fragments_memo.set(key, entry)
+    else:
+        metrics.incr("fragment_hits")
+
+    result, metadata = entry
+    if metadata and sidecar is not None:
+        sidecar.update(metadata)
+    return result
+
+
+def convert_block_to_elements(block_data, key=None):
+    """The elements of a block, from the memo if the block was seen before
+
+    The container blocks get the elements of their children from here too.
+    The outermost caller gets a copy of the memoized elements. A container
+    takes the elements its children just rendered as they are, the memo of a
+    child then points into the tree of its container. Only the children found
+    in the memo are copied, an lxml element has a single parent.
+    """
+
+    key = key or cache_key("block", block_data)
+    rendered = False
+
+    def render():
+        nonlocal rendered
+        rendered = True
+        token = _nested.set(True)
+        try:
+            return block_to_elements(block_data)
+        finally:
+            _nested.reset(token)
+
+    elements = memoized(("elements", key), render)
+    if rendered and _nested.get():
+        return elements
+    return deepcopy(elements)
+
+
+def block_to_html(block_data, key, uid=None):
+    if block_data.get("@type") == "slate" and "value" in block_data:
+        # the most common block, it doesn't need lxml elements
+        return serialize_slate_to_html(block_data, uid) or ""
+
+    elements = with_uid(convert_block_to_elements(block_data, key), uid)
+    if elements:
+        return elements_to_text(elements)
+    return ""
+
+
+def iter_blocks_html(data):
+    """Yields the html of convert_blocks_to_html, one block at a time"""
+
     order = data.blocks_layout["items"]
     blocks = data.blocks
-    fragments = []
+    separator = ""
 
     for uid in order:
         block = blocks.get(uid, None)
         if block is None:
             logger.warning("Unable to find block %s - %r", uid, blocks)
             continue
-        elements = convert_block_to_elements(block)
-        if elements:
-            html = elements_to_text(elements)
-            fragments.append(html)
 
-    return "\n".join(fragments)
+        key = cache_key("block", block)
+        memo_key = ("html", key, uid if keep_uids() else None)
+        html = memoized(memo_key, lambda: block_to_html(block, key, uid))
+        if html:
+            yield separator + html
+            separator = "\n"
+
+
+def convert_blocks_to_html(data):
+    return "".join(iter_blocks_html(data))
+
+
+# the html document around the blocks, as html2content reads it
+DOCUMENT_HEAD = "<html><body><div data-field='blocks'>"
+DOCUMENT_TAIL = "</div></body></html>"
+
+
+def stream_blocks_document(data):
+    """The html document of the blocks, as chunks: the head, the html of each
+    block, as it is serialized, and the tail
+
+    Only one block is held in memory at a time. The layout is checked now, so a
+    bad request fails before any chunk is sent.
+    """
+
+    if not isinstance(data.blocks_layout.get("items"), list):
+        raise ValueError("The blocks layout has no items")
+
+    return chain([DOCUMENT_HEAD], iter_blocks_html(data), [DOCUMENT_TAIL])
+
+
+def convert_blocks_to_html_and_metadata(data):
+    """Converts the blocks to html that only keeps references to their metadata
+
+    Returns the html and the metadata by reference, the sidecar that
+    convert_html_to_content needs to rebuild the blocks.
+    """
+
+    token = _sidecar.set({})
+    try:
+        html = convert_blocks_to_html(data)
+        return {"html": html, "metadata": _sidecar.get()}
+    finally:
+        _sidecar.reset(token)
+
+
+def convert_blocks_to_html_with_uids(data):
+    """Converts the blocks to html that keeps their ids, like STABLE_BLOCK_IDS"""
+
+    token = _keep_uids.set(True)
+    try:
+        return convert_blocks_to_html(data)
+    finally:
+        _keep_uids.reset(token)
+
+
+def convert_blocks_document(data):
+    """The blocks2html response for the blocks of a request
+
+    All the segments are listed, the ones in the translation memory are only
+    left out after the results cache (see main.without_remembered_segments).
+    """
+
+    # segments uses the fields of the serializers defined here
+    from .segments import segments_to_translate
+
+    if data.sidecar:
+        response = convert_blocks_to_html_and_metadata(data)
+    else:
+        response = {"html": convert_blocks_to_html(data)}
+
+    if data.segments:
+        blocks = {"blocks": data.blocks, "blocks_layout": data.blocks_layout}
+        response["segments"] = segments_to_translate(blocks)
+    return response
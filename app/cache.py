@@ -0,0 +1,344 @@
+"""Content-addressed cache of conversion results
+
+The same pages are converted again and again (retries, re-translations of
+unchanged pages). The results are cached by a hash of the normalized request.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict
+
+from . import metrics
+
+
+def cache_key(name, payload):
+    """Hashes the request payload of the `name` converter
+
+    The payload is normalized: dataclasses become dicts and the keys are sorted.
+    """
+
+    normalized = json.dumps(
+        [name, payload],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=asdict,
+    )
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def result_size(value):
+    return len(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+
+
+class ResultCache:
+    """LRU cache bounded by the size of the results in bytes, with a TTL
+
+    get() returns None for a missing or expired result. The hits, misses and
+    evictions are counted in `stats` and in the request counters.
+    """
+
+    blocking = False
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, size, value)
+        self.size = 0
+        self.stats = Counter()
+
+    def count(self, name, value=1):
+        self.stats[name] += value
+        metrics.incr(f"cache_{name}", value)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+            self.remove(key)
+            self.count("evictions")
+            entry = None
+
+        if entry is None:
+            self.count("misses")
+            return None
+
+        self.entries.move_to_end(key)
+        self.count("hits")
+        return entry[2]
+
+    def set(self, key, value):
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.remove(key)
+
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.entries[key] = (expires, size, value)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.count("evictions")
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+
+def sqlite_connect(path, *schema):
+    """A connection to the SQLite database, in WAL mode, with its tables"""
+
+    connection = sqlite3.connect(
+        path, timeout=10, isolation_level=None, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    for statement in schema:
+        connection.execute(statement)
+    return connection
+
+
+@contextmanager
+def immediate_transaction(connection):
+    """A write transaction, that waits for the other writers first"""
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+class SQLiteResultCache:
+    """ResultCache stored in a SQLite database, in WAL mode
+
+    The database is shared by the workers of the host and survives restarts.
+    The TTL is in wall clock time, because it is shared between processes.
+    Each process opens its own connection on first use.
+
+    The calls wait for the database, they are `blocking`. The total size is
+    kept up to date by triggers. The hits don't write: the times the results
+    were used are written with the next set(), or once TOUCH_BATCH are pending.
+    """
+
+    blocking = True
+    TOUCH_BATCH = 100
+
+    def __init__(self, path, max_bytes, ttl=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = Counter()
+        self.touched = {}  # key -> time it was used, not written yet
+        self.lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def count(self, name, value=1):
+        self.stats[name] += value
+        metrics.incr(f"cache_{name}", value)
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite_connect(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, "
+                "value TEXT, size INTEGER, expires REAL, used REAL)",
+                "CREATE INDEX IF NOT EXISTS results_used ON results (used)",
+                "CREATE TABLE IF NOT EXISTS results_size (total INTEGER)",
+                "INSERT INTO results_size SELECT COALESCE(SUM(size), 0) FROM results "
+                "WHERE NOT EXISTS (SELECT 1 FROM results_size)",
+                "CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results "
+                "BEGIN UPDATE results_size SET total = total + NEW.size; END",
+                "CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF size "
+                "ON results BEGIN "
+                "UPDATE results_size SET total = total + NEW.size - OLD.size; END",
+                "CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results "
+                "BEGIN UPDATE results_size SET total = total - OLD.size; END",
+            )
+            self._pid = os.getpid()
+            self.touched = {}
+        return self._connection
+
+    @property
+    def size(self):
+        with self.lock:
+            return self.total(self.connection)
+
+    @staticmethod
+    def total(connection):
+        return connection.execute("SELECT total FROM results_size").fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            connection = self.connection
+            row = connection.execute(
+                "SELECT value, expires FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] is not None and row[1] < now:
+                connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.touched.pop(key, None)
+                self.count("evictions")
+                row = None
+
+            if row is None:
+                self.count("misses")
+                return None
+
+            self.touched[key] = now
+            if len(self.touched) >= self.TOUCH_BATCH:
+                with immediate_transaction(connection):
+                    self.write_touched(connection)
+
+        self.count("hits")
+        return json.loads(row[0])
+
+    def write_touched(self, connection):
+        connection.executemany(
+            "UPDATE results SET used = ? WHERE key = ?",
+            [(used, key) for key, used in self.touched.items()],
+        )
+        self.touched = {}
+
+    def set(self, key, value):
+        value = json.dumps(value, separators=(",", ":"))
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        expires = now + self.ttl if self.ttl else None
+        with self.lock:
+            evicted = self.insert(key, value, size, expires, now)
+
+        if evicted:
+            self.count("evictions", evicted)
+
+    def insert(self, key, value, size, expires, now):
+        """Stores the result and evicts the least recently used ones that don't
+        fit anymore, returns their number"""
+
+        with immediate_transaction(self.connection) as connection:
+            self.write_touched(connection)
+            connection.execute(
+                "INSERT INTO results VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO "
+                "UPDATE SET value = excluded.value, size = excluded.size, "
+                "expires = excluded.expires, used = excluded.used",
+                (key, value, size, expires, now),
+            )
+            total = self.total(connection)
+            stale = []
+            if total > self.max_bytes:
+                rows = connection.execute(
+                    "SELECT key, size FROM results ORDER BY used, rowid")
+                for old_key, old_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((old_key,))
+                    total -= old_size
+                connection.executemany("DELETE FROM results WHERE key = ?", stale)
+        return len(stale)
+
+
+class TranslationMemory:
+    """Translated segments, by the hash of their source text and by language
+
+    It is stored in a SQLite database, shared by the workers of the host. A lock
+    serializes the threads of the process on its connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite_connect(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS memory (source TEXT, language TEXT, "
+                "translation TEXT, PRIMARY KEY (source, language))",
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def source_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def lookup(self, language, texts):
+        """The known translations of the texts, by text"""
+
+        hashes = {self.source_hash(text): text for text in texts}
+        found = {}
+        keys = list(hashes)
+        with self.lock:
+            connection = self.connection
+            for i in range(0, len(keys), 500):  # SQLite limits the query parameters
+                chunk = keys[i:i + 500]
+                rows = connection.execute(
+                    "SELECT source, translation FROM memory WHERE language = ? "
+                    f"AND source IN ({','.join('?' * len(chunk))})",
+                    [language, *chunk],
+                )
+                for source, translation in rows:
+                    found[hashes[source]] = translation
+        return found
+
+    def store(self, language, translations):
+        """Remembers the translations, a mapping of source text to translation"""
+
+        rows = [
+            (self.source_hash(text), language, translation)
+            for text, translation in translations.items()
+        ]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO memory VALUES (?, ?, ?)", rows)
+
+
+class LRUMemo:
+    """Thread safe LRU mapping bounded by its number of entries
+
+    It is shared by the conversions that run in the thread pool.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
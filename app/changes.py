@@ -0,0 +1,89 @@
+"""Incremental translation of a page that was translated before
+
+Only the blocks that changed since the previous translation go through
+blocks2html, translation and html2content. The translations of the other
+blocks are taken from the previous translation, by block id.
+"""
+
+from types import SimpleNamespace
+
+from .blocks2html import convert_blocks_to_html_with_uids
+from .cache import cache_key
+from .html2content import convert_html_to_content
+
+
+def changed_blocks(previous, data):
+    """The ids of the blocks that are new or have changed since previous"""
+
+    previous_blocks = previous.get("blocks", {})
+    changed = []
+    for uid in data.blocks_layout["items"]:
+        block = data.blocks.get(uid)
+        if block is None:
+            continue
+        old = previous_blocks.get(uid)
+        if old is None or cache_key("block", old) != cache_key("block", block):
+            changed.append(uid)
+    return changed
+
+
+def blocks_by_owner(content, uids):
+    """The blocks of the content, grouped by the source block they came from
+
+    A source slate block with several paragraphs gives several blocks, the
+    first one keeps its id and the next ones follow it.
+    """
+
+    owners = {}
+    owner = None
+    for uid in content.get("blocks_layout", {}).get("items", []):
+        if uid in uids:
+            owner = uid
+        if owner is not None:
+            owners.setdefault(owner, []).append((uid, content["blocks"][uid]))
+    return owners
+
+
+def convert_changed_blocks_to_html(data):
+    """The html of the blocks changed since data.previous, with their ids"""
+
+    changed = changed_blocks(data.previous, data)
+    blocks = SimpleNamespace(
+        blocks=data.blocks, blocks_layout={"items": changed})
+    return {"html": convert_blocks_to_html_with_uids(blocks), "changed": changed}
+
+
+def convert_changes_to_content(data):
+    """Merges the translated html of the changed blocks with the previous
+    translation of the unchanged ones, in the order of the current blocks
+
+    Raises ValueError if an unchanged block isn't in the previous translation,
+    it has to be sent as changed.
+    """
+
+    changed = changed_blocks(data.previous, data)
+    content = convert_html_to_content(data.html).get("blocks", {})
+    translated = blocks_by_owner(content, set(changed))
+
+    previous_uids = set(data.previous.get("blocks_layout", {}).get("items", []))
+    reused = blocks_by_owner(data.translation, previous_uids)
+
+    missing = [
+        uid for uid in data.blocks_layout["items"]
+        if uid in data.blocks and uid not in changed and uid not in reused
+    ]
+    if missing:
+        raise ValueError(
+            "Blocks missing from the previous translation: " + ", ".join(missing))
+
+    blocks = {}
+    items = []
+    for uid in data.blocks_layout["items"]:
+        if uid not in data.blocks:
+            continue
+        source = translated if uid in changed else reused
+        for block_uid, block in source.get(uid, []):
+            blocks[block_uid] = block
+            items.append(block_uid)
+
+    return {"blocks": {"blocks": blocks, "blocks_layout": {"items": items}}}
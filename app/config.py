@@ -1,5 +1,35 @@
 """config module"""
 
+import os
+
+# Tree used to deserialize html to slate: "bs4" or "lxml"
+HTML2SLATE_BACKEND = os.environ.get("HTML2SLATE_BACKEND", "bs4")
+# Tree used by html2content to read the html of blocks2html: "bs4" or "lxml"
+HTML2CONTENT_BACKEND = os.environ.get("HTML2CONTENT_BACKEND", "bs4")
+
+# Where the conversions run: "inline" (on the event loop), "thread" or "process"
+CONVERSION_MODE = os.environ.get("CONVERSION_MODE", "inline")
+# Pool size, defaults to the number of cpus
+CONVERSION_WORKERS = int(os.environ.get("CONVERSION_WORKERS", 0)) or os.cpu_count() or 1
+# Conversions waiting for a worker, more requests are rejected with 503
+CONVERSION_QUEUE_SIZE = int(os.environ.get("CONVERSION_QUEUE_SIZE", 32))
+
+# Size in bytes of the blocks2html and html2content results cache, 0 disables it
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 0))
+# Seconds a cached result is kept, 0 keeps it until evicted
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 0))
+# SQLite database of the results cache, shared by the workers of the host
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "")
+# Rendered blocks kept by blocks2html, unchanged blocks are not serialized again
+BLOCK_FRAGMENT_CACHE_SIZE = int(os.environ.get("BLOCK_FRAGMENT_CACHE_SIZE", 1024))
+
+# Keep the block ids through blocks2html and html2content, and derive the
+# missing ones from the block content instead of generating random ones
+STABLE_BLOCK_IDS = os.environ.get("STABLE_BLOCK_IDS", "").lower() in ("1", "true", "yes")
+
+# SQLite database of the translated segments, they are not sent again
+TRANSLATION_MEMORY_PATH = os.environ.get("TRANSLATION_MEMORY_PATH", "")
+
 ACCEPTED_TAGS = [  # valid volto-slate elements
     "a",
     "b",
@@ -0,0 +1,252 @@
+"""Runs the conversions off the event loop, in a thread or process pool
+
+The conversions are synchronous lxml and BeautifulSoup work. Run inline, a big
+page blocks every other request of the worker, including the healthcheck.
+"""
+
+import asyncio
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from litestar.exceptions import ServiceUnavailableException
+
+from . import metrics
+
+POOLS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+BARRIERS = {"thread": threading.Barrier, "process": multiprocessing.Barrier}
+
+# seconds a warmed up worker waits for the others
+WARM_UP_TIMEOUT = 60
+
+
+class QueueFull(ServiceUnavailableException):
+    detail = "Too many conversions waiting, try again later"
+
+
+def warm_up(ready=None):
+    """Imports the converters and runs them once, when a worker starts
+
+    Then the worker waits for the others at the `ready` barrier. The pools only
+    start a new worker when none is idle, so all of them are started.
+    """
+
+    from .blocks2html import convert_blocks_to_html  # noqa
+    from .html2blocks import text_to_blocks
+    from .html2content import convert_html_to_content  # noqa
+
+    text_to_blocks("<p>warm up</p>")
+
+    if ready is not None:
+        try:
+            ready.wait(WARM_UP_TIMEOUT)
+        except threading.BrokenBarrierError:
+            pass  # the pool still works, some workers warm up on first use
+
+
+# returned by next() at the end of a stream, StopIteration can't cross a future
+END_OF_STREAM = object()
+
+
+async def inline_stream(iterator):
+    for item in iterator:
+        yield item
+
+
+def call_with_counters(func, *args):
+    """Calls func in a worker, returning its result and its request counters"""
+
+    with metrics.collect() as counters:
+        result = func(*args)
+    return result, counters
+
+
+class PooledStream:
+    """The async iterator of ConversionExecutor.stream, in a pool
+
+    It gives its place in the queue back when it ends, fails or is closed. A
+    response that is never iterated, when the client leaves first, has to
+    close it: an async generator that never started ignores aclose().
+    """
+
+    def __init__(self, executor, iterator):
+        self.executor = executor
+        self.iterator = iterator
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+
+        try:
+            item = await self.executor.submit_to(
+                self.executor.local_pool, next, self.iterator, END_OF_STREAM)
+        except BaseException:
+            await self.aclose()
+            raise
+        if item is END_OF_STREAM:
+            await self.aclose()
+            raise StopAsyncIteration
+        return item
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.executor.pending -= 1
+
+
+class ConversionExecutor:
+    """Runs the conversions inline or in a pool of pre-warmed workers
+
+    At most `workers + queue_size` conversions are accepted at a time, the next
+    ones raise QueueFull.
+    """
+
+    def __init__(self, mode="inline", workers=1, queue_size=0):
+        if mode != "inline" and mode not in POOLS:
+            raise ValueError(f"Unknown conversion mode: {mode}")
+
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self.pool = None
+
+    def start(self):
+        if self.mode == "inline" or self.pool is not None:
+            return
+
+        ready = BARRIERS[self.mode](self.workers)
+        self.pool = POOLS[self.mode](
+            max_workers=self.workers, initializer=warm_up, initargs=(ready,))
+        # start and warm up all the workers now, instead of on the first requests
+        wait([self.pool.submit(abs, 0) for _ in range(self.workers)])
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    async def submit(self, func, *args):
+        return await self.submit_to(self.pool, func, *args)
+
+    async def submit_to(self, pool, func, *args):
+        loop = asyncio.get_running_loop()
+        result, counters = await loop.run_in_executor(
+            pool, call_with_counters, func, *args
+        )
+
+        for name, value in counters.items():
+            metrics.incr(name, value)
+        return result
+
+    async def run(self, func, *args):
+        if self.pool is None:
+            return func(*args)
+
+        if self.pending >= self.workers + self.queue_size:
+            raise QueueFull()
+
+        self.pending += 1
+        try:
+            return await self.submit(func, *args)
+        finally:
+            self.pending -= 1
+
+    @property
+    def local_pool(self):
+        """The pool of the conversions whose arguments or results can't be sent
+        to other processes, such as iterators and lxml trees. In process mode,
+        the default thread pool of the loop."""
+
+        return self.pool if self.mode == "thread" else None
+
+    async def run_local(self, func, *args):
+        """Like run, in the local_pool"""
+
+        return await self.run_in(self.local_pool, func, *args)
+
+    async def run_in(self, pool, func, *args):
+        """Like run, in the given pool of this process"""
+
+        if self.pool is None:
+            return func(*args)
+
+        if self.pending >= self.workers + self.queue_size:
+            raise QueueFull()
+
+        self.pending += 1
+        try:
+            return await self.submit_to(pool, func, *args)
+        finally:
+            self.pending -= 1
+
+    @contextmanager
+    def single_thread(self):
+        """A pool of one thread, for run_in, for the objects that have to stay
+        on the thread that created them, such as lxml's feed parsers. None when
+        the conversions run inline."""
+
+        if self.pool is None:
+            yield None
+            return
+
+        pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            yield pool
+        finally:
+            pool.shutdown(wait=False)
+
+    async def stream(self, func, *args):
+        """Runs func(*args), which returns an iterator, and returns an async
+        iterator over its items
+
+        The iterator is created now, so its errors are raised here. Its items
+        are then computed one at a time, off the event loop, in the local_pool.
+        A stream takes a place in the queue until it ends or is closed.
+        """
+
+        if self.pool is None:
+            return inline_stream(func(*args))
+
+        if self.pending >= self.workers + self.queue_size:
+            raise QueueFull()
+
+        self.pending += 1
+        try:
+            iterator = await self.submit_to(self.local_pool, func, *args)
+        except BaseException:
+            self.pending -= 1
+            raise
+        return PooledStream(self, iterator)
+
+    async def run_batch(self, func, documents):
+        """Converts the documents in parallel, with func
+
+        Returns the results in the same order, or the exception raised by the
+        conversion of each failed document. A batch takes a single place in the
+        queue, its documents are spread over all the workers.
+        """
+
+        if self.pool is None:
+            results = []
+            for document in documents:
+                try:
+                    results.append(func(document))
+                except Exception as exc:
+                    results.append(exc)
+            return results
+
+        if self.pending >= self.workers + self.queue_size:
+            raise QueueFull()
+
+        self.pending += 1
+        try:
+            runs = [self.submit(func, document) for document in documents]
+            return await asyncio.gather(*runs, return_exceptions=True)
+        finally:
+            self.pending -= 1
@@ -1,27 +1,86 @@
 import json
 import logging
 from collections import deque
-from copy import deepcopy
-from uuid import uuid4
+from functools import lru_cache
+from uuid import NAMESPACE_URL, uuid4, uuid5
 
+import lxml.etree
+import lxml.html
 from bs4 import BeautifulSoup
-from lxml.html import document_fromstring
-
-from app.config import DEFAULT_BLOCK_TYPE, VALID_TOPLEVEL_SLATE_TYPES
-
-from .html2slate import text_to_slate
-from .slate2html import slate_to_html
+from bs4.element import NavigableString
+
+from app.config import (
+    DEFAULT_BLOCK_TYPE,
+    HTML2SLATE_BACKEND,
+    STABLE_BLOCK_IDS,
+    VALID_TOPLEVEL_SLATE_TYPES,
+)
+
+from . import metrics
+from .html2slate import (
+    HTML2Slate,
+    child_nodes,
+    extract_node,
+    lxml_voltoblocks,
+    node_attrs,
+    node_name,
+    parent_node,
+    voltoblock_data,
+)
+from .html2slate import body_fromstring as lxml_body_fromstring
+from .html2slate import detach_body
+from .html2slate import node_text as element_text
 from .utils import nanoid
 
 logger = logging.getLogger()
 
 
-def make_uid():
+BLOCK_UID_NAMESPACE = uuid5(NAMESPACE_URL, "https://github.com/eea/volto-blocks-converter")
+
+
+def make_uid(data=None):
+    """A random block id, or with STABLE_BLOCK_IDS one derived from the data"""
+
+    if STABLE_BLOCK_IDS and data is not None:
+        canonical = json.dumps(data, sort_keys=True, separators=(",", ":"))
+        return str(uuid5(BLOCK_UID_NAMESPACE, canonical))
     return str(uuid4())
 
 
+def table_key(*position):
+    """A random key for a table row or cell, or with STABLE_BLOCK_IDS one
+    derived from its position, so the block data and its id are stable
+    """
+
+    if STABLE_BLOCK_IDS:
+        return "-".join(str(i) for i in position)
+    return nanoid()
+
+
+def unique_uid(uid, taken):
+    """The uid, or one derived from it if a sibling block already has it
+
+    Identical blocks get the same content derived id.
+    """
+
+    i = 0
+    derived = uid
+    while derived in taken:
+        i += 1
+        derived = str(uuid5(BLOCK_UID_NAMESPACE, f"{uid}:{i}"))
+    return derived
+
+
+def unique_uids(uids):
+    taken = set()
+    for uid in uids:
+        uid = unique_uid(uid, taken)
+        taken.add(uid)
+        yield uid
+
+
 def make_tab_block(tabs):
-    block_ids = [make_uid() for _ in tabs]
+    block_ids = list(unique_uids(make_uid(tab) for tab in tabs))
     blocks = {}
 
     for i, tab in enumerate(tabs):
@@ -40,7 +99,7 @@ def make_tab_block(tabs):
 
 
 def make_accordion_block(panels):
-    block_ids = [make_uid() for _ in panels]
+    block_ids = list(unique_uids(make_uid(panel) for panel in panels))
 
     blocks = {}
 
@@ -64,290 +123,675 @@ def make_accordion_block(panels):
 
 
 def block_tag(data, soup_or_tag):
+    """Makes a <voltoblock> placeholder tag for an already converted block
+
+    The block data is kept as is in the tag attributes, so nested containers
+    don't pay for a json round trip at every level. The tag is deserialized by
+    HTML2Slate.handle_tag_voltoblock and is never written back to html.
+    """
+
     if soup_or_tag.parent:
         soup = list(soup_or_tag.parents)[-1]
     else:
         soup = soup_or_tag
 
     element = soup.new_tag("voltoblock")
-    element["data-voltoblock"] = json.dumps(data)
+    element["data-voltoblock"] = data
 
     return element
 
 
-def convert_tabs(soup):
-    nav_tabs = soup.find_all("ul", attrs={"class": "nav nav-tabs"})
+def lxml_block_tag(data):
+    """block_tag for lxml trees
 
-    if not nav_tabs:
-        return
+    lxml attributes are strings: the data is kept in the lxml_voltoblocks of the
+    conversion and the attribute only has its key.
+    """
 
-    for ul in nav_tabs:
-        div_content = ul.find_next_sibling("div", class_="tab-content")
-        tab_structure = []
-        tabs = ul.find_all("li")
+    blocks = lxml_voltoblocks.get()
+    if blocks is None:
+        value = json.dumps(data)
+    else:
+        value = f"#{len(blocks)}"
+        blocks[value] = data
 
-        for li in tabs:
-            if li.a is None:
-                # broken html generated
-                continue
+    return lxml.html.Element("voltoblock", {"data-voltoblock": value})
 
-            tab_id = li.a.attrs["href"].replace("#", "")
-            title = li.a.text
 
-            tab_blocks = text_to_blocks(
-                div_content.find_all("div", {"id": tab_id}, limit=1)[0]
-            )
+def replace_node(element, replacement):
+    """Replaces an lxml element, its tail stays in place"""
 
-            tab_structure.append(
-                {"id": tab_id, "title": title, "content": tab_blocks})
+    replacement.tail = element.tail
+    element.tail = None
+    element.getparent().replace(element, replacement)
 
-        data = make_tab_block(tab_structure)
-        ul.replace_with(block_tag(data, soup))  # no need to decompose
-        div_content.decompose()
 
+def has_class(name):
+    """XPath condition of a class, like BeautifulSoup's class_ matching"""
 
-def convert_iframe(soup):
-    # TODO: also apply the height
-    iframes = soup.find_all("iframe")
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
 
-    for tag in iframes:
-        data = {"@type": "maps", "url": tag.attrs["src"]}
-        tag.replace_with(block_tag(data, soup))
 
+# Preprocessors replace the html of complex volto blocks with <voltoblock> tags.
+# They're registered by the element they convert and dispatched by
+# preprocess_tree, in a single walk of the tree.
+PREPROCESSORS = {"tag": {}, "class": {}, "block-type": {}}
+# The XPath of the elements each preprocessor converts, to find them in lxml trees
+SELECTORS = {}
+# The lxml version of each preprocessor, registered with lxml_preprocessor
+LXML_PREPROCESSORS = {}
 
-def convert_button(soup):
-    buttons = soup.find_all("a", attrs={"class": "bluebutton"})
 
-    for button in buttons:
-        target = button.attrs["target"] if button.has_attr(
-            "target") else "_self"
+def preprocessor(tag=None, class_=None, block_type=None):
+    """Registers a preprocessor for the elements matching all the given criteria
 
-        data = {
-            "@type": "callToActionBlock",
-            "text": button.text,
-            "href": button.attrs["href"],
-            "target": target,
-            "styles": {"icon": "ri-share-line", "theme": "primary", "align": "left"},
-        }
+    The preprocessor is called with a matching element and converts it in place.
+    `class_` can list several classes, separated by spaces, all of them required,
+    in any order and among other classes: "nav nav-tabs" also matches
+    class="nav-tabs nav foo", unlike BeautifulSoup's exact string match.
+    The criteria are also the markers looked up in the raw html, to skip the
+    preprocessors that can't match anything (see applicable_preprocessors).
+    """
 
-        parent = button.find_parent("p")
-        if parent:
-            parent.replace_with(block_tag(data, soup))
+    classes = class_.split() if class_ else []
+    markers = [f"<{tag}"] if tag else []
+    markers += classes
+    if block_type:
+        markers += ["data-block-type", block_type]
+    markers = tuple(marker.lower() for marker in markers)
+
+    conditions = [has_class(cls) for cls in classes]
+    if block_type:
+        conditions.append(f"@data-block-type='{block_type}'")
+    selector = f"descendant::{tag or '*'}" + "".join(f"[{c}]" for c in conditions)
+
+    def register(func):
+        if block_type:
+            key = ("block-type", block_type)
+        elif classes:
+            key = ("class", classes[0])
         else:
-            button.replace_with(block_tag(data, soup))
+            key = ("tag", tag)
 
+        entry = (tag, classes, block_type, markers, func)
+        PREPROCESSORS[key[0]].setdefault(key[1], []).append(entry)
+        SELECTORS[func] = selector
+        return func
 
-def convert_read_more(soup):
-    links = soup.find_all("a", attrs={"class": "accordion-toggle"})
+    return register
 
-    new_data = {
-        "@type": "readMoreBlock",
-        "height": "50vh",
-        "label_closed": "Read more",
-        "label_opened": "Read less",
-        "label_position": "right",
-    }
 
-    for tag in links:
-        if tag.text == "Read more":
-            tag.replace_with(block_tag(new_data, soup))
+def lxml_preprocessor(preprocessor):
+    """Registers the lxml version of a preprocessor"""
+
+    def register(func):
+        LXML_PREPROCESSORS[preprocessor] = func
+        return func
+
+    return register
 
 
-def convert_accordion(soup):
-    accordions = soup.find_all("div", attrs={"class": "panel-group"})
+def matching_preprocessors(element):
+    attrs = node_attrs(element)
+    name = node_name(element)
+    candidates = PREPROCESSORS["tag"].get(name, [])
+
+    classes = attrs.get("class") or []
+    for cls in classes:
+        candidates = candidates + PREPROCESSORS["class"].get(cls, [])
+
+    block_type = attrs.get("data-block-type")
+    if block_type:
+        candidates = candidates + PREPROCESSORS["block-type"].get(block_type, [])
+
+    for tag, required_classes, required_block_type, _, func in candidates:
+        if tag and name != tag:
+            continue
+        if any(cls not in classes for cls in required_classes):
+            continue
+        if required_block_type and block_type != required_block_type:
+            continue
+        yield func
 
-    # accordion_titles = soup.find_all("div", attrs={"class": "panel-heading"})
-    # if accordion_titles and not accordions:
-    #     for node in accordion_titles:
-    #         node.decompose()
-    #     return
 
-    if not accordions:
-        # handle single accordion, aka "Read more", which we remove
+def applicable_preprocessors(text):
+    """Returns the preprocessors whose markers are all found in the raw html
+
+    Most pages don't have any of the converted blocks, this cheap substring
+    check allows skipping the tree walk altogether.
+    """
+
+    text = text.lower()
+    applicable = set()
+    skipped = 0
+
+    for entries in PREPROCESSORS.values():
+        for entry_list in entries.values():
+            for *_, markers, func in entry_list:
+                if all(marker in text for marker in markers):
+                    applicable.add(func)
+                else:
+                    skipped += 1
+
+    metrics.incr("skipped_preprocessors", skipped)
+    return applicable
+
+
+def preprocess_tree(soup, applicable=None):
+    """Runs the preprocessors over the descendants of the soup, innermost first
+
+    The tree is walked once. The matching elements are then converted in reverse
+    document order, so every nested block is already a <voltoblock> tag when its
+    container is converted. Only the `applicable` preprocessors run, if given.
+    """
+
+    if applicable is not None and not applicable:
         return
 
-    for div in accordions:
-        panels = div.find_all("div", attrs={"class": "panel"})
+    lxml_tree = isinstance(soup, lxml.etree._Element)
+    if lxml_tree:
+        # only the candidates of the preprocessors are visited, found by XPath
+        funcs = frozenset(SELECTORS if applicable is None else applicable)
+        elements = preprocessors_xpath(funcs)(soup)
+    else:
+        elements = soup.find_all(True)
 
-        panels_structure = []
-        for panel in panels:
-            panel_id = (
-                panel.find_all("div", attrs={"class": "panel-heading"})[0]
-                .attrs["id"]
-                .split("-heading")[0]
-            )
-            panel_title = panel.find_all(
-                "h4", attrs={"class": "panel-title"})[0].text
+    matches = [
+        (element, func)
+        for element in elements
+        for func in matching_preprocessors(element)
+        if applicable is None or func in applicable
+    ]
 
-            _panel_bodies = panel.find_all(
-                "div", attrs={"class": "panel-body"})
+    for element, func in reversed(matches):
+        if not in_tree(element, soup):  # replaced together with a converted block
+            continue
+        if lxml_tree:
+            func = LXML_PREPROCESSORS[func]
+        func(element)
 
-            if panel_title == "Read more":
-                return
 
-            blocks = []
-            for panel_body in _panel_bodies:
-                blocks.extend(text_to_blocks(panel_body))
+def in_tree(element, root):
+    """Whether the element is still a descendant of root. An element inside a
+    replaced one is in a detached subtree, its own parent is still set."""
 
-            panels_structure.append(
-                {"id": panel_id, "title": panel_title, "content": blocks}
-            )
+    node = parent_node(element)
+    while node is not None and node is not root:
+        node = parent_node(node)
+    return node is root
+
+
+@lru_cache(maxsize=64)
+def preprocessors_xpath(funcs):
+    """The XPath of the elements converted by the preprocessors, a union of their
+    selectors in document order"""
+
+    return lxml.etree.XPath(" | ".join(sorted(SELECTORS[func] for func in funcs)))
+
+
+def element_to_blocks(element):
+    """Converts the content of a preprocessed element to [uid, block] pairs"""
+
+    slate = HTML2Slate().from_elements([element])
+    return convert_slate_to_blocks(slate)
+
+
+def blocks_storage(blocks_list):
+    blocks = {}
+    blocks_layout_items = []
 
-        data = make_accordion_block(panels_structure)
-        div.replace_with(block_tag(data, soup))
+    for uid, block in blocks_list:
+        blocks[uid] = block
+        blocks_layout_items.append(uid)
 
+    return blocks, {"items": blocks_layout_items}
 
-def convert_grid_block(soup):
-    grid_blocks = soup.find_all("div", attrs={"data-block-type": "gridBlock"})
 
-    for div in grid_blocks:
-        if not div.parent:
+@preprocessor("ul", class_="nav nav-tabs")
+def convert_tabs(ul):
+    div_content = ul.find_next_sibling("div", class_="tab-content")
+    if div_content is None:
+        # the panes were left out, such as in a html2content fragment that only
+        # has the tab list: it stays a list
+        return
+    tab_structure = []
+    tabs = ul.find_all("li")
+
+    for li in tabs:
+        if li.a is None:
+            # broken html generated
             continue
 
-        # Base data
-        data_str = div.attrs.get("data-volto-block", "{}")
-        data = json.loads(data_str)
-        data["@type"] = "gridBlock"
+        tab_id = li.a.attrs["href"].replace("#", "")
+        title = li.a.text
+
+        tab_blocks = element_to_blocks(
+            div_content.find_all("div", {"id": tab_id}, limit=1)[0]
+        )
 
-        # The gridBlock stores its blocks directly under 'blocks' and 'blocks_layout'
-        # unlike other blocks which put them under 'data'.
-        # However, text_to_blocks returns a list of [uid, block], so we need to
-        # reconstruction the structure.
-        
-        # We need to process the children of the div to find the nested blocks
-        nested_blocks_list = text_to_blocks(div)
+        tab_structure.append(
+            {"id": tab_id, "title": title, "content": tab_blocks})
 
-        blocks = {}
-        blocks_layout_items = []
+    data = make_tab_block(tab_structure)
+    ul.replace_with(block_tag(data, ul))  # no need to decompose
+    div_content.decompose()
 
-        for uid, block in nested_blocks_list:
-            blocks[uid] = block
-            blocks_layout_items.append(uid)
-            
-        # We update the existing data with the potentially modified nested blocks
-        # (e.g. translated content)
-        data["blocks"] = blocks
-        data["blocks_layout"] = {"items": blocks_layout_items}
 
-        div.replace_with(block_tag(data, soup))
+TAB_CONTENT = lxml.etree.XPath(f"following-sibling::div[{has_class('tab-content')}][1]")
+TAB_LINK = lxml.etree.XPath("(.//a)[1]")
+TAB_PANE = lxml.etree.XPath("(.//div[@id=$id])[1]")
 
 
-def convert_hero(soup):
-    hero_blocks = soup.find_all("div", attrs={"data-block-type": "hero"})
+@lxml_preprocessor(convert_tabs)
+def lxml_convert_tabs(ul):
+    div_content = TAB_CONTENT(ul)
+    if not div_content:
+        return
+    div_content = div_content[0]
+    tab_structure = []
 
-    for div in hero_blocks:
-        if not div.parent:
+    for li in ul.iter("li"):
+        link = TAB_LINK(li)
+        if not link:
+            # broken html generated
             continue
 
-        # Base data
-        data_str = div.attrs.get("data-volto-block", "{}")
-        data = json.loads(data_str)
-        data["@type"] = "hero"
+        tab_id = link[0].attrib["href"].replace("#", "")
+        title = element_text(link[0])
 
-        # Extract translated fields
-        for field in ["buttonLabel", "copyright"]:
-            field_div = div.find("div", attrs={"data-fieldname": field})
-            if field_div:
-                data[field] = field_div.text
+        tab_blocks = element_to_blocks(TAB_PANE(div_content, id=tab_id)[0])
 
-        # Extract nested blocks
-        blocks_div = div.find("div", attrs={"data-volto-section": "blocks"})
-        if blocks_div:
-            nested_blocks_list = text_to_blocks(blocks_div)
+        tab_structure.append(
+            {"id": tab_id, "title": title, "content": tab_blocks})
 
-            blocks = {}
-            blocks_layout_items = []
+    data = make_tab_block(tab_structure)
+    replace_node(ul, lxml_block_tag(data))
+    extract_node(div_content)
 
-            for uid, block in nested_blocks_list:
-                blocks[uid] = block
-                blocks_layout_items.append(uid)
 
-            data["data"] = {
-                "blocks": blocks,
-                "blocks_layout": {"items": blocks_layout_items}
-            }
+@preprocessor("iframe")
+def convert_iframe(tag):
+    # TODO: also apply the height
+    data = {"@type": "maps", "url": tag.attrs["src"]}
+    tag.replace_with(block_tag(data, tag))
 
-        div.replace_with(block_tag(data, soup))
 
+@lxml_preprocessor(convert_iframe)
+def lxml_convert_iframe(tag):
+    data = {"@type": "maps", "url": tag.attrib["src"]}
+    replace_node(tag, lxml_block_tag(data))
+
+
+@preprocessor("a", class_="bluebutton")
+def convert_button(button):
+    target = button.attrs["target"] if button.has_attr(
+        "target") else "_self"
+
+    data = {
+        "@type": "callToActionBlock",
+        "text": button.text,
+        "href": button.attrs["href"],
+        "target": target,
+        "styles": {"icon": "ri-share-line", "theme": "primary", "align": "left"},
+    }
+
+    parent = button.find_parent("p")
+    if parent:
+        parent.replace_with(block_tag(data, button))
+    else:
+        button.replace_with(block_tag(data, button))
+
+
+@lxml_preprocessor(convert_button)
+def lxml_convert_button(button):
+    data = {
+        "@type": "callToActionBlock",
+        "text": element_text(button),
+        "href": button.attrib["href"],
+        "target": button.attrib.get("target", "_self"),
+        "styles": {"icon": "ri-share-line", "theme": "primary", "align": "left"},
+    }
+
+    parent = next(button.iterancestors("p"), None)
+    replace_node(button if parent is None else parent, lxml_block_tag(data))
+
+
+READ_MORE_BLOCK = {
+    "@type": "readMoreBlock",
+    "height": "50vh",
+    "label_closed": "Read more",
+    "label_opened": "Read less",
+    "label_position": "right",
+}
+
+
+@preprocessor("a", class_="accordion-toggle")
+def convert_read_more(tag):
+    if tag.text == "Read more":
+        tag.replace_with(block_tag(dict(READ_MORE_BLOCK), tag))
+
+
+@lxml_preprocessor(convert_read_more)
+def lxml_convert_read_more(tag):
+    if element_text(tag) == "Read more":
+        replace_node(tag, lxml_block_tag(dict(READ_MORE_BLOCK)))
+
+
+def is_read_more(title):
+    """Checks if an accordion panel title is a "Read more" toggle
+
+    The toggle link in the title is converted before the accordion, to a
+    readMoreBlock.
+    """
+
+    if element_text(title) == "Read more":
+        return True
+
+    if isinstance(title, lxml.etree._Element):
+        tags = title.iterdescendants("voltoblock")
+    else:
+        tags = title.find_all("voltoblock")
+
+    return any(voltoblock_data(tag).get("@type") == "readMoreBlock" for tag in tags)
 
-def convert_teaser(soup):
-    teasers = soup.find_all("div", attrs={"data-block-type": "teaser"})
 
-    for div in teasers:
-        if not div.parent:
+@preprocessor("div", class_="panel-group")
+def convert_accordion(div):
+    panels = div.find_all("div", attrs={"class": "panel"})
+
+    panels_structure = []
+    for panel in panels:
+        panel_id = (
+            panel.find_all("div", attrs={"class": "panel-heading"})[0]
+            .attrs["id"]
+            .split("-heading")[0]
+        )
+        title = panel.find_all("h4", attrs={"class": "panel-title"})[0]
+        panel_title = title.text
+
+        _panel_bodies = panel.find_all(
+            "div", attrs={"class": "panel-body"})
+
+        if is_read_more(title):
+            return
+
+        blocks = []
+        for panel_body in _panel_bodies:
+            blocks.extend(element_to_blocks(panel_body))
+
+        panels_structure.append(
+            {"id": panel_id, "title": panel_title, "content": blocks}
+        )
+
+    data = make_accordion_block(panels_structure)
+    div.replace_with(block_tag(data, div))
+
+
+ACCORDION_PANELS = lxml.etree.XPath(f".//div[{has_class('panel')}]")
+PANEL_HEADING = lxml.etree.XPath(f"(.//div[{has_class('panel-heading')}])[1]")
+PANEL_TITLE = lxml.etree.XPath(f"(.//h4[{has_class('panel-title')}])[1]")
+PANEL_BODIES = lxml.etree.XPath(f".//div[{has_class('panel-body')}]")
+
+
+@lxml_preprocessor(convert_accordion)
+def lxml_convert_accordion(div):
+    panels_structure = []
+    for panel in ACCORDION_PANELS(div):
+        panel_id = PANEL_HEADING(panel)[0].attrib["id"].split("-heading")[0]
+        title = PANEL_TITLE(panel)[0]
+
+        if is_read_more(title):
+            return
+
+        blocks = []
+        for panel_body in PANEL_BODIES(panel):
+            blocks.extend(element_to_blocks(panel_body))
+
+        panels_structure.append(
+            {"id": panel_id, "title": element_text(title), "content": blocks}
+        )
+
+    data = make_accordion_block(panels_structure)
+    replace_node(div, lxml_block_tag(data))
+
+
+@preprocessor("div", block_type="gridBlock")
+def convert_grid_block(div):
+    # Base data
+    data_str = div.attrs.get("data-volto-block", "{}")
+    data = json.loads(data_str)
+    data["@type"] = "gridBlock"
+
+    # The gridBlock stores its blocks directly under 'blocks' and 'blocks_layout'
+    # unlike other blocks which put them under 'data'.
+    # However, element_to_blocks returns a list of [uid, block], so we need to
+    # reconstruction the structure.
+
+    # We update the existing data with the potentially modified nested blocks
+    # (e.g. translated content)
+    data["blocks"], data["blocks_layout"] = blocks_storage(element_to_blocks(div))
+
+    div.replace_with(block_tag(data, div))
+
+
+@lxml_preprocessor(convert_grid_block)
+def lxml_convert_grid_block(div):
+    data = json.loads(div.attrib.get("data-volto-block", "{}"))
+    data["@type"] = "gridBlock"
+    data["blocks"], data["blocks_layout"] = blocks_storage(element_to_blocks(div))
+
+    replace_node(div, lxml_block_tag(data))
+
+
+@preprocessor("div", block_type="hero")
+def convert_hero(div):
+    # Base data
+    data_str = div.attrs.get("data-volto-block", "{}")
+    data = json.loads(data_str)
+    data["@type"] = "hero"
+
+    # Extract translated fields
+    for field in ["buttonLabel", "copyright"]:
+        field_div = div.find("div", attrs={"data-fieldname": field})
+        if field_div:
+            data[field] = field_div.text
+
+    # Extract nested blocks
+    blocks_div = div.find("div", attrs={"data-volto-section": "blocks"})
+    if blocks_div:
+        blocks, blocks_layout = blocks_storage(element_to_blocks(blocks_div))
+        data["data"] = {"blocks": blocks, "blocks_layout": blocks_layout}
+
+    div.replace_with(block_tag(data, div))
+
+
+HERO_FIELD = lxml.etree.XPath("(.//div[@data-fieldname=$name])[1]")
+HERO_BLOCKS = lxml.etree.XPath("(.//div[@data-volto-section='blocks'])[1]")
+
+
+@lxml_preprocessor(convert_hero)
+def lxml_convert_hero(div):
+    data = json.loads(div.attrib.get("data-volto-block", "{}"))
+    data["@type"] = "hero"
+
+    for field in ["buttonLabel", "copyright"]:
+        for field_div in HERO_FIELD(div, name=field):
+            data[field] = element_text(field_div)
+
+    for blocks_div in HERO_BLOCKS(div):
+        blocks, blocks_layout = blocks_storage(element_to_blocks(blocks_div))
+        data["data"] = {"blocks": blocks, "blocks_layout": blocks_layout}
+
+    replace_node(div, lxml_block_tag(data))
+
+
+@preprocessor("div", block_type="teaser")
+def convert_teaser(div):
+    data_str = div.attrs.get("data-volto-block", "{}")
+    data = json.loads(data_str)
+    data["@type"] = "teaser"
+
+    # Extract fields
+    for field_div in div.find_all("div", attrs={"data-fieldname": True}):
+        if field_div.parent == div:
+            data[field_div.attrs["data-fieldname"]] = field_div.text
+
+    # Extract itemModel
+    item_model_div = div.find("div", attrs={"data-model-type": True})
+    if item_model_div and item_model_div.parent == div:
+        model_data_str = item_model_div.attrs.get("data-volto-block", "{}")
+        model_data = json.loads(model_data_str)
+        model_data["@type"] = item_model_div.attrs["data-model-type"]
+
+        # Handle callToAction in itemModel
+        call_div = item_model_div.find(
+            "div", attrs={"data-volto-calltoaction": True})
+        if call_div:
+            call_data = json.loads(
+                call_div.attrs["data-volto-calltoaction"])
+            # Extract label from children
+            for child in call_div.find_all("div", attrs={"data-fieldname": "label"}):
+                call_data["label"] = child.text
+            model_data["callToAction"] = call_data
+
+        data["itemModel"] = model_data
+
+    div.replace_with(block_tag(data, div))
+
+
+TEASER_FIELDS = lxml.etree.XPath("div[@data-fieldname]")
+TEASER_MODEL = lxml.etree.XPath("(.//div[@data-model-type])[1]")
+TEASER_CALLTOACTION = lxml.etree.XPath("(.//div[@data-volto-calltoaction])[1]")
+CALLTOACTION_LABELS = lxml.etree.XPath(".//div[@data-fieldname='label']")
+
+
+@lxml_preprocessor(convert_teaser)
+def lxml_convert_teaser(div):
+    data = json.loads(div.attrib.get("data-volto-block", "{}"))
+    data["@type"] = "teaser"
+
+    for field_div in TEASER_FIELDS(div):
+        data[field_div.attrib["data-fieldname"]] = element_text(field_div)
+
+    for item_model_div in TEASER_MODEL(div):
+        if item_model_div.getparent() is not div:
             continue
+        model_data = json.loads(item_model_div.attrib.get("data-volto-block", "{}"))
+        model_data["@type"] = item_model_div.attrib["data-model-type"]
+
+        for call_div in TEASER_CALLTOACTION(item_model_div):
+            call_data = json.loads(call_div.attrib["data-volto-calltoaction"])
+            for child in CALLTOACTION_LABELS(call_div):
+                call_data["label"] = element_text(child)
+            model_data["callToAction"] = call_data
+
+        data["itemModel"] = model_data
+
+    replace_node(div, lxml_block_tag(data))
+
+
+def body_fromstring(text):
+    """Parses html to a BeautifulSoup tree and returns its body
+
+    The lxml parser cleans up the broken html, the same way text_to_slate does.
+    Everything around the body children is dropped, so they're deserialized just
+    like the fragments of text_to_slate.
+    """
+
+    soup = BeautifulSoup(text, "lxml")
+    metrics.incr("parse")
+
+    body = soup.body
+    if body is None:
+        return None
+
+    for sibling in list(body.previous_siblings) + list(body.next_siblings):
+        sibling.extract()
+
+    first = next(iter(body.children), None)
+    if type(first) is NavigableString:  # the text of lxml's body, not a comment
+        first.extract()
+
+    return body
+
+
+def text_to_blocks(text_or_element, backend=None):
+    """Converts html to a list of [uid, block] pairs
+
+    The html can be a string or an element from a tree parsed by body_fromstring.
+    The tree is preprocessed and deserialized to slate in place, without writing
+    it back to html. The backend (bs4 or lxml) defaults to the HTML2SLATE_BACKEND
+    setting.
+    """
 
-        data_str = div.attrs.get("data-volto-block", "{}")
-        data = json.loads(data_str)
-        data["@type"] = "teaser"
-
-        # Extract fields
-        for field_div in div.find_all("div", attrs={"data-fieldname": True}):
-            if field_div.parent == div:
-                data[field_div.attrs["data-fieldname"]] = field_div.text
-
-        # Extract itemModel
-        item_model_div = div.find("div", attrs={"data-model-type": True})
-        if item_model_div and item_model_div.parent == div:
-            model_data_str = item_model_div.attrs.get("data-volto-block", "{}")
-            model_data = json.loads(model_data_str)
-            model_data["@type"] = item_model_div.attrs["data-model-type"]
-
-            # Handle callToAction in itemModel
-            call_div = item_model_div.find(
-                "div", attrs={"data-volto-calltoaction": True})
-            if call_div:
-                call_data = json.loads(
-                    call_div.attrs["data-volto-calltoaction"])
-                # Extract label from children
-                for child in call_div.find_all("div", attrs={"data-fieldname": "label"}):
-                    call_data["label"] = child.text
-                model_data["callToAction"] = call_data
-
-            data["itemModel"] = model_data
-
-        div.replace_with(block_tag(data, soup))
-
-
-preprocessors = [
-    convert_tabs,
-    convert_iframe,
-    convert_accordion,
-    convert_hero,
-    convert_grid_block,
-    convert_teaser,
-    convert_read_more,
-    convert_button,
-]
-
-
-def text_to_blocks(text_or_element):
     if text_or_element and not isinstance(text_or_element, str):
-        soup = text_or_element
-    else:
-        soup = BeautifulSoup(str(text_or_element), "html.parser")
+        preprocess_tree(text_or_element)
+        return element_to_blocks(text_or_element)
+
+    backend = backend or HTML2SLATE_BACKEND
+    if backend == "lxml":
+        return lxml_text_to_blocks(str(text_or_element))
+    elif backend != "bs4":
+        raise ValueError(f"Unknown html2blocks backend: {backend}")
 
-    for proc in preprocessors:
-        proc(soup)
+    text = str(text_or_element)
+    soup = body_fromstring(text)
+    if soup is None:
+        return []
 
-    new_text = str(soup)
+    preprocess_tree(soup, applicable_preprocessors(text))
 
-    slate = text_to_slate(new_text)
+    slate = HTML2Slate().from_elements(list(soup.children))
 
     blocks = convert_slate_to_blocks(slate)
     return blocks
 
 
+def lxml_text_to_blocks(text):
+    """text_to_blocks on an lxml tree, with the lxml preprocessors"""
+
+    try:
+        body = lxml_body_fromstring(text)
+    except lxml.etree.ParserError:  # no html at all
+        return []
+
+    return lxml_body_to_blocks(body, applicable_preprocessors(text))
+
+
+def document_to_blocks(text, document):
+    """text_to_blocks of an html document already parsed with lxml, such as the
+    one of html2slate.HTMLFeed. The text is only used for the preprocessors
+    markers."""
+
+    if document is None or document.find("body") is None:
+        return []
+    return lxml_body_to_blocks(detach_body(document), applicable_preprocessors(text))
+
+
+def lxml_body_to_blocks(body, applicable):
+    token = lxml_voltoblocks.set({})
+    try:
+        preprocess_tree(body, applicable)
+        slate = HTML2Slate().from_elements(list(child_nodes(body)))
+    finally:
+        lxml_voltoblocks.reset(token)
+
+    return convert_slate_to_blocks(slate)
+
+
 def convert_slate_to_blocks(slate):
     blocks = []
     for paragraph in slate:
         maybe_block = convert_block(paragraph, parent=None)
 
         if not isinstance(maybe_block, list):
-            blocks.append([make_uid(), maybe_block])
+            blocks.append([make_uid(maybe_block), maybe_block])
         else:
             blocks.extend(maybe_block)
 
+    if STABLE_BLOCK_IDS:
+        uids = unique_uids(uid for uid, _ in blocks)
+        blocks = [[uid, block] for uid, (_, block) in zip(uids, blocks)]
     return blocks
 
 
@@ -402,14 +846,15 @@ def table_to_columns_block(node):
                 colblocks[uid] = block
                 colblocks_layout.append(uid)
 
-            uid = make_uid()
-            columns_storage["blocks"][uid] = {
+            column = {
                 "blocks": colblocks,
                 "blocks_layout": {"items": colblocks_layout},
             }
+            uid = unique_uid(make_uid(column), columns_storage["blocks"])
+            columns_storage["blocks"][uid] = column
             columns_storage["blocks_layout"]["items"].append(uid)
 
-        blocks.append([make_uid(), blockdata])
+        blocks.append([make_uid(blockdata), blockdata])
 
     def body_to_columns(body):
         for child in body["children"]:
@@ -456,22 +901,23 @@ def table_to_table_block(node, plaintext):
         elif child["type"] == "thead":
             thead = child
 
-    for theadrow in (thead or {}).get("children", []):
-        row = {"cells": [], "key": nanoid()}
+    theadrows = (thead or {}).get("children", [])
+    for i, theadrow in enumerate(theadrows):
+        row = {"cells": [], "key": table_key(i)}
         block["table"]["rows"].append(row)
 
-        for child in theadrow.get("children", []):
-            cell = {"key": nanoid()}
+        for j, child in enumerate(theadrow.get("children", [])):
+            cell = {"key": table_key(i, j)}
             cell["value"] = child["children"]
             cell["type"] = "header"
             row["cells"].append(cell)
 
-    for tbodyrow in (tbody or {}).get("children", []):
-        row = {"cells": [], "key": nanoid()}
+    for i, tbodyrow in enumerate((tbody or {}).get("children", []), len(theadrows)):
+        row = {"cells": [], "key": table_key(i)}
         block["table"]["rows"].append(row)
 
-        for child in tbodyrow.get("children", []):
-            cell = {"key": nanoid()}
+        for j, child in enumerate(tbodyrow.get("children", [])):
+            cell = {"key": table_key(i, j)}
             cell["value"] = child["children"]
             cell["type"] = "data"
             row["cells"].append(cell)
@@ -532,25 +978,44 @@ def convert_volto_block(block, node, plaintext, parent=None):
         }
 
 
+def node_text(slate_node):
+    if "text" in slate_node:
+        # line breaks are <br> tags in html, they have no text
+        return slate_node["text"].replace("\n", "")
+
+    if slate_node.get("type") == "voltoblock":  # not rendered to html
+        return ""
+
+    return "".join(node_text(child) for child in slate_node.get("children", []))
+
+
 def extract_text(slate_node):
-    """ Extract plaintext from a slate node by converting to HTML and using lxml
+    """Extracts the plaintext of a slate node, walking its children
+
+    Gives the text content of the node's html, without rendering and parsing it.
+    A text node is at the start of that html document, where lxml skips the
+    leading whitespace.
     """
-    html = slate_to_html([slate_node])
-    if not (html and html.strip()):
-        return ""
-    try:
-        # throws error on VOLTOBLOCKS
-        e = document_fromstring(html)
-        text = e.text_content()
-        return text
-    except AttributeError:
-        return ""
+
+    if "text" in slate_node:
+        text = slate_node["text"]
+        if "\n" not in text and not text.strip():
+            return ""
+
+        first, *lines = text.split("\n")
+        return "".join([first.lstrip(" \t\r")] + lines)
+
+    return node_text(slate_node)
 
 
 def convert_block(slate_node, parent=None):
     # TODO: do the plaintext
 
-    plaintext = extract_text(deepcopy(slate_node))
+    if slate_node.get("type") == "voltoblock" and slate_node["data"]:
+        # already converted by a preprocessor, don't copy its nested blocks
+        return slate_node["data"]
+
+    plaintext = extract_text(slate_node)
     volto_block = convert_volto_block(
         slate_node, slate_node, plaintext, parent=parent)
     if volto_block:
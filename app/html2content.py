@@ -3,145 +3,191 @@
 import json
 import logging
 import os
-from uuid import uuid4
+import re
+from contextvars import ContextVar, copy_context
+from copy import deepcopy
+from typing import Optional
 
+import lxml.etree
+import lxml.html
 from bs4 import BeautifulSoup
-from bs4.element import Tag
 
-from .html2blocks import make_uid, text_to_blocks
-from .html2slate import HTML2Slate
-from .utils import nanoid
+from . import metrics
+from .config import HTML2CONTENT_BACKEND
+from .html2blocks import make_uid, table_key, text_to_blocks, unique_uid
+from .html2slate import (
+    HTML2Slate,
+    child_nodes,
+    extract_node,
+    is_element,
+    node_attrs,
+    node_name,
+    node_text,
+    pop_attribute,
+    soup_string,
+)
 
 logger = logging.getLogger(__name__)
 
-# import lxml.html
+BODY_TAG = re.compile(r"<body\b", re.I)
 
 DEBUG = os.environ.get("DEBUG", False) and "TTT----" or ""
 
 
 def get_elements(node):
-    for child in node.children:
-        if child.name:
+    for child in child_nodes(node):
+        if is_element(child):
             yield child
 
 
+def table_rows(fragment):
+    """The rows of the tables in the fragment, like the "table tr" selector"""
+
+    if isinstance(fragment, lxml.etree._Element):
+        return fragment.xpath(".//tr[ancestor::table]")
+    return fragment.css.select("table tr")
+
+
+# the metadata sidecar of blocks2html, by reference
+_sidecar: ContextVar[Optional[dict]] = ContextVar("sidecar", default=None)
+
+
+def load_metadata(raw):
+    """The block metadata from the sidecar, or from its json in the html"""
+
+    sidecar = _sidecar.get()
+    if sidecar is not None and raw in sidecar:
+        # blocks with the same metadata share the reference
+        return deepcopy(sidecar[raw])
+    return json.loads(raw)
+
+
+def block_uid(element, data):
+    """The block id kept by blocks2html, or a new one"""
+
+    return node_attrs(element).get("data-block-uid") or make_uid(data)
+
+
 def deserialize_layout_block(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
 
     colblockdata = {"blocks_layout": {"items": []}, "blocks": {}}
 
     for column in get_elements(fragment):
-        rawcolsettings = column.attrs.get("data-volto-column-data", "{}")
-        colsettings = json.loads(rawcolsettings)
+        rawcolsettings = node_attrs(column).get("data-volto-column-data", "{}")
+        colsettings = load_metadata(rawcolsettings)
         coldata = deserialize_blocks(column)
         coldata.update(colsettings)
-        coluid = str(uuid4())
+        coluid = unique_uid(block_uid(column, coldata), colblockdata["blocks"])
         colblockdata["blocks"][coluid] = coldata
         colblockdata["blocks_layout"]["items"].append(coluid)
 
     if "data" not in data:
         data["data"] = {}
     data["data"].update(colblockdata)
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
 
     return [uid, data]
 
 
 def deserialize_teaserGrid(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
     columns = []
-    for colel in fragment.children:
-        blockel = next(colel.children)
+    for colel in child_nodes(fragment):
+        blockel = next(child_nodes(colel))
         block = deserialize_block(blockel)[1]
         columns.append(block)
 
     data["columns"] = columns
 
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
     return [uid, data]
 
 
 def deserialize_title_block(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
 
-    for ediv in fragment.children:
-        if not isinstance(ediv, Tag):
+    for ediv in child_nodes(fragment):
+        if not is_element(ediv):
             continue
-        name = ediv.attrs["data-fieldname"]
+        name = node_attrs(ediv)["data-fieldname"]
         if name != "info":
-            data[name] = f"{DEBUG}{ediv.text}"
+            data[name] = f"{DEBUG}{node_text(ediv)}"
         else:
             data["info"] = [
-                {"@id": el.attrs["id"], "description": f"{DEBUG}{el.text}"}
-                for el in ediv.children
+                {
+                    "@id": node_attrs(el)["id"],
+                    "description": f"{DEBUG}{node_text(el)}",
+                }
+                for el in child_nodes(ediv)
             ]
 
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
     return [uid, data]
 
 
 def deserialize_layout_block_with_titles(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
 
     colblockdata = {"blocks_layout": {"items": []}, "blocks": {}}
 
     for column in get_elements(fragment):
-        metaelement = next(column.children)
-        metaelement.extract()
-        val = metaelement.attrs["data-volto-column"]
-        metadata = json.loads(val)
-        for ediv in metaelement.children:
-            name = ediv.attrs["data-fieldname"]
-            metadata[name] = f"{DEBUG}{ediv.text}"
+        metaelement = next(child_nodes(column))
+        extract_node(metaelement)
+        val = node_attrs(metaelement)["data-volto-column"]
+        metadata = load_metadata(val)
+        for ediv in child_nodes(metaelement):
+            name = node_attrs(ediv)["data-fieldname"]
+            metadata[name] = f"{DEBUG}{node_text(ediv)}"
 
         coldata = deserialize_blocks(column)
         coldata.update(metadata)
-        coluid = str(uuid4())
+        coluid = unique_uid(block_uid(column, coldata), colblockdata["blocks"])
         colblockdata["blocks"][coluid] = coldata
         colblockdata["blocks_layout"]["items"].append(coluid)
 
     if "data" not in data:
         data["data"] = {}
     data["data"].update(colblockdata)
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
 
     return [uid, data]
 
 
 def deserialize_hero(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
 
-    for ediv in fragment.children:
-        if not isinstance(ediv, Tag):
+    for ediv in child_nodes(fragment):
+        if not is_element(ediv):
             continue
 
-        if "data-fieldname" in ediv.attrs:
-            name = ediv.attrs["data-fieldname"]
-            data[name] = f"{DEBUG}{ediv.text}"
-        elif ediv.attrs.get("data-volto-section") == "blocks":
+        if "data-fieldname" in node_attrs(ediv):
+            name = node_attrs(ediv)["data-fieldname"]
+            data[name] = f"{DEBUG}{node_text(ediv)}"
+        elif node_attrs(ediv).get("data-volto-section") == "blocks":
             nested_data = deserialize_blocks(ediv)
             if "data" not in data:
                 data["data"] = {}
             data["data"].update(nested_data)
 
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
     return [uid, data]
 
 
 def deserialize_grid_block(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
 
     # deserialize_blocks iterates children and returns blocks dict and layout
     # content = deserialize_blocks(fragment)
@@ -152,35 +198,35 @@ def deserialize_grid_block(fragment):
     data["blocks"] = nested["blocks"]
     data["blocks_layout"] = nested["blocks_layout"]
 
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
     return [uid, data]
 
 
 def deserialize_group_block(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
     data["data"] = deserialize_blocks(fragment)
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
     return [uid, data]
 
 
 def deserialize_slate_table_block(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
 
     data["rows"] = []
 
-    for erow in fragment.css.select("table tr"):
-        row = {"cells": [], "key": nanoid()}
+    for i, erow in enumerate(table_rows(fragment)):
+        row = {"cells": [], "key": table_key(i)}
         data["rows"].append(row)
-        for ecell in get_elements(erow):
-            cell = {"key": nanoid()}
-            cell["value"] = HTML2Slate().from_elements(ecell)
+        for j, ecell in enumerate(get_elements(erow)):
+            cell = {"key": table_key(i, j)}
+            cell["value"] = HTML2Slate().from_elements(child_nodes(ecell))
 
-            if ecell.name == "th":
+            if node_name(ecell) == "th":
                 cell["type"] = "header"
-            elif ecell.name == "td":
+            elif node_name(ecell) == "td":
                 cell["type"] = "data"
             else:
                 raise ValueError
@@ -188,31 +234,31 @@ def deserialize_slate_table_block(fragment):
             row["cells"].append(cell)
 
     block = {"@type": "slateTable", "table": data}
-    return [str(uuid4()), block]
+    return [block_uid(fragment, block), block]
 
 
 def deserialize_statistic_block(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
     data["@type"] = "statistic_block"
     data["items"] = []
 
-    for eitem in fragment.children:
-        rawitemdata = eitem.attrs["volto-data-item"]
-        itemdata = json.loads(rawitemdata)
-        for div in eitem:
-            fieldname = div.attrs["fieldname"]
-            itemdata[fieldname] = HTML2Slate().from_elements(div.children)
+    for eitem in child_nodes(fragment):
+        rawitemdata = node_attrs(eitem)["volto-data-item"]
+        itemdata = load_metadata(rawitemdata)
+        for div in child_nodes(eitem):
+            fieldname = node_attrs(div)["fieldname"]
+            itemdata[fieldname] = HTML2Slate().from_elements(child_nodes(div))
         data["items"].append(itemdata)
 
-    return [str(uuid4()), data]
+    return [block_uid(fragment, data), data]
 
 
 def generic_slateblock_converter(fieldname):
     def converter(fragment):
-        rawdata = fragment.attrs["data-volto-block"]
-        _type = fragment.attrs["data-block-type"]
-        data = json.loads(rawdata)
+        rawdata = node_attrs(fragment)["data-volto-block"]
+        _type = node_attrs(fragment)["data-block-type"]
+        data = load_metadata(rawdata)
         data["@type"] = _type
 
         elements = list(get_elements(fragment))
@@ -221,7 +267,7 @@ def generic_slateblock_converter(fieldname):
         visit_slate_nodes(slate_value, debug_translation)
         data[fieldname] = slate_value
 
-        uid = str(uuid4())
+        uid = block_uid(fragment, data)
 
         return [uid, data]
 
@@ -229,84 +275,91 @@ def generic_slateblock_converter(fieldname):
 
 
 def generic_block_converter(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
 
-    for ediv in fragment.children:
-        if not isinstance(ediv, Tag):
+    for ediv in child_nodes(fragment):
+        if not is_element(ediv):
             continue
 
-        name = ediv.attrs["data-fieldname"]
-        data[name] = f"{DEBUG}{ediv.text}"
+        name = node_attrs(ediv)["data-fieldname"]
+        data[name] = f"{DEBUG}{node_text(ediv)}"
 
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
     return [uid, data]
 
 
 def deserialize_itemModel(fragment):
-    data = {"@type": fragment.attrs["data-model-type"]}
-    data.update(json.loads(fragment.attrs["data-volto-block"]))
-
-    for ediv in fragment.children:
-        if "data-volto-calltoaction" in ediv.attrs:
-            callToAction = json.loads(ediv.attrs["data-volto-calltoaction"])
-            for ecdiv in ediv.children:
-                fname = ecdiv.attrs["data-fieldname"]
-                callToAction[fname] = f"{DEBUG}{ecdiv.text}"
+    data = {"@type": node_attrs(fragment)["data-model-type"]}
+    data.update(load_metadata(node_attrs(fragment)["data-volto-block"]))
+
+    for ediv in child_nodes(fragment):
+        if "data-volto-calltoaction" in node_attrs(ediv):
+            callToAction = load_metadata(node_attrs(ediv)["data-volto-calltoaction"])
+            for ecdiv in child_nodes(ediv):
+                fname = node_attrs(ecdiv)["data-fieldname"]
+                callToAction[fname] = f"{DEBUG}{node_text(ecdiv)}"
             data["callToAction"] = callToAction
 
     return data
 
 
 def deserialize_teaser(fragment):
-    rawdata = fragment.attrs["data-volto-block"]
-    data = json.loads(rawdata)
-    data["@type"] = fragment.attrs["data-block-type"]
+    rawdata = node_attrs(fragment)["data-volto-block"]
+    data = load_metadata(rawdata)
+    data["@type"] = node_attrs(fragment)["data-block-type"]
 
-    for ediv in fragment.children:
-        if not isinstance(ediv, Tag):
+    for ediv in child_nodes(fragment):
+        if not is_element(ediv):
             continue
 
-        if "data-model-type" in ediv.attrs:
+        if "data-model-type" in node_attrs(ediv):
             model_info = deserialize_itemModel(ediv)
             data["itemModel"] = model_info
             continue
 
-        name = ediv.attrs["data-fieldname"]
-        data[name] = f"{DEBUG}{ediv.text}"
+        name = node_attrs(ediv)["data-fieldname"]
+        data[name] = f"{DEBUG}{node_text(ediv)}"
 
-    uid = str(uuid4())
+    uid = block_uid(fragment, data)
     return [uid, data]
 
 
 def deserialize_slate_block(fragment):
-    blocks = text_to_blocks(fragment)
+    # the block id is not part of the slate value
+    uid = pop_attribute(fragment, "data-block-uid")
+
+    # text_to_blocks cleans up the html from a string, the fragment comes as it
+    # was parsed by html.parser
+    blocks = text_to_blocks(soup_string(fragment))
+    metrics.incr("serialize")
 
     if len(blocks) == 0:
         # return a placeholder block. An empty text block renders as <div></div>
         # so we try to overcome this
-        return [make_uid(), {"@type": "slate", "value": []}]
+        block = {"@type": "slate", "value": []}
+        return [uid or make_uid(block), block]
 
     if len(blocks) != 1:
         logger.warning(
             "Fragment yielded more then one slate block: %s ===> %r  ",
-            str(fragment),
+            soup_string(fragment),
             blocks,
         )
 
     if len(blocks) == 1:
-        [uid, block] = blocks[0]
+        block = blocks[0][1]
         if block.get("@type") == "slate":
             slate_value = block["value"]
             visit_slate_nodes(slate_value, debug_translation)
 
-            rawdata = fragment.attrs.get("data-volto-block", None)
+            rawdata = node_attrs(fragment).get("data-volto-block", None)
             if rawdata:
-                data = json.loads(rawdata)
+                data = load_metadata(rawdata)
                 block.update(data)
 
-        return [uid, block]
+        return [uid or make_uid(block), block]
 
     items = []
     bb = {}
@@ -314,20 +367,20 @@ def deserialize_slate_block(fragment):
         "@type": "group",
         "data": {"blocks_layout": {"items": items}, "blocks": bb},
     }
-    for uid, block in blocks:
+    for child_uid, block in blocks:
         if block.get("@type") == "slate":
             slate_value = block["value"]
             visit_slate_nodes(slate_value, debug_translation)
 
-            rawdata = fragment.attrs.get("data-volto-block", None)
+            rawdata = node_attrs(fragment).get("data-volto-block", None)
             if rawdata:
-                data = json.loads(rawdata)
+                data = load_metadata(rawdata)
                 block.update(data)
 
-        items.append(uid)
-        bb[uid] = block
+        items.append(child_uid)
+        bb[child_uid] = block
 
-    return [make_uid(), group_block]
+    return [uid or make_uid(group_block), group_block]
 
 
 converters = {
@@ -372,7 +425,7 @@ def debug_translation(node):
 def deserialize_block(fragment):
     """Convert a lxml fragment to a Volto block. This assumes that the HTML
     structure has been previously exported with block2html"""
-    _type = fragment.attrs.get("data-block-type")
+    _type = node_attrs(fragment).get("data-block-type")
     if _type:
         if _type not in converters:
             print(f"Block deserializer needed: {_type}. Using default.")
@@ -385,43 +438,171 @@ def deserialize_block(fragment):
     return deserialize_slate_block(fragment)
 
 
-def deserialize_blocks(element):
-    """Converts a <div> with serialized (html) blocks inside to Volto blocks"""
+def iter_blocks(element):
+    """Yields the [uid, block] of the blocks in a <div>, one at a time"""
 
-    blocks = {}
-    items = []
+    taken = set()
 
     for f in get_elements(element):
         pair = deserialize_block(f)
         if len(pair) != 2:
             continue  # converter not created yet
         uid, block = pair
+        uid = unique_uid(uid, taken)
+        taken.add(uid)
+        yield uid, block
+
+
+def deserialize_blocks(element):
+    """Converts a <div> with serialized (html) blocks inside to Volto blocks"""
+
+    blocks = {}
+    items = []
+
+    for uid, block in iter_blocks(element):
         blocks[uid] = block
         items.append(uid)
 
     return {"blocks": blocks, "blocks_layout": {"items": items}}
 
 
-def convert_html_to_content(text: str):
-    data = {}
-    tree = BeautifulSoup(text, "html.parser")
+def convert_html_to_content(text: str, metadata=None, backend=None):
+    """Converts the html of blocks2html back to content
+
+    The metadata is the sidecar of blocks2html, when the html only has
+    references to it. The backend (bs4 or lxml) defaults to the
+    HTML2CONTENT_BACKEND setting.
+    """
+
+    backend = html2content_backend(backend)
+
+    token = _sidecar.set(metadata)
+    try:
+        return html_to_content(text, backend)
+    finally:
+        _sidecar.reset(token)
+
+
+def convert_html_to_records(text: str, metadata=None, backend=None):
+    """convert_html_to_content, as an iterator of the records of content_records
+
+    The html is parsed now, so a bad document fails before any record is sent.
+    The blocks are converted one by one, as the records are consumed, so the
+    whole content is never held in memory.
+    """
+
+    backend = html2content_backend(backend)
+
+    # the sidecar stays set while the records are consumed, possibly from
+    # other threads, in a context of their own
+    context = copy_context()
+    context.run(_sidecar.set, metadata)
+    fields = context.run(content_fields, text, backend)
 
-    body = tree.find("body")
+    return run_in_context(context, content_records(fields))
+
+
+def run_in_context(context, iterator):
+    while True:
+        try:
+            yield context.run(next, iterator)
+        except StopIteration:
+            return
+
+
+def html2content_backend(backend):
+    backend = backend or HTML2CONTENT_BACKEND
+    if backend not in ("bs4", "lxml"):
+        raise ValueError(f"Unknown html2content backend: {backend}")
+    return backend
+
+
+def convert_document_to_content(document):
+    """convert_html_to_content of the (html, metadata) of a request"""
+
+    return convert_html_to_content(*document)
+
+
+def body_element(text, backend):
+    """The <body> of the html, parsed with the backend, or None"""
+
+    if backend == "bs4":
+        tree = BeautifulSoup(text, "html.parser")
+        metrics.incr("parse")
+        return tree.find("body")
+
+    # lxml adds a body to any html, html.parser only finds the one in the text
+    if not BODY_TAG.search(text):
+        return None
+    tree = lxml.html.document_fromstring(text)
+    metrics.incr("parse")
+    return tree.find("body")
+
+
+def content_fields(text, backend):
+    """The (field, element) of the data-field divs of the html"""
+
+    return body_fields(body_element(text, backend))
+
+
+def body_fields(body):
     if body is None:
-        return data
+        return []
 
-    fragments = body.find_all("div", recursive=False)
+    fields = []
+    for f in get_elements(body):
+        field = node_attrs(f).get("data-field")
+        if node_name(f) == "div" and field:
+            fields.append((field, f))
+    return fields
+
+
+def field_html(element):
+    metrics.incr("serialize")
+    return "".join(soup_string(child) for child in child_nodes(element))
+
+
+def html_to_content(text, backend="bs4"):
+    return fields_to_content(content_fields(text, backend))
+
+
+def document_to_content(text, document):
+    """html_to_content of an html document already parsed with lxml, such as the
+    one of html2slate.HTMLFeed"""
+
+    body = None
+    if document is not None and BODY_TAG.search(text):
+        body = document.find("body")
+    return fields_to_content(body_fields(body))
 
-    for f in fragments:
-        if not hasattr(f, "attrs"):
-            continue
-        field = f.attrs.get("data-field")
-        if not field:
-            continue
 
+def fields_to_content(fields):
+    data = {}
+
+    for field, f in fields:
         if field == "blocks":
             data[field] = deserialize_blocks(f)
         else:
-            data[field] = "".join(str(child) for child in f.children) or ""
+            data[field] = field_html(f)
 
     return data
+
+
+def content_records(fields):
+    """The content of the fields of html_to_content, as a stream of records:
+
+        {"field": <name>, "value": <html>} for the fields other than blocks
+        {"uid": <uid>, "block": <block>} for each top level block, in order
+        {"blocks_layout": {"items": [...]}} after the last block
+    """
+
+    for field, f in fields:
+        if field != "blocks":
+            yield {"field": field, "value": field_html(f)}
+            continue
+
+        items = []
+        for uid, block in iter_blocks(f):
+            items.append(uid)
+            yield {"uid": uid, "block": block}
+        yield {"blocks_layout": {"items": items}}
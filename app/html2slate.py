@@ -3,20 +3,38 @@
 A port of volto-slate' deserialize.js module
 """
 
+import codecs
 import json
 import re
 from collections import deque
+from contextvars import ContextVar
+from typing import Optional, cast
 
+import lxml.etree
 import lxml.html
 from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution
 from bs4.element import NavigableString, Tag
 
-from .config import ACCEPTED_TAGS, DEFAULT_BLOCK_TYPE, INLINE_ELEMENTS
+from . import metrics
+from .config import (
+    ACCEPTED_TAGS,
+    DEFAULT_BLOCK_TYPE,
+    HTML2SLATE_BACKEND,
+    INLINE_ELEMENTS,
+)
 
 SLATE_INLINE_ELEMENTS = [e.lower() for e in INLINE_ELEMENTS] + [
     "link"  # Volto's <a> link
 ]
 
+INLINE_TAGS = frozenset(INLINE_ELEMENTS)
+
+# the block data of the <voltoblock> tags of an lxml tree, by reference. lxml
+# attributes are strings, so the data is kept here instead (see html2blocks)
+lxml_voltoblocks: ContextVar[Optional[dict]] = ContextVar("lxml_voltoblocks", default=None)
+
 SPACE_BEFORE_ENDLINE = re.compile(r"\s+\n", re.M)
 SPACE_AFTER_DEADLINE = re.compile(r"\n\s+", re.M)
 TAB = re.compile(r"\t", re.M)
@@ -28,6 +46,31 @@ FIRST_ALL_SPACE = re.compile(r"^\s+", re.M)
 ANY_SPACE_AT_END = re.compile(r"\s$", re.M)
 ANY_WHITESPACE = re.compile(r"\s|\t|\n", re.M)
 
+# The following mirror what BeautifulSoup does while building its tree, so that
+# walking an lxml tree gives the same slate value as walking the BeautifulSoup one
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+PRESERVE_WHITESPACE_TAGS = ("pre", "textarea")
+# text inside these tags is skipped when reading the text of other elements
+STRING_CONTAINERS = ("rt", "rp", "style", "script", "template")
+# attributes that are split into a list of values
+CDATA_LIST_ATTRIBUTES = {
+    "*": ("class", "accesskey", "dropzone"),
+    "a": ("rel", "rev"),
+    "link": ("rel", "rev"),
+    "td": ("headers",),
+    "th": ("headers",),
+    "form": ("accept-charset",),
+    "object": ("archive",),
+    "area": ("rel",),
+    "icon": ("sizes",),
+    "iframe": ("sandbox",),
+    "output": ("for",),
+}
+# elements written as <br/> by str() of a BeautifulSoup tag
+VOID_ELEMENTS = HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS
+# their text is written as is, without escaping
+CDATA_CONTAINING_TAGS = ("script", "style")
+
 
 def is_inline_slate(el):
     """Returns true if the element is a text node
@@ -102,25 +145,27 @@ def remove_space_follow_space(text, node):
     if not text.startswith(" "):
         return text
 
-    previous = node.previousSibling
-    if previous:
+    previous = previous_sibling(node)
+    if exists(previous):
         if is_textnode(previous):
-            if previous.text.endswith(" "):
+            if node_text(previous).endswith(" "):
                 return FIRST_SPACE.sub("", text)
         elif is_inline(previous):
             prev_text = collapse_inline_space(previous)
             if prev_text.endswith(" "):
                 return FIRST_SPACE.sub("", text)
     else:
-        parent = node.parent
-        if parent.previousSibling:
-            prev_text = collapse_inline_space(parent.previousSibling)
+        parent = parent_node(node)
+        parent_previous = previous_sibling(parent)
+        if exists(parent_previous):
+            prev_text = collapse_inline_space(parent_previous)
             if prev_text and prev_text.endswith(" "):
                 return FIRST_SPACE.sub("", text)
         else:
             # TODO: temporary, to be tested
-            if parent.parent and is_inline(parent.parent):
-                return collapse_inline_space(parent.parent)
+            grandparent = parent_node(parent)
+            if exists(grandparent) and is_inline(grandparent):
+                return collapse_inline_space(grandparent)
             return FIRST_SPACE.sub("", text)
 
     return text
@@ -132,7 +177,7 @@ def is_inline(node):
     if isinstance(node, str) or is_textnode(node):
         return True
 
-    if node.name.upper() in INLINE_ELEMENTS:
+    if (node_name(node) or "").upper() in INLINE_TAGS:
         return True
 
     return False
@@ -141,13 +186,13 @@ def is_inline(node):
 def get_inline_ancestor_sibling(node):
     """Find a "visual sibling" by moving up in DOM hierarchy and finding a sibling"""
 
-    next_ = node.nextSibling
+    next_ = next_sibling(node)
 
     while next_ is None:
-        node = node.parent
+        node = parent_node(node)
         if node is None or not is_inline(node):
             break
-        next_ = node.nextSibling
+        next_ = next_sibling(node)
 
     if (next_ is not None) and (not is_inline(next_)):
         return None
@@ -158,16 +203,18 @@ def get_inline_ancestor_sibling(node):
 def remove_element_edges(text, node):
     """Sequences of spaces at the beginning and end of an element are removed"""
 
-    previous = node.previousSibling
-    next_ = node.nextSibling
-    parent = node.parent
+    previous = previous_sibling(node)
+    next_ = next_sibling(node)
+    parent = parent_node(node)
 
     if (not is_inline(parent)) and (previous is None) and FIRST_ANY_SPACE.search(text):
         text = FIRST_ALL_SPACE.sub("", text)
 
     if ANY_SPACE_AT_END.search(text):
         has_inline_ancestor_sibling = get_inline_ancestor_sibling(node) is not None
-        if not has_inline_ancestor_sibling or (next_ and next_.name == "br"):
+        if not has_inline_ancestor_sibling or (
+            exists(next_) and node_name(next_) == "br"
+        ):
             text = ANY_SPACE_AT_END.sub("", text)
 
     return text
@@ -177,24 +224,18 @@ def clean_padding_text(text, node):
     """Cleans head/tail whitespaces of a single html text with multiple toplevel tags"""
 
     if is_whitespace(text):
-        has_prev = (
-            node.previousSibling
-            and is_element(node.previousSibling)
-            and not is_inline(node.previousSibling)
-        )
-        has_next = (
-            node.nextSibling
-            and is_element(node.nextSibling)
-            and not is_inline(node.nextSibling)
-        )
+        previous = previous_sibling(node)
+        next_ = next_sibling(node)
+        has_prev = exists(previous) and is_element(previous) and not is_inline(previous)
+        has_next = exists(next_) and is_element(next_) and not is_inline(next_)
 
         if has_prev and has_next:
             return ""
 
-        if node.previousSibling and not node.nextSibling:
+        if exists(previous) and not exists(next_):
             return ""
 
-        if node.nextSibling and not node.previousSibling:
+        if exists(next_) and not exists(previous):
             return ""
 
     return text
@@ -206,8 +247,11 @@ def collapse_inline_space(node):
     See
 
     https://developer.mozilla.org/en-US/docs/Web/API/Document_Object_Model/Whitespace
+
+    The deserializer uses WhitespaceCollapser, which gives the same results for all
+    the text nodes of a tree without collapsing the same text many times.
     """
-    text = node.text or ""
+    text = node_text(node) or ""
 
     # 0 (Volto). Return None if is text between block nodes
     text = clean_padding_text(text, node)
@@ -233,17 +277,478 @@ def collapse_inline_space(node):
 
 def fragments_fromstring(text):
     tree = BeautifulSoup(text, "html.parser")
+    metrics.incr("parse")
     return list(tree)
 
 
 def is_textnode(node):
-    return isinstance(node, NavigableString)
+    # lxml comments are text nodes, just like BeautifulSoup's Comment
+    if isinstance(node, lxml.etree._Element):
+        return not isinstance(node.tag, str)
+    return isinstance(node, (NavigableString, LxmlTextNode))
 
 
 def is_element(node):
+    if isinstance(node, lxml.etree._Element):
+        return isinstance(node.tag, str)
     return isinstance(node, Tag)
 
 
+class LxmlTextNode(str):
+    """The text or tail of an lxml element, seen as a standalone text node
+
+    lxml stores text in ``element.text`` and ``element.tail``. To navigate it like
+    a DOM we remember which element owns the string and in which slot it lives.
+    """
+
+    owner: lxml.etree._Element
+    is_tail: bool
+
+    def __new__(cls, value, owner, is_tail):
+        node = super().__new__(cls, value)
+        node.owner = owner
+        node.is_tail = is_tail
+        return node
+
+
+def closest(element, tags):
+    """Returns the element or its nearest ancestor with one of the given tags"""
+
+    if element.tag in tags:
+        return element
+    return next(element.iterancestors(*tags), None)
+
+
+def lxml_text_node(owner, is_tail=False):
+    """Returns the text (or the tail) of an lxml element as a LxmlTextNode"""
+
+    value = owner.tail if is_tail else owner.text
+    if not value:
+        return None
+
+    if not value.strip(ASCII_SPACES):
+        # BeautifulSoup collapses whitespace-only strings to a single character
+        parent = owner.getparent() if is_tail else owner
+        if parent is None or closest(parent, PRESERVE_WHITESPACE_TAGS) is None:
+            value = "\n" if "\n" in value else " "
+
+    return LxmlTextNode(value, owner, is_tail)
+
+
+def lxml_strings(element, wanted, kind=None):
+    """Yields the text nodes of an lxml element that belong to the ``wanted``
+    string container (None for regular text)"""
+
+    if element.tag in STRING_CONTAINERS:
+        kind = element.tag
+
+    if kind == wanted:
+        text = lxml_text_node(element)
+        if text is not None:
+            yield text
+
+    for child in element:
+        if isinstance(child.tag, str):
+            yield from lxml_strings(child, wanted, kind)
+        if kind == wanted:
+            tail = lxml_text_node(child, is_tail=True)
+            if tail is not None:
+                yield tail
+
+
+def lxml_attrs(element):
+    """Returns the attributes of an lxml element as BeautifulSoup reports them"""
+
+    attrs = dict(element.attrib)
+    for name in CDATA_LIST_ATTRIBUTES["*"] + CDATA_LIST_ATTRIBUTES.get(element.tag, ()):
+        if name in attrs:
+            attrs[name] = attrs[name].split()
+
+    return attrs
+
+
+def lxml_child_nodes(element):
+    text = lxml_text_node(element)
+    if text is not None:
+        yield text
+
+    for child in element:
+        yield child
+        tail = lxml_text_node(child, is_tail=True)
+        if tail is not None:
+            yield tail
+
+
+# The following functions navigate both BeautifulSoup and lxml trees
+
+
+def exists(node):
+    """Truth value of a node, as BeautifulSoup nodes have it"""
+
+    if node is None:
+        return False
+    if isinstance(node, lxml.etree._Element):
+        if isinstance(node.tag, str) or node.text:
+            return True
+        # empty comments are falsy, unless whitespace collapsing turned them to " "
+        parent = node.getparent()
+        return parent is None or closest(parent, PRESERVE_WHITESPACE_TAGS) is None
+    return bool(node)
+
+
+def node_name(node):
+    if isinstance(node, lxml.etree._Element):
+        return node.tag if isinstance(node.tag, str) else None
+    return getattr(node, "name", None)
+
+
+def node_attrs(node):
+    if isinstance(node, lxml.etree._Element):
+        return lxml_attrs(node)
+    return node.attrs
+
+
+def node_text(node):
+    """Returns the text of a node, like BeautifulSoup's ``.text``"""
+
+    if isinstance(node, LxmlTextNode):
+        parent = parent_node(node)
+        if parent is not None and closest(parent, STRING_CONTAINERS) is not None:
+            return ""
+        return str(node)
+
+    if isinstance(node, lxml.etree._Element):
+        if not isinstance(node.tag, str):
+            return ""
+        wanted = node.tag if node.tag in STRING_CONTAINERS else None
+        container = closest(node, STRING_CONTAINERS)
+        kind = container.tag if container is not None else None
+        return "".join(lxml_strings(node, wanted, kind))
+
+    return node.text
+
+
+def outer_html(node):
+    if isinstance(node, lxml.etree._Element):
+        return cast(str, lxml.html.tostring(node, encoding="unicode", with_tail=False))
+    return repr(node)
+
+
+def child_nodes(node):
+    if isinstance(node, lxml.etree._Element):
+        return lxml_child_nodes(node)
+    return node.children
+
+
+def parent_node(node):
+    if isinstance(node, LxmlTextNode):
+        return node.owner.getparent() if node.is_tail else node.owner
+    if isinstance(node, lxml.etree._Element):
+        return node.getparent()
+    return node.parent
+
+
+def previous_sibling(node):
+    if isinstance(node, LxmlTextNode):
+        return node.owner if node.is_tail else None
+
+    if isinstance(node, lxml.etree._Element):
+        previous = node.getprevious()
+        if previous is not None:
+            return lxml_text_node(previous, is_tail=True) or previous
+        parent = node.getparent()
+        return lxml_text_node(parent) if parent is not None else None
+
+    return node.previous_sibling
+
+
+def next_sibling(node):
+    if isinstance(node, LxmlTextNode):
+        if node.is_tail:
+            return node.owner.getnext()
+        return node.owner[0] if len(node.owner) else None
+
+    if isinstance(node, lxml.etree._Element):
+        return lxml_text_node(node, is_tail=True) or node.getnext()
+
+    return node.next_sibling
+
+
+def node_key(node):
+    # lxml text nodes are created on the fly, so they're identified by their owner
+    if isinstance(node, LxmlTextNode):
+        return (id(node.owner), node.is_tail)
+    return id(node)
+
+
+def pop_attribute(node, name):
+    """Removes an attribute of the element, returns its value or None"""
+
+    if isinstance(node, lxml.etree._Element):
+        return node.attrib.pop(name, None)
+    return node.attrs.pop(name, None)
+
+
+def extract_node(node):
+    """Removes the element from the tree, its lxml tail stays in place"""
+
+    if not isinstance(node, lxml.etree._Element):
+        return node.extract()
+
+    parent = node.getparent()
+    if node.tail:
+        previous = node.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or "") + node.tail
+        else:
+            parent.text = (parent.text or "") + node.tail
+        node.tail = None
+    parent.remove(node)
+    return node
+
+
+def soup_string(node):
+    """Returns the node as ``str()`` of the BeautifulSoup node writes it
+
+    For lxml nodes, the html is written with BeautifulSoup's "minimal" formatter,
+    so both trees give the same html.
+    """
+
+    if isinstance(node, LxmlTextNode):
+        return str(node)
+    if isinstance(node, lxml.etree._Element):
+        if not isinstance(node.tag, str):
+            # like a BeautifulSoup Comment, only the text of the comment
+            return node.text or ""
+        return "".join(lxml_soup_markup(node))
+    return str(node)
+
+
+def lxml_soup_markup(element):
+    attrs = []
+    # BeautifulSoup writes the attributes sorted by name
+    for name, value in sorted(lxml_attrs(element).items()):
+        if isinstance(value, list):
+            value = " ".join(value)
+        value = EntitySubstitution.substitute_xml(value)
+        attrs.append(f" {name}={EntitySubstitution.quoted_attribute_value(value)}")
+
+    if element.tag in VOID_ELEMENTS and not len(element) and not element.text:
+        yield f"<{element.tag}{''.join(attrs)}/>"
+        return
+
+    yield f"<{element.tag}{''.join(attrs)}>"
+    for child in lxml_child_nodes(element):
+        if isinstance(child, LxmlTextNode):
+            if element.tag in CDATA_CONTAINING_TAGS:
+                yield str(child)
+            else:
+                yield EntitySubstitution.substitute_xml(child)
+        elif isinstance(child.tag, str):
+            yield from lxml_soup_markup(child)
+        else:
+            yield f"<!--{child.text or ''}-->"
+    yield f"</{element.tag}>"
+
+
+def voltoblock_data(node):
+    """The block data of a <voltoblock> tag"""
+
+    data = node_attrs(node)["data-voltoblock"]
+    if not isinstance(data, str):
+        # the block data is kept unserialized by html2blocks.block_tag
+        return data
+
+    blocks = lxml_voltoblocks.get()
+    if blocks is not None and data in blocks:
+        return blocks[data]
+    return json.loads(data)
+
+
+def compact_whitespace(text):
+    """Shortens a run of whitespace, without changing how the rules collapse it"""
+
+    if "\n" in text:
+        return "\n"
+    return MULTIPLE_SPACE.sub(" ", convert_tabs_to_spaces(text))
+
+
+def compact_text(text):
+    """Shortens a text to what the whitespace rules see of an element's text
+
+    The rules only look at the whitespace at the edges of the text, so we keep that
+    and the first and last non whitespace characters.
+    """
+
+    stripped = text.strip()
+    if not stripped:
+        return compact_whitespace(text)
+
+    start = len(text) - len(text.lstrip())
+    end = len(text.rstrip())
+    return (
+        compact_whitespace(text[:start])
+        + stripped[0]
+        + stripped[-1:] * (len(stripped) > 1)
+        + compact_whitespace(text[end:])
+    )
+
+
+class WhitespaceCollapser(object):
+    """Collapses the inline whitespace of all the text nodes of a block
+
+    It applies the same rules as collapse_inline_space, which, for every text node,
+    looks back at the previous siblings (and the previous siblings of the parents)
+    to find out if the previous text ended with a space, collapsing them again. With
+    deeply nested inline markup the same text gets normalized over and over.
+
+    Here the text nodes are collapsed in document order, as the deserializer visits
+    them, and the results are recorded. When a rule needs to know if the previous
+    node ended with a space, it's already known (or computed once) and elements are
+    only collapsed on a compact version of their text, so the cost stays linear.
+    """
+
+    def __init__(self):
+        # values keep the nodes alive, so their ids are not reused
+        self.collapsed = {}
+        self.compacted = {}
+        self.texts = {}
+        self.summaries = {}
+        self.next_nodes = {}
+
+    def collapse(self, node, compact=False):
+        """Returns the collapsed text of a node
+
+        With compact, only the edges of an element's text are right, which is all
+        that's needed to check if it ends with a space.
+        """
+
+        if is_textnode(node):
+            compact = False
+
+        cache = self.compacted if compact else self.collapsed
+        key = node_key(node)
+        if key in cache:
+            return cache[key][1]
+
+        text = (self.summary(node) if compact else self.text(node)) or ""
+        text = clean_padding_text(text, node)
+        text = remove_space_before_after_endline(text)
+        text = convert_tabs_to_spaces(text)
+        text = convert_linebreaks_to_spaces(text)
+        text = self.remove_space_follow_space(text, node, compact)
+        text = self.remove_element_edges(text, node)
+
+        cache[key] = (node, text)
+        return text
+
+    def ends_with_space(self, node):
+        return self.collapse(node, compact=True).endswith(" ")
+
+    def text(self, node):
+        """The text of a node, same as node_text, built from the children's text"""
+
+        if is_textnode(node):
+            return node_text(node)
+
+        key = node_key(node)
+        if key not in self.texts:
+            self.texts[key] = (node, self.join_children(node, self.text))
+        return self.texts[key][1]
+
+    def summary(self, node):
+        """The compact_text of a node, built from the children's summaries"""
+
+        if is_textnode(node):
+            return node_text(node)
+
+        key = node_key(node)
+        if key not in self.summaries:
+            text = compact_text(self.join_children(node, self.summary))
+            self.summaries[key] = (node, text)
+        return self.summaries[key][1]
+
+    def join_children(self, node, get_text):
+        if node_name(node) in STRING_CONTAINERS:
+            return node_text(node)
+
+        # the strings of a string container are never part of the text
+        return "".join(
+            get_text(child)
+            for child in child_nodes(node)
+            if not (is_element(child) and node_name(child) in STRING_CONTAINERS)
+        )
+
+    def remove_space_follow_space(self, text, node, compact=False):
+        """See remove_space_follow_space"""
+
+        text = MULTIPLE_SPACE.sub(" ", text)
+
+        if not text.startswith(" "):
+            return text
+
+        previous = previous_sibling(node)
+        if exists(previous):
+            if is_textnode(previous):
+                if node_text(previous).endswith(" "):
+                    return FIRST_SPACE.sub("", text)
+            elif is_inline(previous):
+                if self.ends_with_space(previous):
+                    return FIRST_SPACE.sub("", text)
+        else:
+            parent = parent_node(node)
+            parent_previous = previous_sibling(parent)
+            if exists(parent_previous):
+                if self.ends_with_space(parent_previous):
+                    return FIRST_SPACE.sub("", text)
+            else:
+                grandparent = parent_node(parent)
+                if exists(grandparent) and is_inline(grandparent):
+                    return self.collapse(grandparent, compact)
+                return FIRST_SPACE.sub("", text)
+
+        return text
+
+    def next_node(self, node):
+        """The next sibling of the node or of its closest inline ancestor that has
+        one. This is the loop of get_inline_ancestor_sibling"""
+
+        next_ = next_sibling(node)
+        if next_ is not None:
+            return next_
+
+        key = node_key(node)
+        if key in self.next_nodes:
+            return self.next_nodes[key][1]
+
+        parent = parent_node(node)
+        if parent is not None and is_inline(parent):
+            next_ = self.next_node(parent)
+
+        self.next_nodes[key] = (node, next_)
+        return next_
+
+    def remove_element_edges(self, text, node):
+        """See remove_element_edges"""
+
+        previous = previous_sibling(node)
+        next_ = next_sibling(node)
+        parent = parent_node(node)
+
+        if (not is_inline(parent)) and (previous is None) and FIRST_ANY_SPACE.search(text):
+            text = FIRST_ALL_SPACE.sub("", text)
+
+        if ANY_SPACE_AT_END.search(text):
+            sibling = self.next_node(node)
+            has_inline_ancestor_sibling = sibling is not None and is_inline(sibling)
+            if not has_inline_ancestor_sibling or (
+                exists(next_) and node_name(next_) == "br"
+            ):
+                text = ANY_SPACE_AT_END.sub("", text)
+
+        return text
+
+
 def style_to_object(text):
     out = {}
 
@@ -288,7 +793,12 @@ class HTML2Slate(object):
     See https://github.com/plone/volto/blob/5f9066a70b9f3b60d462fc96a1aa7027ff9bbac0/packages/volto-slate/src/editor/deserialize.js
     """
 
+    def __init__(self):
+        self.whitespace = WhitespaceCollapser()
+
     def from_elements(self, elements):
+        # the whitespace state only applies to the tree being deserialized
+        self.whitespace = WhitespaceCollapser()
         nodes = []
         for f in elements:
             slate_nodes = self.deserialize(f)
@@ -310,17 +820,18 @@ class HTML2Slate(object):
             return []
 
         if is_textnode(node):
-            text = collapse_inline_space(node)
+            text = self.whitespace.collapse(node)
             return [{"text": text}] if text else None
         elif not is_element(node):
             return None
 
-        tagname = node.name
+        tagname = node_name(node)
+        attrs = node_attrs(node)
         handler = None
 
-        if "data-slate-data" in node.attrs:
+        if "data-slate-data" in attrs:
             handler = self.handle_slate_data_element
-        elif "data-slate-node" in node.attrs:
+        elif "data-slate-node" in attrs:
             handler = self.handle_slate_node_element
         else:
             handler = getattr(self, "handle_tag_{}".format(tagname), None)
@@ -339,7 +850,7 @@ class HTML2Slate(object):
     def deserialize_children(self, node):
         res = []
 
-        for child in node.children:
+        for child in child_nodes(node):
             b = self.deserialize(child)
             if isinstance(b, list):
                 res += b
@@ -349,7 +860,7 @@ class HTML2Slate(object):
         return res
 
     def handle_tag_a(self, node):
-        link = node["href"] if "href" in node.attrs else None
+        link = node_attrs(node).get("href", None)
 
         element = {
             "type": "link",
@@ -364,15 +875,15 @@ class HTML2Slate(object):
         return self.handle_tag_ul(node, node_type="ol")
 
     def handle_tag_span(self, node):
-        rawdata = node.attrs.get("data-slate-node", None)
+        rawdata = node_attrs(node).get("data-slate-node", None)
 
-        if not rawdata and list(node.children):
+        if not rawdata and list(child_nodes(node)):
             return self.deserialize_children(node)
 
         data = {}
         if rawdata:
             data = json.loads(rawdata)
-        data["text"] = node.text
+        data["text"] = node_text(node)
         return data
 
     def handle_tag_ul(self, node, node_type="ul"):
@@ -385,9 +896,10 @@ class HTML2Slate(object):
         return {"type": node_type, "children": children}
 
     def handle_tag_img(self, node):
-        url = node.attrs.get("src", "")
+        attrs = node_attrs(node)
+        url = attrs.get("src", "")
 
-        str_node = repr(node)
+        str_node = outer_html(node)
 
         align = ""
         if "float: left" in str_node:
@@ -409,8 +921,8 @@ class HTML2Slate(object):
             "type": "img",
             "align": align,
             "url": url,
-            "title": node.attrs.get("title", ""),
-            "alt": node.attrs.get("alt", ""),
+            "title": attrs.get("title", ""),
+            "alt": attrs.get("alt", ""),
             "children": [{"text": ""}],
             "scale": scale,
         }
@@ -420,7 +932,7 @@ class HTML2Slate(object):
     def handle_tag_voltoblock(self, node):
         element = {
             "type": "voltoblock",
-            "data": json.loads(node.attrs["data-voltoblock"]),
+            "data": voltoblock_data(node),
         }
         return element
 
@@ -432,12 +944,13 @@ class HTML2Slate(object):
         return self.handle_block(node)
 
     def handle_tag_div(self, node):
-        if getattr(node, "name", "") == "[document]":
+        attrs = node_attrs(node)
+        if node_name(node) == "[document]":
             # treat divs directly in the input as paragraph nodes. Fixes
             # en/observatory/policy-context/european-policy-framework/who/
             return self.handle_tag_p(node)
-        elif node.attrs.get("data-slate-node"):
-            rawdata = node.attrs["data-slate-node"]
+        elif attrs.get("data-slate-node"):
+            rawdata = attrs["data-slate-node"]
             slate_node = json.loads(rawdata)
             slate_node["children"] = self.deserialize_children(node)
             return slate_node
@@ -446,7 +959,7 @@ class HTML2Slate(object):
 
     def handle_tag_p(self, node):
         # TO DO: implement <b> special cases
-        style = node.get("style", "")
+        style = node_attrs(node).get("style", "")
         styles = style_to_object(style)
         if styles.get("text-align") == "center":
             return {
@@ -457,21 +970,21 @@ class HTML2Slate(object):
         return self.handle_block(node)
 
     def handle_block(self, node):
-        value = {"type": node.name, "children": self.deserialize_children(node)}
-        for k, v in node.attrs.items():
+        value = {"type": node_name(node), "children": self.deserialize_children(node)}
+        for k, v in node_attrs(node).items():
             k = fix_node_attributes(k)
             value[k] = v
         return value
 
     def handle_slate_data_element(self, node):
-        data = node["data-slate-data"]
+        data = node_attrs(node)["data-slate-data"]
         element = json.loads(data)
         element["children"] = self.deserialize_children(node)
         return element
 
     def handle_slate_node_element(self, node):
         # __import__("pdb").set_trace()
-        data = node["data-slate-node"]
+        data = node_attrs(node)["data-slate-node"]
         element = json.loads(data)
         element["children"] = self.deserialize_children(node)
         return element
@@ -507,6 +1020,69 @@ class HTML2Slate(object):
         return value
 
 
+class LxmlHTML2Slate(HTML2Slate):
+    """A HTML2Slate that walks the lxml tree directly
+
+    The default text_to_slate pipeline cleans up the html with lxml, serializes it
+    and parses it again with BeautifulSoup. Here we deserialize the lxml tree, with
+    the same results. The only known difference: lxml writes an empty <li> without
+    its end tag, so the serialized html nests the following siblings inside it.
+    """
+
+    def to_slate(self, text):
+        body = body_fromstring(text)
+        return self.from_elements(child_nodes(body))
+
+
+def body_fromstring(text):
+    """Parses (and cleans up) html with lxml, returns the body as a root element"""
+
+    e = lxml.html.document_fromstring(text)
+    metrics.incr("parse")
+    return detach_body(e)
+
+
+class HTMLFeed:
+    """Parses html with lxml's feed parser, as its chunks arrive
+
+    The chunks are bytes in the given encoding. The text is kept too, for the
+    checks the converters do on the raw html.
+    """
+
+    def __init__(self, encoding="utf-8"):
+        # libxml2 doesn't know all the aliases, such as latin-1
+        encoding = codecs.lookup(encoding).name
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self.parser = lxml.html.HTMLParser(encoding=encoding)
+        self.text = []
+
+    def feed(self, chunk):
+        self.text.append(self.decoder.decode(chunk))
+        self.parser.feed(chunk)
+
+    def close(self):
+        """Returns the text and the lxml document, None for an empty one"""
+
+        self.text.append(self.decoder.decode(b"", final=True))
+        try:
+            document = self.parser.close()
+        except lxml.etree.XMLSyntaxError:  # nothing was fed
+            document = None
+        metrics.incr("parse")
+        return "".join(self.text), document
+
+
+def detach_body(document):
+    """Returns the body of an lxml document, as a root element"""
+
+    body = document.find("body")
+    document.remove(body)
+
+    # only the body children are deserialized, like in text_to_slate
+    body.text = body.tail = None
+    return body
+
+
 def tostr(s):
     if isinstance(s, str):
         return s
@@ -514,11 +1090,23 @@ def tostr(s):
         return s.decode("utf-8")
 
 
-def text_to_slate(text: str):
+def text_to_slate(text: str, backend=None):
+    """Convert html text to a slate value
+
+    The backend (bs4 or lxml) defaults to the HTML2SLATE_BACKEND setting
+    """
+    backend = backend or HTML2SLATE_BACKEND
+    if backend == "lxml":
+        return LxmlHTML2Slate().to_slate(text)
+    elif backend != "bs4":
+        raise ValueError(f"Unknown html2slate backend: {backend}")
+
     # first we cleanup the broken html
     e = lxml.html.document_fromstring(text)
+    metrics.incr("parse")
     children = e.find("body").getchildren()
     text = "".join(tostr(lxml.html.tostring(child)) for child in children)
+    metrics.incr("serialize")
     return HTML2Slate().to_slate(text)
 
 
@@ -1,29 +1,102 @@
 # import json
+import asyncio
 import logging
+from collections import Counter
 from dataclasses import dataclass
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
-from litestar import Litestar, get, post  # Request,
-from litestar.status_codes import HTTP_200_OK
+from litestar import Litestar, Request, get, post
+from litestar.background_tasks import BackgroundTask
+from litestar.exceptions import HTTPException, ValidationException
+from litestar.response import Stream
+from litestar.serialization import encode_json
+from litestar.status_codes import HTTP_200_OK, HTTP_415_UNSUPPORTED_MEDIA_TYPE
 
-from .blocks2html import convert_blocks_to_html
-from .html2blocks import text_to_blocks
-from .html2content import convert_html_to_content
-from .html2slate import text_to_slate
+from . import metrics
+from .blocks2html import convert_blocks_document, stream_blocks_document
+from .cache import ResultCache, SQLiteResultCache, cache_key
+from .changes import convert_changed_blocks_to_html, convert_changes_to_content
+from .config import (
+    CONVERSION_MODE,
+    CONVERSION_QUEUE_SIZE,
+    CONVERSION_WORKERS,
+    RESULT_CACHE_PATH,
+    RESULT_CACHE_SIZE,
+    RESULT_CACHE_TTL,
+)
+from .executor import ConversionExecutor
+from .html2blocks import document_to_blocks, text_to_blocks
+from .html2content import (
+    convert_document_to_content,
+    convert_html_to_records,
+    document_to_content,
+)
+from .html2slate import HTMLFeed, text_to_slate
+from .segments import convert_segments_to_content, untranslated_segments
 from .tests import run
 
 logger = logging.getLogger()
 
+executor = ConversionExecutor(
+    CONVERSION_MODE, CONVERSION_WORKERS, CONVERSION_QUEUE_SIZE)
+
+# the conversions in progress, by request hash
+in_flight = {}
+flight_stats = Counter()
+
+result_cache = None
+if RESULT_CACHE_SIZE and RESULT_CACHE_PATH:
+    result_cache = SQLiteResultCache(
+        RESULT_CACHE_PATH, RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+elif RESULT_CACHE_SIZE:
+    result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
 
 @dataclass
 class HtmlData:
     html: str
+    # the metadata sidecar of blocks2html, for html2content
+    metadata: Optional[Dict] = None
 
 
 @dataclass
 class Blocks:
     blocks: Any
     blocks_layout: Any
+    # send the metadata of the blocks next to the html, instead of inside it
+    sidecar: bool = False
+    # also send the translatable segments of the blocks
+    segments: bool = False
+    # the target language, for the translation memory of the segments
+    language: Optional[str] = None
+
+
+@dataclass
+class BlocksChanges:
+    blocks: Any
+    blocks_layout: Any
+    # the blocks and layout of the previous translation source
+    previous: Dict
+
+
+@dataclass
+class ContentChanges:
+    # the translated html of /blocks2html/changes
+    html: str
+    blocks: Any
+    blocks_layout: Any
+    previous: Dict
+    # the previous translation, as given by html2content
+    translation: Dict
+
+
+@dataclass
+class Segments:
+    blocks: Any
+    blocks_layout: Any
+    # the translated segments, as sent by blocks2html
+    segments: List[Dict]
+    language: Optional[str] = None
 
 
 @dataclass
@@ -31,6 +104,194 @@ class Response:
     data: Any
 
 
+@dataclass
+class HtmlBatch:
+    documents: List[HtmlData]
+
+
+@dataclass
+class BlocksBatch:
+    documents: List[Blocks]
+
+
+def batch_results(results, key=None):
+    """The response of each document of a batch, like the single document
+    endpoints, or its error. Without a key the results are the responses.
+    """
+
+    response = []
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Batch conversion failed: %r", result)
+            response.append({"error": f"{type(result).__name__}: {result}"})
+        else:
+            response.append({key: result} if key else result)
+    return response
+
+
+async def single_flight(key, func, *args):
+    """Awaits func(*args), or the call with the same key that is in flight
+
+    The identical requests that arrive during a conversion share its result
+    (or its error) and are counted as coalesced.
+    """
+
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(func(*args))
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    else:
+        flight_stats["coalesced"] += 1
+        metrics.incr("coalesced")
+
+    # a cancelled request doesn't cancel the conversion of the others
+    return await asyncio.shield(task)
+
+
+async def cache_call(cache, func, *args):
+    """Runs func(*args), that calls the cache, in a thread if the cache waits
+    for a database"""
+
+    if cache.blocking:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+async def convert_and_cache(key, func, document):
+    result = await executor.run(func, document)
+    cache = result_cache
+    if cache is not None:
+        await cache_call(cache, cache.set, key, result)
+    return result
+
+
+async def coalesced_run(name, func, document):
+    """Runs the conversion once for the identical concurrent requests"""
+
+    key = cache_key(name, document)
+    return await single_flight(key, executor.run, func, document)
+
+
+async def cached_run(name, func, document):
+    """Runs the conversion, unless its result is in the results cache"""
+
+    key = cache_key(name, document)
+    cache = result_cache
+    result = None
+    if cache is not None:
+        result = await cache_call(cache, cache.get, key)
+    if result is None:
+        result = await single_flight(key, convert_and_cache, key, func, document)
+    return result
+
+
+async def cached_run_batch(name, func, documents):
+    """Runs the conversions of a batch that are not in the results cache"""
+
+    cache = result_cache
+    if cache is None:
+        return await executor.run_batch(func, documents)
+
+    keys = [cache_key(name, doc) for doc in documents]
+    results = await cache_call(cache, lambda: [cache.get(key) for key in keys])
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        converted = await executor.run_batch(
+            func, [documents[i] for i in missing])
+        for i, result in zip(missing, converted):
+            results[i] = result
+        new = [(keys[i], results[i]) for i in missing
+               if not isinstance(results[i], Exception)]
+        await cache_call(cache, lambda: [cache.set(*pair) for pair in new])
+    return results
+
+
+async def without_remembered_segments(documents, responses):
+    """Leaves out the segments already in the translation memory, from the
+    blocks2html responses. The memory changes, so it is looked up after the
+    results cache."""
+
+    for i, (document, response) in enumerate(zip(documents, responses)):
+        if document.segments and document.language and isinstance(response, dict):
+            segments = await executor.run(
+                untranslated_segments, response["segments"], document.language)
+            responses[i] = dict(response, segments=segments)
+    return responses
+
+
+async def ndjson_lines(records):
+    """Encodes the records as newline delimited json, one line at a time
+
+    The status is sent with the first line: a conversion that fails later ends
+    the stream with an error record, like the errors of the batches.
+    """
+
+    try:
+        async for record in records:
+            yield encode_json(record) + b"\n"
+    except Exception as exc:
+        logger.warning("Stream conversion failed: %r", exc)
+        yield encode_json({"error": f"{type(exc).__name__}: {exc}"}) + b"\n"
+
+
+async def html_chunks(chunks):
+    """Encodes the html chunks of a stream
+
+    A conversion that fails after the first chunk ends the document with an
+    html comment with the error, instead of the tail of the document.
+    """
+
+    try:
+        async for chunk in chunks:
+            yield chunk.encode("utf-8")
+    except Exception as exc:
+        logger.warning("Stream conversion failed: %r", exc)
+        error = f"{type(exc).__name__}: {exc}".replace("--", "- -")
+        yield f"\n<!-- conversion failed: {error} -->".encode("utf-8")
+
+
+async def parse_request_html(request):
+    """Parses the text/html body of the request while it is uploaded
+
+    Each chunk is fed to lxml's feed parser as it arrives, off the event loop.
+    The parser can't move between threads, it lives on a thread of its own.
+    Returns the text and the lxml document.
+    """
+
+    media_type, options = request.content_type
+    if media_type != "text/html":
+        raise HTTPException(
+            status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="The body must be text/html",
+        )
+
+    with executor.single_thread() as thread:
+        try:
+            feed = await executor.run_in(
+                thread, HTMLFeed, options.get("charset", "utf-8"))
+        except LookupError as exc:
+            raise ValidationException(detail=str(exc)) from exc
+
+        async for chunk in request.stream():
+            if chunk:
+                await executor.run_in(thread, feed.feed, chunk)
+        return await executor.run_in(thread, feed.close)
+
+
+async def start_counters(request: Request) -> None:
+    metrics.start()
+
+
+async def report_counters(response):
+    counters = metrics.current()
+    if counters:
+        summary = ",".join(f"{k}={v}" for k, v in sorted(counters.items()))
+        logger.debug("Conversion counters: %s", summary)
+        response.headers["X-Conversion-Counters"] = summary
+    return response
+
+
 @get(path="/healthcheck")
 async def health_check() -> str:
     return "healthy"
@@ -42,45 +303,182 @@ async def run_tests() -> str:
     return "healthy"
 
 
+@get(path="/stats")
+async def stats() -> Dict:
+    return {
+        "coalesced": flight_stats["coalesced"],
+        "cache": dict(result_cache.stats) if result_cache is not None else None,
+    }
+
+
 @post(path="/html")
 async def html(data: HtmlData) -> Dict:
     html = data.html
-    return {"data": text_to_slate(html)}
+    return {"data": await coalesced_run("html", text_to_slate, html)}
 
 
 @post(path="/toblocks", status_code=HTTP_200_OK)
 async def toblocks(data: HtmlData) -> Dict:
     html: str = data.html
-    data = text_to_blocks(html)
+    data = await coalesced_run("toblocks", text_to_blocks, html)
 
     # logger.info("Blocks: \n%s", json.dumps(data, indent=2))
     return {"data": data}
 
 
+@post(path="/toblocks/html", status_code=HTTP_200_OK)
+async def toblocks_html(request: Request) -> Dict:
+    """/toblocks for a raw text/html body, parsed as it is uploaded"""
+
+    text, document = await parse_request_html(request)
+    return {"data": await executor.run_local(document_to_blocks, text, document)}
+
+
 @post(path="/blocks2html", status_code=HTTP_200_OK)
 async def handle_block2html(data: Blocks) -> Dict:
-    html = convert_blocks_to_html(data)
+    response = await cached_run("blocks2html", convert_blocks_document, data)
+    [response] = await without_remembered_segments([data], [response])
+
+    # logger.info("HTML: \n%s", response["html"])
+    return response
+
+
+@post(path="/blocks2html/stream", status_code=HTTP_200_OK)
+async def handle_block2html_stream(data: Blocks) -> Stream:
+    """blocks2html as an html document, each block is sent once serialized
+
+    The document can be sent as is to html2content. The sidecar and the
+    segments need the whole page, they're not available here.
+    """
+
+    if data.sidecar or data.segments:
+        raise ValidationException(
+            detail="The stream has the html only, without sidecar or segments")
 
-    # logger.info("HTML: \n%s", html)
-    return {"html": html}
+    try:
+        chunks = await executor.stream(stream_blocks_document, data)
+    except ValueError as exc:
+        raise ValidationException(detail=str(exc)) from exc
+    return Stream(
+        html_chunks(chunks),
+        media_type="text/html",
+        background=BackgroundTask(chunks.aclose),
+    )
 
 
 @post(path="/html2content", status_code=HTTP_200_OK)
 async def handle_html2content(data: HtmlData) -> Dict:
-    html = data.html
-    data = convert_html_to_content(html)
+    document = (data.html, data.metadata)
+    data = await cached_run("html2content", convert_document_to_content, document)
 
     # logger.info("Data: \n%s", json.dumps(data, indent=2))
     return {"data": data}
 
 
+@post(path="/html2content/stream", status_code=HTTP_200_OK)
+async def handle_html2content_stream(data: HtmlData) -> Stream:
+    """html2content as NDJSON, each top level block is sent once converted
+
+    The lines are the records of html2content.content_records.
+    """
+
+    records = await executor.stream(convert_html_to_records, data.html, data.metadata)
+    return Stream(
+        ndjson_lines(records),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(records.aclose),
+    )
+
+
+@post(path="/html2content/html", status_code=HTTP_200_OK)
+async def handle_html2content_html(request: Request) -> Dict:
+    """/html2content for a raw text/html body, parsed as it is uploaded
+
+    The html is read with lxml, whatever the HTML2CONTENT_BACKEND. There's no
+    metadata sidecar, the html has to keep the block metadata.
+    """
+
+    text, document = await parse_request_html(request)
+    data = await executor.run_local(document_to_content, text, document)
+    return {"data": data}
+
+
+@post(path="/blocks2html/changes", status_code=HTTP_200_OK)
+async def handle_block2html_changes(data: BlocksChanges) -> Dict:
+    return await executor.run(convert_changed_blocks_to_html, data)
+
+
+@post(path="/html2content/changes", status_code=HTTP_200_OK)
+async def handle_html2content_changes(data: ContentChanges) -> Dict:
+    try:
+        return {"data": await executor.run(convert_changes_to_content, data)}
+    except ValueError as exc:
+        raise ValidationException(detail=str(exc)) from exc
+
+
+@post(path="/segments2content", status_code=HTTP_200_OK)
+async def handle_segments2content(data: Segments) -> Dict:
+    try:
+        data = await executor.run(convert_segments_to_content, data)
+    except ValueError as exc:
+        raise ValidationException(detail=str(exc)) from exc
+
+    return {"data": data}
+
+
+@post(path="/html/batch", status_code=HTTP_200_OK)
+async def html_batch(data: HtmlBatch) -> Dict:
+    documents = [doc.html for doc in data.documents]
+    results = await executor.run_batch(text_to_slate, documents)
+    return {"results": batch_results(results, "data")}
+
+
+@post(path="/toblocks/batch", status_code=HTTP_200_OK)
+async def toblocks_batch(data: HtmlBatch) -> Dict:
+    documents = [doc.html for doc in data.documents]
+    results = await executor.run_batch(text_to_blocks, documents)
+    return {"results": batch_results(results, "data")}
+
+
+@post(path="/blocks2html/batch", status_code=HTTP_200_OK)
+async def handle_block2html_batch(data: BlocksBatch) -> Dict:
+    results = await cached_run_batch(
+        "blocks2html", convert_blocks_document, data.documents)
+    results = await without_remembered_segments(data.documents, results)
+    return {"results": batch_results(results)}
+
+
+@post(path="/html2content/batch", status_code=HTTP_200_OK)
+async def handle_html2content_batch(data: HtmlBatch) -> Dict:
+    documents = [(doc.html, doc.metadata) for doc in data.documents]
+    results = await cached_run_batch(
+        "html2content", convert_document_to_content, documents)
+    return {"results": batch_results(results, "data")}
+
+
 app = Litestar(
     route_handlers=[
         health_check,
+        stats,
         html,
         toblocks,
+        toblocks_html,
         handle_block2html,
+        handle_block2html_stream,
         handle_html2content,
+        handle_html2content_stream,
+        handle_html2content_html,
+        handle_block2html_changes,
+        handle_html2content_changes,
+        handle_segments2content,
+        html_batch,
+        toblocks_batch,
+        handle_block2html_batch,
+        handle_html2content_batch,
     ],
+    on_startup=[executor.start],
+    on_shutdown=[executor.stop],
+    before_request=start_counters,
+    after_request=report_counters,
     debug=True,
 )
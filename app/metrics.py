@@ -0,0 +1,38 @@
+"""Per request counters of the expensive operations done by the converters, such
+as parsing html to a tree ("parse") or writing a tree back to html ("serialize")
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+_counters: ContextVar[Optional[Counter]] = ContextVar("counters", default=None)
+
+
+def incr(name, value=1):
+    counters = _counters.get()
+    if counters is not None:
+        counters[name] += value
+
+
+def start():
+    """Starts counting for the current context (request) and returns the counters"""
+
+    counters = Counter()
+    _counters.set(counters)
+    return counters
+
+
+def current():
+    return _counters.get()
+
+
+@contextmanager
+def collect():
+    counters = Counter()
+    token = _counters.set(counters)
+    try:
+        yield counters
+    finally:
+        _counters.reset(token)
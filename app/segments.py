@@ -0,0 +1,345 @@
+"""Translatable segments of Volto blocks, as an alternative to blocks2html
+
+Each segment is the text of a block field, or of a slate paragraph, with its
+inline markup replaced by numbered XLIFF style placeholders:
+
+    {"key": "<block id>:value:0", "text": 'Some <g id="1">bold</g> text'}
+
+The key is made of the block id (the ids of the parent blocks too, for nested
+blocks), the field path and the slate path. The translated segments are merged
+back in the blocks json, without going through html.
+"""
+
+import re
+from copy import deepcopy
+from html import escape, unescape
+
+from . import metrics
+from .blocks2html import (
+    CALLTOACTION_FIELDS,
+    GENERIC_FIELDS,
+    HERO_FIELDS,
+    TEASER_FIELDS,
+    iterate_blocks,
+)
+from .cache import TranslationMemory
+from .config import TRANSLATION_MEMORY_PATH
+from .html2blocks import extract_text
+
+# the text fields of the blocks, the slate fields are handled by the walkers
+TEXT_FIELDS = dict(
+    GENERIC_FIELDS, title=["subtitle"], teaser=TEASER_FIELDS, hero=HERO_FIELDS
+)
+SLATE_FIELDS = {"slate": "value", "quote": "value", "item": "description"}
+
+translation_memory = (
+    TranslationMemory(TRANSLATION_MEMORY_PATH) if TRANSLATION_MEMORY_PATH else None
+)
+
+TOKENS = re.compile(r'<g id="(\d+)">|</g>|<x id="(\d+)"/>|[^<]+|<')
+
+
+def is_leaf(node):
+    return isinstance(node, dict) and "text" in node
+
+
+def text_target(key, container, name):
+    if isinstance(container.get(name), str):
+        yield (key, container, name, "text")
+
+
+def slate_targets(key, container, name, path=()):
+    """The lists of slate nodes that hold text, the paragraphs
+
+    A list with a text node is a single segment, with its inline elements.
+    """
+
+    nodes = container.get(name)
+    if not isinstance(nodes, list):
+        return
+
+    if any(is_leaf(node) for node in nodes):
+        yield (f"{key}:{'.'.join(map(str, path))}", container, name, "slate")
+        return
+
+    for i, node in enumerate(nodes):
+        if isinstance(node, dict):
+            yield from slate_targets(key, node, "children", path + (i,))
+
+
+def blocks_targets(data, path=""):
+    for uid, block in iterate_blocks(data):
+        yield from block_targets(block, f"{path}{uid}")
+
+
+def columns_targets(block, path, titles=False):
+    data = block.get("data", {})
+    for coluid, column in iterate_blocks(data):
+        if titles:
+            for target in text_target(f"{path}/{coluid}:title", column, "title"):
+                yield target + (block,)
+        yield from blocks_targets(column, f"{path}/{coluid}/")
+
+
+def field_targets(block, path):
+    """The (key, container, name, kind) of the translatable fields of a block
+
+    The kind is "text" for strings and "slate" for lists of slate nodes.
+    """
+
+    _type = block.get("@type")
+
+    for name in TEXT_FIELDS.get(_type, []):
+        yield from text_target(f"{path}:{name}", block, name)
+
+    if _type in SLATE_FIELDS:
+        name = SLATE_FIELDS[_type]
+        yield from slate_targets(f"{path}:{name}", block, name)
+
+    elif _type == "slateTable":
+        for i, row in enumerate(block.get("table", {}).get("rows", [])):
+            for j, cell in enumerate(row["cells"]):
+                key = f"{path}:table.rows.{i}.cells.{j}.value"
+                yield from slate_targets(key, cell, "value")
+
+    elif _type == "statistic_block":
+        for i, item in enumerate(block.get("items", [])):
+            for name in ("label", "value"):
+                yield from slate_targets(f"{path}:items.{i}.{name}", item, name)
+
+    elif _type == "title":
+        for i, bit in enumerate(block.get("info", [])):
+            key = f"{path}:info.{i}.description"
+            yield from text_target(key, bit, "description")
+
+    elif _type == "teaser":
+        call = (block.get("itemModel") or {}).get("callToAction") or {}
+        for name in CALLTOACTION_FIELDS:
+            key = f"{path}:itemModel.callToAction.{name}"
+            yield from text_target(key, call, name)
+
+
+def block_targets(block, path):
+    """The translatable fields of the block and of the blocks inside it, as
+    (key, container, name, kind, block)
+    """
+
+    for target in field_targets(block, path):
+        yield target + (block,)
+
+    _type = block.get("@type")
+    if _type == "teaserGrid":
+        for i, teaser in enumerate(block.get("columns", [])):
+            yield from block_targets(teaser, f"{path}/columns.{i}")
+
+    elif _type == "columnsBlock":
+        yield from columns_targets(block, path)
+
+    elif _type in ("tabs_block", "accordion"):
+        yield from columns_targets(block, path, titles=True)
+
+    elif _type == "group":
+        yield from blocks_targets(block["data"], f"{path}/")
+
+    elif _type == "hero" and block.get("data"):
+        yield from blocks_targets(block["data"], f"{path}/")
+
+    elif _type == "gridBlock" and "blocks" in block:
+        yield from blocks_targets(block, f"{path}/")
+
+
+def nodes_to_segment(nodes, placeholders):
+    """The text of the slate nodes, with placeholders for their markup"""
+
+    bits = []
+    for node in nodes:
+        if not isinstance(node, dict):
+            continue
+        if is_leaf(node) and len(node) == 1:
+            bits.append(escape(node["text"], quote=False))
+            continue
+
+        placeholders.append(node)
+        i = len(placeholders)
+        if is_leaf(node):
+            bits.append(f'<g id="{i}">{escape(node["text"], quote=False)}</g>')
+        elif "children" in node:
+            inner = nodes_to_segment(node["children"], placeholders)
+            bits.append(f'<g id="{i}">{inner}</g>')
+        else:
+            bits.append(f'<x id="{i}"/>')
+
+    return "".join(bits)
+
+
+def segment_to_nodes(text, placeholders):
+    """The slate nodes of a translated segment, with the original markup"""
+
+    stack = [(None, [])]
+    for match in TOKENS.finditer(text):
+        token = match.group(0)
+        g_id, x_id = match.group(1), match.group(2)
+        if g_id or x_id:
+            index = int(g_id or x_id) - 1
+            if not 0 <= index < len(placeholders):
+                raise ValueError(f"Unknown placeholder in segment: {token}")
+            node = placeholders[index]
+            if g_id:
+                stack.append((node, []))
+            else:
+                stack[-1][1].append(node)
+        elif token == "</g>":
+            if len(stack) == 1:
+                raise ValueError(f"Unbalanced placeholder in segment: {text}")
+            node, children = stack.pop()
+            stack[-1][1].extend(rebuild_node(node, children))
+        else:
+            stack[-1][1].append({"text": unescape(token)})
+
+    if len(stack) != 1:
+        raise ValueError(f"Unbalanced placeholder in segment: {text}")
+    return with_text_around(stack[0][1])
+
+
+def with_text_around(children):
+    """Adds the empty text nodes slate keeps around its inline elements"""
+
+    nodes = []
+    for child in children:
+        if not is_leaf(child) and (not nodes or not is_leaf(nodes[-1])):
+            nodes.append({"text": ""})
+        nodes.append(child)
+    if not nodes or not is_leaf(nodes[-1]):
+        nodes.append({"text": ""})
+    return nodes
+
+
+def rebuild_node(node, children):
+    """The original node, with the translated children
+
+    A text node with marks (bold, italic) gives its marks to the text inside.
+    """
+
+    if is_leaf(node):
+        marks = {k: v for k, v in node.items() if k != "text"}
+        children = children or [{"text": ""}]
+        return [dict(marks, **child) if is_leaf(child) else child for child in children]
+
+    node = {k: v for k, v in node.items() if k != "children"}
+    node["children"] = with_text_around(children)
+    return [node]
+
+
+def extract_segments(data):
+    """The translatable segments of the blocks, in document order"""
+
+    segments = []
+    for key, container, name, kind, _ in blocks_targets(data):
+        value = container[name]
+        if kind == "text":
+            text = escape(value, quote=False)
+        else:
+            text = nodes_to_segment(value, [])
+        if text.strip():
+            segments.append({"key": key, "text": text})
+
+    return segments
+
+
+def inject_segments(data, segments):
+    """A copy of the blocks, with the translated segments merged back in
+
+    The fields of the missing segments keep their text.
+    """
+
+    data = deepcopy(data)
+    translations = {segment["key"]: segment["text"] for segment in segments}
+    translated = {}
+
+    for key, container, name, kind, block in list(blocks_targets(data)):
+        if key not in translations:
+            continue
+        text = translations[key]
+        if kind == "text":
+            value = unescape(text)
+        else:
+            placeholders = []
+            nodes_to_segment(container[name], placeholders)
+            value = segment_to_nodes(text, placeholders)
+        if value != container[name]:
+            container[name] = value
+            translated[id(block)] = block
+
+    for block in translated.values():
+        if block.get("@type") == "slate" and "plaintext" in block:
+            block["plaintext"] = "".join(
+                extract_text(node) for node in block["value"])
+
+    return data
+
+
+def unique_segments(segments):
+    """The segments with a text that wasn't seen before, each text is sent once"""
+
+    seen = set()
+    unique = []
+    for segment in segments:
+        if segment["text"] not in seen:
+            seen.add(segment["text"])
+            unique.append(segment)
+
+    metrics.incr("duplicate_segments", len(segments) - len(unique))
+    return unique
+
+
+def segments_to_translate(data, language=None):
+    """The unique segments of the blocks, without the ones already translated
+    to the language in the translation memory
+    """
+
+    return untranslated_segments(unique_segments(extract_segments(data)), language)
+
+
+def untranslated_segments(segments, language=None):
+    """The segments that aren't in the translation memory for the language"""
+
+    if language and translation_memory is not None:
+        known = translation_memory.lookup(language, [s["text"] for s in segments])
+        metrics.incr("remembered_segments", len(known))
+        segments = [s for s in segments if s["text"] not in known]
+    return segments
+
+
+def translate_segments(data, translated, language=None):
+    """Merges the translations of segments_to_translate back in the blocks
+
+    The translation of a segment goes to all the segments with the same
+    source text. The segments translated before come from the translation
+    memory, the new translations are added to it.
+    """
+
+    source = extract_segments(data)
+    texts = {segment["key"]: segment["text"] for segment in source}
+    translations = {}
+    for segment in translated:
+        if segment["key"] in texts:
+            translations[texts[segment["key"]]] = segment["text"]
+
+    if language and translation_memory is not None:
+        translation_memory.store(language, translations)
+        missing = {s["text"] for s in source if s["text"] not in translations}
+        translations.update(translation_memory.lookup(language, missing))
+
+    segments = [
+        {"key": segment["key"], "text": translations[segment["text"]]}
+        for segment in source
+        if segment["text"] in translations
+    ]
+    return inject_segments(data, segments)
+
+
+def convert_segments_to_content(data):
+    """The blocks of the request, with its translated segments"""
+
+    blocks = {"blocks": data.blocks, "blocks_layout": data.blocks_layout}
+    return {"blocks": translate_segments(blocks, data.segments, data.language)}
@@ -1,14 +1,25 @@
 import functools
 import json
-from copy import deepcopy
+import re
+from typing import cast
 
 from lxml.html import builder as E
 from lxml.html import tostring
 
+from . import metrics
 from .config import ACCEPTED_TAGS
 
 SLATE_ACCEPTED_TAGS = ACCEPTED_TAGS + ["link"]
 
+# lxml doesn't write the content of empty elements
+VOID_TAGS = ("br", "img")
+
+# lxml doesn't write the end tag of these elements when they have no content
+OPTIONAL_END_TAGS = ("li",)
+
+# control characters rejected by lxml
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
 
 def join(element, children):
     """join.
@@ -41,21 +52,30 @@ class Slate2HTML(object):
         """
         if "text" in element:
             if "\n" not in element["text"]:
-                return [inline_text_element(element["text"], deepcopy(element))]
+                return [inline_text_element(element["text"], dict(element))]
 
+            # the copy loses its "text" key after the first line
+            node = dict(element)
             return join(
                 E.BR,
-                [inline_text_element(t, element)
+                [inline_text_element(t, node)
                     for t in element["text"].split("\n")],)
 
         if "type" not in element:
-            element['type'] = 'p'
-        tagname = element["type"]
+            element = dict(element, type="p")
 
         # try:
         # except:
         #     import pdb; pdb.set_trace()
 
+        res = self.get_handler(element)(element)
+        if isinstance(res, list):
+            return res
+        return [res]
+
+    def get_handler(self, element):
+        tagname = element["type"]
+
         if element.get("data") and element["type"] not in SLATE_ACCEPTED_TAGS:
             handler = self.handle_slate_data_element
         else:
@@ -68,10 +88,7 @@ class Slate2HTML(object):
             handler = self.generic_type_handler
             # raise ValueError("Unknown handler")
 
-        res = handler(element)
-        if isinstance(res, list):
-            return res
-        return [res]
+        return handler
 
     def handle_tag_div(self, element):
         # TODO: temporary, we need to see what to do for two-way with eTranslation
@@ -83,9 +100,7 @@ class Slate2HTML(object):
     def handle_tag_p(self, element):
         attributes = {}
 
-        data = deepcopy(element)
-        data.pop('children', None)
-        data.pop('type', None)
+        data = {k: v for k, v in element.items() if k not in ("children", "type")}
 
         if data:
             attributes = {"data-slate-data": json.dumps(data)}
@@ -142,10 +157,11 @@ class Slate2HTML(object):
         el = E.SPAN
 
         children = []
-        for child in element.pop("children"):
+        for child in element["children"]:
             children += self.serialize(child)
 
-        return el(*children, **{"data-slate-node": json.dumps(element)})
+        data = {k: v for k, v in element.items() if k != "children"}
+        return el(*children, **{"data-slate-node": json.dumps(data)})
 
     # def handle_tag_callout(self, element):
     #     el = E.P
@@ -193,6 +209,174 @@ class Slate2HTML(object):
         return elements_to_text(children)
 
 
+def check_xml_compatible(text):
+    if INVALID_XML_CHARS.search(text):
+        raise ValueError(
+            "All strings must be XML compatible: Unicode or ASCII, no NULL bytes "
+            "or control characters"
+        )
+
+
+def escape_text(text):
+    check_xml_compatible(text)
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return text.encode("ascii", "xmlcharrefreplace").decode("ascii")
+
+
+def quote_attribute(value):
+    """Escapes and quotes an attribute value, like lxml's html serializer"""
+
+    value = escape_text(value)
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"{}"'.format(value.replace('"', "&quot;"))
+
+
+@functools.lru_cache(maxsize=1024)
+def href_attribute(url):
+    """lxml escapes urls in a html specific way, so we let it write them"""
+
+    html = cast(str, tostring(E.A(href=url), encoding="unicode"))
+    return html[len("<a "):-len("></a>")]
+
+
+class Slate2HTMLWriter(Slate2HTML):
+    """Writes the same html as Slate2HTML, without building lxml elements
+
+    The html is written straight into a list of strings. Like elements_to_text,
+    the top level text nodes are written as they are, unescaped.
+    """
+
+    def __init__(self):
+        self.parts = []
+        # the attributes of the next element written, a top level one
+        self.attributes = []
+
+    def pop_attributes(self):
+        attributes, self.attributes = self.attributes, []
+        return attributes
+
+    def write_text(self, element, toplevel=False, attributes=()):
+        text = element["text"]
+        data = {k: v for k, v in element.items() if k != "text"}
+
+        # Slate2HTML wraps the first line in a span if the text node has data,
+        # then removes the "text" key, so the next lines are wrapped only if
+        # there's more than one data key left
+        for i, line in enumerate(text.split("\n")):
+            if i:
+                self.parts.append("<br />" if toplevel else "<br>")
+            if len(data) > (1 if i else 0):
+                self.write_start(
+                    "span", [("data-slate-node", json.dumps(data))] + list(attributes)
+                )
+                self.parts.append(escape_text(line))
+                self.parts.append("</span>")
+            elif toplevel:
+                self.parts.append(line)
+            else:
+                self.parts.append(escape_text(line))
+
+    def write_start(self, tagname, attributes):
+        self.parts.append("<" + tagname)
+        for name, value in attributes:
+            if name == "href":
+                self.parts.append(" " + href_attribute(value))
+            else:
+                self.parts.append(f" {name}={quote_attribute(value)}")
+        self.parts.append(">")
+
+    def write_element(self, tagname, attributes, children):
+        self.write_start(tagname, attributes)
+
+        if tagname in VOID_TAGS:
+            # the children are still serialized, but not written
+            parts, self.parts = self.parts, []
+            for child in children:
+                self.serialize(child)
+            self.parts = parts
+            return
+
+        start = len(self.parts)
+        for child in children:
+            self.serialize(child)
+
+        if tagname in OPTIONAL_END_TAGS and len(self.parts) == start:
+            return
+        self.parts.append(f"</{tagname}>")
+
+    def serialize(self, element):
+        """Writes the html of the element, there are no elements to return"""
+
+        if "text" in element:
+            self.write_text(element)
+            return []
+
+        if "type" not in element:
+            element = dict(element, type="p")
+
+        self.get_handler(element)(element)
+        return []
+
+    def handle_tag_div(self, element):
+        return self.handle_block(element)
+
+    def handle_tag_p(self, element):
+        attributes = self.pop_attributes()
+        data = {k: v for k, v in element.items() if k not in ("children", "type")}
+        if data:
+            attributes = [("data-slate-data", json.dumps(data))] + attributes
+
+        tagname = getattr(E, element["type"].upper()).args[0]
+        self.write_element(tagname, attributes, element["children"])
+
+    def handle_tag_link(self, element):
+        attributes = self.pop_attributes()
+        url = element.get("data", {}).get("url")
+        if url is not None:
+            attributes = [("href", url)] + attributes
+
+        self.write_element("a", attributes, element["children"])
+
+    def handle_slate_data_element(self, element):
+        data = {"type": element["type"], "data": element["data"]}
+        attributes = [("data-slate-data", json.dumps(data))] + self.pop_attributes()
+        self.write_element("span", attributes, element["children"])
+
+    def generic_type_handler(self, element):
+        children = element["children"]
+        data = {k: v for k, v in element.items() if k != "children"}
+        attributes = [("data-slate-node", json.dumps(data))] + self.pop_attributes()
+        self.write_element("span", attributes, children)
+
+    def handle_block(self, element):
+        attributes = self.pop_attributes()
+        _type = element["type"].upper()
+        if _type == "VOLTOBLOCK":
+            return
+        tagname = getattr(E, _type).args[0]
+        self.write_element(tagname, attributes, element["children"])
+
+    def to_html(self, value, attributes=()):
+        """Writes the html of a slate value
+
+        The optional attributes are added to the top level elements.
+        """
+
+        self.parts = []
+        for child in value:
+            if "text" in child:
+                self.write_text(child, toplevel=True, attributes=attributes)
+            else:
+                self.attributes = list(attributes)
+                self.serialize(child)
+
+        metrics.incr("serialize")
+        return "".join(self.parts)
+
+
 def _tostring(s):
     if isinstance(s, str):
         return s
@@ -202,17 +386,19 @@ def _tostring(s):
 
 
 def elements_to_text(children):
+    metrics.incr("serialize")
     return "".join(_tostring(f) for f in children)
 
 
-def slate_to_html(value):
-    """slate_to_html.
+def slate_to_html(value, attributes=()):
+    """Converts a slate value to html, without building lxml elements
 
     :param value:
+    :param attributes: (name, value) pairs added to the top level elements
     """
 
-    convert = Slate2HTML()
-    return convert.to_html(value)
+    convert = Slate2HTMLWriter()
+    return convert.to_html(value, attributes)
 
 
 def slate_to_elements(value):
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from app import blocks2html, html2blocks, main
+from app.blocks2html import convert_blocks_to_html
+from app.cache import LRUMemo
+from app.executor import ConversionExecutor
+from app.main import Blocks
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", help="run the timing benchmarks")
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: a timing benchmark, only run with --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    # the timings depend on the machine and its load
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="timing benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+# the html of a blocks field, as sent back to html2content
+HTML_TPL = "<html><body><div data-field='blocks'>%s</div></body></html>"
+
+
+def read_fixture(name):
+    with open(f"tests/fixtures/{name}") as f:
+        return f.read()
+
+
+def blocks_fixture(name):
+    """The blocks2html html of a fixture, a page or a single block"""
+
+    payload = json.loads(read_fixture(name))
+    if "@type" in payload:
+        payload = {"blocks": {"uid1": payload}, "blocks_layout": {"items": ["uid1"]}}
+    return convert_blocks_to_html(Blocks(**payload))
+
+
+@pytest.fixture
+def stable_ids(monkeypatch):
+    monkeypatch.setattr(html2blocks, "STABLE_BLOCK_IDS", True)
+    monkeypatch.setattr(blocks2html, "STABLE_BLOCK_IDS", True)
+    monkeypatch.setattr(blocks2html, "fragments_memo", LRUMemo(100))
+
+
+@pytest.fixture(params=["inline", "thread", "process"])
+def app_executor(request, monkeypatch):
+    """The executor of the app, in each mode, with several workers"""
+
+    executor = ConversionExecutor(request.param, workers=2, queue_size=0)
+    executor.start()
+    monkeypatch.setattr(main, "executor", executor)
+    yield executor
+    executor.stop()
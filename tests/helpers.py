@@ -0,0 +1,147 @@
+"""Helpers shared by the test modules"""
+
+import asyncio
+import json
+
+from app.main import app
+
+
+def post(path, payload):
+    """Posts json to the app through ASGI, returns the status and the json"""
+
+    status, _, chunks = post_raw(path, payload)
+    return status, json.loads(b"".join(chunks))
+
+
+def post_raw(path, payload, content_type="application/json", disconnect=False):
+    """Posts json to the app through ASGI, returns the status, the headers and
+    the body, with the body chunks sent by the app
+
+    With another content type, the payload is the body, or the list of its
+    chunks. With disconnect, the client leaves as soon as the body is sent.
+    """
+
+    if content_type == "application/json":
+        chunks = [json.dumps(payload).encode("utf-8")]
+    elif isinstance(payload, list):
+        chunks = payload
+    else:
+        chunks = [payload]
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("utf-8"),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", content_type.encode("latin-1"))],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+    }
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": True} for chunk in chunks
+    ]
+    messages[-1]["more_body"] = False
+    sent = []
+
+    async def run_app():
+        done = asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # the client stays connected until the response is sent, streams
+            # are cancelled on disconnect
+            if not disconnect:
+                await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body"
+            ):
+                done.set()
+
+        await app(scope, receive, send)  # pyright: ignore[reportArgumentType]
+
+    asyncio.run(run_app())
+    status = sent[0]["status"]
+    headers = {k.decode(): v.decode() for k, v in sent[0]["headers"]}
+    chunks = [m["body"] for m in sent[1:] if m.get("body")]
+    return status, headers, chunks
+
+
+# HTML matching the serialization of a hero block with nested blocks
+HERO_HTML = """
+<html><body>
+<div data-field="blocks">
+<div data-block-type="hero" data-volto-block="{}">
+    <div data-fieldname="buttonLabel">Click me</div>
+    <div data-fieldname="copyright">© 2026</div>
+    <div data-volto-section="blocks">
+        <div data-block-type="slate" data-volto-block="{}"><p>Nested text</p></div>
+    </div>
+</div>
+</div>
+</body></html>
+"""
+
+LEAF = "<p>Some <strong>text</strong> here</p><p>More text</p>"
+
+
+def tabs(inner, i):
+    return (
+        f'<ul class="nav nav-tabs"><li><a href="#tab{i}">Tab {i}</a></li></ul>'
+        f'<div class="tab-content"><div id="tab{i}">{inner}</div></div>'
+    )
+
+
+def accordion(inner, i):
+    return (
+        '<div class="panel-group"><div class="panel">'
+        f'<div class="panel-heading" id="panel{i}-heading">'
+        f'<h4 class="panel-title">Panel {i}</h4></div>'
+        f'<div class="panel-body">{inner}</div></div></div>'
+    )
+
+
+def grid(inner, i):
+    return f'<div data-block-type="gridBlock" data-volto-block="{{}}">{inner}</div>'
+
+
+def hero(inner, i):
+    return (
+        '<div data-block-type="hero" data-volto-block="{}">'
+        f'<div data-volto-section="blocks">{inner}</div></div>'
+    )
+
+
+CONTAINERS = [grid, tabs, accordion, hero]
+
+
+def nested_page(depth, width=1):
+    """A page with `width` copies of containers nested `depth` levels deep"""
+
+    html = LEAF
+    for level in range(depth):
+        html = LEAF + CONTAINERS[level % 4](html, level)
+    return html * width
+
+
+def without_ids(value):
+    """The blocks, with their ids replaced by their position"""
+
+    if isinstance(value, list):
+        return [without_ids(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    result = {k: without_ids(v) for k, v in value.items()}
+    if "blocks_layout" in value:
+        items = value["blocks_layout"]["items"]
+        result["blocks"] = [without_ids(value["blocks"][uid]) for uid in items]
+        result["blocks_layout"] = len(items)
+    return result
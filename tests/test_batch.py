@@ -0,0 +1,51 @@
+import asyncio
+
+from app.blocks2html import convert_blocks_to_html
+from app.executor import ConversionExecutor
+from app.html2blocks import text_to_blocks
+from app.html2slate import text_to_slate
+from app.main import Blocks
+from helpers import post
+
+
+def test_html_batch():
+    documents = [{"html": "<p>one</p>"}, {"html": "<p>two <b>2</b></p>"}]
+    status, response = post("/html/batch", {"documents": documents})
+
+    assert status == 200
+    assert response["results"] == [
+        {"data": text_to_slate(doc["html"])} for doc in documents
+    ]
+
+
+def test_blocks2html_batch_errors():
+    page = {
+        "blocks": {"a": {"@type": "slate", "value": [{"text": "x"}]}},
+        "blocks_layout": {"items": ["a"]},
+    }
+    broken = {"blocks": {"a": {"value": []}}, "blocks_layout": {"items": ["a"]}}
+
+    status, response = post("/blocks2html/batch", {"documents": [page, broken, page]})
+
+    assert status == 200
+    html = convert_blocks_to_html(Blocks(**page))
+    assert response["results"][0] == {"html": html}
+    assert list(response["results"][1]) == ["error"]
+    assert response["results"][2] == {"html": html}
+
+
+def test_run_batch_in_pool():
+    executor = ConversionExecutor("thread", workers=2)
+    executor.start()
+    documents = ["<p>a</p>", 42, "<h2>b</h2><p>c</p>"]
+
+    try:
+        results = asyncio.run(executor.run_batch(text_to_blocks, documents))
+    finally:
+        executor.stop()
+
+    first, error, last = results
+    assert isinstance(first, list) and len(first) == 1
+    assert isinstance(error, AttributeError)
+    assert isinstance(last, list)
+    assert [block["@type"] for _, block in last] == ["slate", "slate"]
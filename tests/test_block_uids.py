@@ -0,0 +1,96 @@
+import json
+
+from app import blocks2html, html2blocks
+from app.blocks2html import convert_blocks_to_html
+from app.cache import LRUMemo
+from app.html2blocks import text_to_blocks
+from app.html2content import convert_html_to_content
+from app.main import Blocks
+
+from conftest import HTML_TPL
+from helpers import without_ids
+
+
+def block_ids(value):
+    """All the block and column ids in the layouts, recursively"""
+
+    ids = []
+    if isinstance(value, list):
+        for v in value:
+            ids.extend(block_ids(v))
+    elif isinstance(value, dict):
+        if "blocks_layout" in value:
+            items = value["blocks_layout"]["items"]
+            ids.extend(items)
+            ids.extend(block_ids([value["blocks"][uid] for uid in items]))
+        for k, v in value.items():
+            if k not in ("blocks", "blocks_layout"):
+                ids.extend(block_ids(v))
+    return ids
+
+
+def roundtrip(payload):
+    html = convert_blocks_to_html(Blocks(**payload))
+    return convert_html_to_content(HTML_TPL % html)["blocks"]
+
+
+def test_ids_roundtrip(stable_ids):
+    with open("tests/fixtures/payload-t1.json") as f:
+        payload = json.load(f)
+
+    content = roundtrip(payload)
+
+    assert content["blocks_layout"] == payload["blocks_layout"]
+    # a slate block without value has no html
+    lost = "73acd526-92d9-4de8-b774-eb584b51e51c"
+    assert block_ids(content) == [uid for uid in block_ids(payload) if uid != lost]
+
+
+def test_same_content_without_ids(stable_ids, monkeypatch):
+    with open("tests/fixtures/payload-t1.json") as f:
+        payload = json.load(f)
+    stable = roundtrip(payload)
+
+    monkeypatch.setattr(html2blocks, "STABLE_BLOCK_IDS", False)
+    monkeypatch.setattr(blocks2html, "STABLE_BLOCK_IDS", False)
+    monkeypatch.setattr(blocks2html, "fragments_memo", LRUMemo(100))
+
+    assert without_ids(stable) == without_ids(roundtrip(payload))
+
+
+def test_content_derived_ids(stable_ids):
+    html = "<p>Same</p><p>Same</p><h2>Other</h2>"
+
+    first = [uid for uid, _ in text_to_blocks(html)]
+    second = [uid for uid, _ in text_to_blocks(html)]
+
+    assert first == second
+    assert len(set(first)) == 3
+
+    content = convert_html_to_content(HTML_TPL % html)["blocks"]
+    assert content == convert_html_to_content(HTML_TPL % html)["blocks"]
+    assert len(content["blocks"]) == 3
+
+
+def test_table_ids(stable_ids):
+    html = (
+        "<table><thead><tr><th>A</th><th>B</th></tr></thead>"
+        "<tbody><tr><td>1</td><td>2</td></tr></tbody></table>"
+    )
+
+    first = text_to_blocks(html)
+    assert first == text_to_blocks(html)
+    rows = first[0][1]["table"]["rows"]
+    assert [row["key"] for row in rows] == ["0", "1"]
+    assert [cell["key"] for cell in rows[1]["cells"]] == ["1-0", "1-1"]
+
+    content = convert_html_to_content(HTML_TPL % html)["blocks"]
+    assert content == convert_html_to_content(HTML_TPL % html)["blocks"]
+    table = next(iter(content["blocks"].values()))["table"]
+    assert [row["key"] for row in table["rows"]] == ["0", "1"]
+
+
+def test_random_ids_by_default():
+    html = "<p>Same</p>"
+
+    assert text_to_blocks(html)[0][0] != text_to_blocks(html)[0][0]
@@ -1,8 +1,11 @@
 import json
+from copy import deepcopy
 
 import pytest
 
+from app import blocks2html, metrics
 from app.blocks2html import convert_blocks_to_html
+from app.cache import LRUMemo
 from app.html2content import convert_html_to_content
 from app.main import Blocks
 
@@ -39,3 +42,105 @@ def test_it(json_payload):
     #     json.dump(content, f)
 
     # assert json_payload == content['blocks']
+
+
+def slate(text):
+    return {
+        "@type": "slate",
+        "value": [{"type": "p", "children": [{"text": text}, {"text": "a\nb", "bold": True}]}],
+        "plaintext": text,
+        "styles": {"align": "left"},
+    }
+
+
+def columns():
+    return {
+        "blocks": {
+            "col": {
+                "title": "Column",
+                "blocks": {"s": slate("in a column")},
+                "blocks_layout": {"items": ["s"]},
+            }
+        },
+        "blocks_layout": {"items": ["col"]},
+    }
+
+
+def fixture_blocks():
+    for name in ["grid_block.json", "statistic_block.json", "teaser.json"]:
+        with open(f"tests/fixtures/{name}") as f:
+            yield json.load(f)
+
+    yield {"@type": "columnsBlock", "data": columns(), "gridSize": 12}
+    yield {"@type": "tabs_block", "data": columns()}
+    yield {"@type": "group", "data": {"blocks": {"s": slate("x")}, "blocks_layout": {"items": ["s"]}}}
+    yield {"@type": "title", "subtitle": "Sub", "info": [{"@id": "i", "description": "d"}]}
+    yield {
+        "@type": "slateTable",
+        "table": {"rows": [{"key": "r", "cells": [{"key": "c", "type": "data", "value": [{"text": "v"}]}]}]},
+    }
+    yield {"@type": "hero", "buttonLabel": "Go", "data": {"blocks": {"s": slate("y")}, "blocks_layout": {"items": ["s"]}}}
+    yield {"@type": "quote", "value": [{"type": "unknown", "children": [{"text": "q"}]}]}
+
+
+def test_input_unchanged(json_payload):
+    blocks = dict(json_payload["blocks"])
+    for i, block in enumerate(fixture_blocks()):
+        blocks[f"block{i}"] = block
+    data = {"blocks": blocks, "blocks_layout": {"items": list(blocks)}}
+
+    original = deepcopy(data)
+    html = convert_blocks_to_html(Blocks(**data))
+
+    assert data == original
+    # the same data can be converted again
+    assert convert_blocks_to_html(Blocks(**data)) == html
+
+
+def test_fragments_memo(monkeypatch):
+    monkeypatch.setattr(blocks2html, "fragments_memo", LRUMemo(100))
+    group = {"@type": "group", "data": {"blocks": {"s": slate("x")}, "blocks_layout": {"items": ["s"]}}}
+    data = {"blocks": {"g": group}, "blocks_layout": {"items": ["g"]}}
+    with open("tests/fixtures/teaser.json") as f:
+        teaser = json.load(f)
+
+    with metrics.collect() as counters:
+        html = convert_blocks_to_html(Blocks(**data))
+    assert counters["fragment_hits"] == 0
+
+    with metrics.collect() as counters:
+        assert convert_blocks_to_html(Blocks(**data)) == html
+    assert counters["fragment_hits"] == 1
+
+    # the teaser inside the teaserGrid reuses the elements of the first teaser
+    grid = {"@type": "teaserGrid", "columns": [teaser]}
+    data = {"blocks": {"t": teaser, "grid": grid}, "blocks_layout": {"items": ["t", "grid"]}}
+    with metrics.collect() as counters:
+        html = convert_blocks_to_html(Blocks(**data))
+    assert counters["fragment_hits"] == 1
+
+    monkeypatch.setattr(blocks2html, "fragments_memo", LRUMemo(0))
+    assert convert_blocks_to_html(Blocks(**data)) == html
+
+
+def test_nested_elements_copied_once(monkeypatch):
+    monkeypatch.setattr(blocks2html, "fragments_memo", LRUMemo(100))
+    copies = []
+    monkeypatch.setattr(
+        blocks2html, "deepcopy", lambda value: copies.append(value) or deepcopy(value))
+
+    block = slate("x")
+    for _ in range(5):
+        # the same child twice, the second one comes from the memo
+        layout = {"blocks": {"a": block, "b": block}, "blocks_layout": {"items": ["a", "b"]}}
+        block = {"@type": "group", "data": layout}
+    data = {"blocks": {"g": block}, "blocks_layout": {"items": ["g"]}}
+
+    html = convert_blocks_to_html(Blocks(**data))
+
+    # the outermost group, and the second child of each group
+    assert len(copies) == 6
+    assert html.count("<p") == 2 ** 5
+
+    monkeypatch.setattr(blocks2html, "fragments_memo", LRUMemo(0))
+    assert convert_blocks_to_html(Blocks(**data)) == html
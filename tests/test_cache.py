@@ -0,0 +1,191 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+
+import pytest
+
+import app.main
+from app.cache import ResultCache, SQLiteResultCache, TranslationMemory, cache_key
+from app.main import Blocks
+from helpers import post
+
+PAGE = {
+    "blocks": {"a": {"@type": "slate", "value": [{"text": "x"}]}},
+    "blocks_layout": {"items": ["a"]},
+}
+
+
+def counting(monkeypatch, name):
+    calls = []
+    func = getattr(app.main, name)
+
+    def wrapper(*args):
+        calls.append(args)
+        return func(*args)
+
+    monkeypatch.setattr(app.main, name, wrapper)
+    return calls
+
+
+def test_cache_key_normalized():
+    reordered = dict(reversed(asdict(Blocks(**PAGE)).items()))
+
+    assert cache_key("blocks2html", Blocks(**PAGE)) == cache_key(
+        "blocks2html", reordered)
+    assert cache_key("blocks2html", PAGE) != cache_key("html2content", PAGE)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "sqlite":
+            return SQLiteResultCache(str(tmp_path / "cache.db"), **kwargs)
+        return ResultCache(**kwargs)
+
+    return make
+
+
+def test_lru_size_bound(make_cache):
+    cache = make_cache(max_bytes=20)
+    cache.set("a", "0123456")  # 9 bytes serialized
+    cache.set("b", "0123456")
+    assert cache.get("a") == "0123456"
+
+    cache.set("c", "0123456")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == cache.get("c") == "0123456"
+    assert cache.size == 18
+    assert cache.stats == {"hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_ttl(make_cache, monkeypatch):
+    cache = make_cache(max_bytes=100, ttl=10)
+    cache.set("a", "value")
+
+    now = time.monotonic(), time.time()
+    monkeypatch.setattr(time, "monotonic", lambda: now[0] + 11)
+    monkeypatch.setattr(time, "time", lambda: now[1] + 11)
+
+    assert cache.get("a") is None
+    assert cache.size == 0
+    assert cache.stats == {"misses": 1, "evictions": 1}
+
+
+def test_sqlite_shared(tmp_path):
+    path = str(tmp_path / "cache.db")
+    SQLiteResultCache(path, max_bytes=100).set("a", {"html": "<p>a</p>"})
+
+    # another worker, or the same one after a restart
+    cache = SQLiteResultCache(path, max_bytes=100)
+
+    assert cache.get("a") == {"html": "<p>a</p>"}
+    assert cache.connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+def test_sqlite_hits_dont_write(tmp_path):
+    cache = SQLiteResultCache(str(tmp_path / "cache.db"), max_bytes=100)
+    cache.set("a", "value")
+    changes = cache.connection.total_changes
+
+    assert cache.get("a") == "value"
+    assert cache.connection.total_changes == changes
+    assert "a" in cache.touched
+
+    cache.set("b", "value")
+    assert cache.touched == {}
+
+
+def test_sqlite_existing_database(tmp_path):
+    path = str(tmp_path / "cache.db")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE results (key TEXT PRIMARY KEY, "
+        "value TEXT, size INTEGER, expires REAL, used REAL)")
+    connection.execute("INSERT INTO results VALUES ('a', '\"x\"', 3, NULL, 0)")
+    connection.commit()
+    connection.close()
+
+    cache = SQLiteResultCache(path, max_bytes=100)
+    assert cache.size == 3
+    cache.set("a", "xyz")
+    assert cache.size == 5
+
+
+def test_translation_memory_threads(tmp_path):
+    memory = TranslationMemory(str(tmp_path / "memory.db"))
+    texts = {f"text {i}": f"texte {i}" for i in range(50)}
+
+    def remember(language):
+        memory.store(language, texts)
+        return memory.lookup(language, list(texts))
+
+    # the pool threads share the connection, opened by the first of them
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        found = list(pool.map(remember, [f"l{i}" for i in range(16)]))
+
+    assert found == [texts] * 16
+
+
+def test_hit_skips_conversion(make_cache, monkeypatch):
+    monkeypatch.setattr(app.main, "result_cache", make_cache(max_bytes=10000))
+    calls = counting(monkeypatch, "convert_blocks_document")
+
+    first = post("/blocks2html", PAGE)
+    second = post("/blocks2html", PAGE)
+
+    assert first == second
+    assert len(calls) == 1
+
+
+def test_batch_uses_cache(make_cache, monkeypatch):
+    monkeypatch.setattr(app.main, "result_cache", make_cache(max_bytes=10000))
+    calls = counting(monkeypatch, "convert_document_to_content")
+
+    status, single = post("/html2content", {"html": "<p>one</p>"})
+    documents = [{"html": "<p>one</p>"}, {"html": "<p>two</p>"}]
+    status, response = post("/html2content/batch", {"documents": documents})
+
+    assert response["results"][0] == single
+    assert [html for (html, _), in calls] == ["<p>one</p>", "<p>two</p>"]
+
+
+def test_single_flight(monkeypatch):
+    monkeypatch.setattr(app.main, "flight_stats", app.main.Counter())
+    calls = []
+
+    async def convert(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def requests():
+        return await asyncio.gather(
+            app.main.single_flight("a", convert, 1),
+            app.main.single_flight("a", convert, 1),
+            app.main.single_flight("b", convert, 2),
+            app.main.single_flight("a", convert, 1),
+        )
+
+    assert asyncio.run(requests()) == [2, 2, 4, 2]
+    assert calls == [1, 2]
+    assert app.main.flight_stats["coalesced"] == 2
+    assert app.main.in_flight == {}
+
+
+def test_single_flight_errors():
+    async def convert():
+        await asyncio.sleep(0.01)
+        raise ValueError("broken")
+
+    async def requests():
+        return await asyncio.gather(
+            app.main.single_flight("a", convert),
+            app.main.single_flight("a", convert),
+            return_exceptions=True,
+        )
+
+    errors = asyncio.run(requests())
+    assert [type(e) for e in errors] == [ValueError, ValueError]
@@ -0,0 +1,89 @@
+from copy import deepcopy
+from dataclasses import asdict
+
+import pytest
+
+from app.blocks2html import convert_blocks_to_html_with_uids
+from app.changes import convert_changed_blocks_to_html, convert_changes_to_content
+from app.html2content import convert_html_to_content
+from app.main import Blocks, BlocksChanges, ContentChanges
+from conftest import HTML_TPL
+from helpers import post, without_ids
+
+
+def slate(*texts):
+    return {
+        "@type": "slate",
+        "value": [{"type": "p", "children": [{"text": text}]} for text in texts],
+    }
+
+
+def translate(html):
+    return html.replace("Hello", "Bonjour").replace("World", "Monde")
+
+
+def full_translation(source):
+    html = convert_blocks_to_html_with_uids(Blocks(**source))
+    return convert_html_to_content(HTML_TPL % translate(html))["blocks"]
+
+
+def source_page():
+    return {
+        "blocks": {
+            "a": slate("Hello one"),
+            "b": {"@type": "teaser", "title": "Hello World", "head_title": "World"},
+            "c": slate("Hello two", "World two"),
+        },
+        "blocks_layout": {"items": ["a", "b", "c"]},
+    }
+
+
+def test_changes():
+    previous = source_page()
+    translation = full_translation(previous)
+
+    current = deepcopy(previous)
+    current["blocks"]["b"]["title"] = "Hello new World"
+    current["blocks"]["d"] = slate("World new")
+    current["blocks_layout"]["items"] = ["d", "c", "b", "a"]
+
+    response = convert_changed_blocks_to_html(BlocksChanges(previous=previous, **current))
+    assert response["changed"] == ["d", "b"]
+    assert "two" not in response["html"]
+
+    content = convert_changes_to_content(ContentChanges(
+        html=HTML_TPL % translate(response["html"]),
+        previous=previous,
+        translation=translation,
+        **current,
+    ))["blocks"]
+
+    # the unchanged blocks are reused, paragraphs split from "c" included
+    items = content["blocks_layout"]["items"]
+    assert items[0] == "d" and items[-2:] == ["b", "a"]
+    for uid in translation["blocks_layout"]["items"]:
+        if uid != "b":
+            assert content["blocks"][uid] == translation["blocks"][uid]
+
+    assert without_ids(content) == without_ids(full_translation(current))
+
+
+def test_missing_from_translation():
+    previous = source_page()
+    translation = full_translation(previous)
+    # the translation of "a" was lost, yet "a" didn't change
+    translation["blocks_layout"]["items"].remove("a")
+    del translation["blocks"]["a"]
+
+    changes = ContentChanges(
+        html=HTML_TPL % "",
+        previous=previous,
+        translation=translation,
+        **deepcopy(previous),
+    )
+    with pytest.raises(ValueError, match=": a$"):
+        convert_changes_to_content(changes)
+
+    status, body = post("/html2content/changes", asdict(changes))
+    assert status == 400
+    assert body["detail"].endswith(": a")
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from app import metrics
+from app.executor import ConversionExecutor, QueueFull
+from app.html2blocks import text_to_blocks
+from app.html2slate import text_to_slate
+from helpers import nested_page
+
+
+HTML = "<p>Hello <strong>world</strong></p>"
+
+
+@pytest.fixture(params=["inline", "thread", "process"])
+def executor(request):
+    executor = ConversionExecutor(request.param, workers=2, queue_size=2)
+    executor.start()
+    yield executor
+    executor.stop()
+
+
+def test_same_result_and_counters(executor):
+    async def convert():
+        with metrics.collect() as counters:
+            result = await executor.run(text_to_slate, HTML)
+        return result, counters
+
+    result, counters = asyncio.run(convert())
+
+    with metrics.collect() as expected:
+        assert result == text_to_slate(HTML)
+    assert counters == expected
+
+
+@pytest.mark.parametrize("mode", ["thread", "process"])
+def test_all_workers_warmed_up(mode):
+    executor = ConversionExecutor(mode, workers=3)
+    executor.start()
+    try:
+        pool = executor.pool
+        if isinstance(pool, ThreadPoolExecutor):
+            assert len(pool._threads) == 3
+        else:
+            assert isinstance(pool, ProcessPoolExecutor)
+            assert len(pool._processes) == 3
+    finally:
+        executor.stop()
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        ConversionExecutor("fibers")
+
+
+def test_queue_is_bounded():
+    executor = ConversionExecutor("thread", workers=1, queue_size=1)
+    executor.start()
+
+    async def convert_all():
+        runs = [executor.run(time.sleep, 0.1) for _ in range(3)]
+        return await asyncio.gather(*runs, return_exceptions=True)
+
+    try:
+        results = asyncio.run(convert_all())
+    finally:
+        executor.stop()
+
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], QueueFull)
+
+
+def test_stream_closed_before_iterated(executor):
+    async def open_and_close():
+        stream = await executor.stream(iter, [HTML, HTML])
+        await stream.aclose()
+        return [item async for item in stream]
+
+    assert asyncio.run(open_and_close()) == []
+    assert executor.pending == 0
+
+
+async def latencies(executor, pages):
+    """Converts the pages concurrently while probing the event loop
+
+    Returns the latencies of the conversions and of the probes, which stand for
+    cheap requests such as the healthcheck.
+    """
+
+    probes = []
+    done = False
+
+    async def probe():
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            probes.append(time.perf_counter() - start - 0.005)
+
+    async def convert(html):
+        start = time.perf_counter()
+        await executor.run(text_to_blocks, html)
+        return time.perf_counter() - start
+
+    prober = asyncio.create_task(probe())
+    await asyncio.sleep(0)
+    requests = await asyncio.gather(*[convert(html) for html in pages])
+    done = True
+    await prober
+
+    return requests, probes
+
+
+def p99(values):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * 0.99))]
+
+
+@pytest.mark.benchmark
+def test_p99_latency():
+    # mixed sizes: many small pages and a few big ones
+    pages = [nested_page(1)] * 20 + [nested_page(6, width=40)] * 4
+
+    results = {}
+    for mode in ["inline", "process"]:
+        executor = ConversionExecutor(mode, workers=2, queue_size=len(pages))
+        executor.start()
+        try:
+            requests, probes = asyncio.run(latencies(executor, pages))
+        finally:
+            executor.stop()
+        results[mode] = (p99(requests), p99(probes))
+
+    # off the loop, cheap requests don't wait for the big conversions
+    assert results["process"][1] < results["inline"][1] / 2
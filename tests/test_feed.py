@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from app import metrics
+from app.html2blocks import document_to_blocks, text_to_blocks
+from app.html2content import convert_html_to_content, document_to_content
+from app.html2slate import HTMLFeed
+from conftest import HTML_TPL
+from helpers import HERO_HTML, nested_page, post_raw
+
+PAGE = "<h1>Tïtle</h1>" + nested_page(4) + '<p><iframe src="http://map"></iframe></p>'
+
+
+def chunked(text, size=7, encoding="utf-8"):
+    # small chunks, some of them cut multibyte characters
+    body = text.encode(encoding)
+    return [body[i : i + size] for i in range(0, len(body), size)]
+
+
+def feed(chunks, encoding="utf-8"):
+    parser = HTMLFeed(encoding)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def post_html(path, chunks, charset="utf-8"):
+    status, _, body = post_raw(path, chunks, f"text/html; charset={charset}")
+    return status, json.loads(b"".join(body))
+
+
+def test_feed_parity(stable_ids):
+    text, document = feed(chunked(PAGE))
+
+    assert text == PAGE
+    assert document_to_blocks(text, document) == text_to_blocks(PAGE, backend="lxml")
+
+
+def test_feed_content_parity(stable_ids):
+    text, document = feed(chunked(HERO_HTML))
+
+    expected = convert_html_to_content(HERO_HTML, backend="lxml")
+    assert document_to_content(text, document) == expected
+
+
+def test_feed_counts_one_parse():
+    with metrics.collect() as counters:
+        feed(chunked(PAGE))
+
+    assert counters["parse"] == 1
+
+
+@pytest.mark.parametrize("text", ["", "   ", "<p>no body</p>"])
+def test_feed_without_blocks(text, stable_ids):
+    assert document_to_blocks(*feed(chunked(text))) == text_to_blocks(text, "lxml")
+    assert document_to_content(*feed(chunked(text))) == {}
+
+
+def test_toblocks_html(app_executor, stable_ids):
+    # the chunks of a request are fed to its parser on one thread, whatever
+    # the pool threads that are free
+    for _ in range(3):
+        status, response = post_html("/toblocks/html", chunked(PAGE))
+
+        assert status == 200
+        assert response["data"] == text_to_blocks(PAGE, backend="lxml")
+    assert app_executor.pending == 0
+
+
+def test_toblocks_html_charset(stable_ids):
+    status, response = post_html(
+        "/toblocks/html", chunked(PAGE, encoding="latin-1"), "latin-1")
+
+    assert status == 200
+    assert response["data"] == text_to_blocks(PAGE, backend="lxml")
+
+
+def test_html2content_html(app_executor, stable_ids):
+    html = HTML_TPL % '<div data-block-type="slate"><p>a <b>b</b></p></div>'
+    status, response = post_html("/html2content/html", chunked(html))
+
+    assert status == 200
+    assert response["data"] == convert_html_to_content(html, backend="lxml")
+
+
+def test_html_body_required():
+    status, _, _ = post_raw("/toblocks/html", {"html": PAGE})
+
+    assert status == 415
+
+
+def test_unknown_charset():
+    status, _, _ = post_raw("/toblocks/html", [b"<p>x</p>"], "text/html; charset=x-nope")
+
+    assert status == 400
@@ -0,0 +1,48 @@
+import pytest
+
+from app.html2content import convert_html_to_content
+from conftest import HTML_TPL, blocks_fixture, read_fixture
+from helpers import HERO_HTML
+
+
+FIELDS_HTML = (
+    "<html><body>"
+    "<div data-field='title'>A &amp; B</div>"
+    "<div data-field='description'>lead <b class=' a  b '>x</b><br> "
+    """<a title='say "hi"' href="u?a=1&amp;b=2">l</a><!-- c --> </div>"""
+    "<div data-field='blocks'><p>x</p></div>"
+    "</body></html>"
+)
+
+
+@pytest.mark.parametrize(
+    "html",
+    [
+        HTML_TPL % blocks_fixture("payload-t1.json"),
+        HTML_TPL % blocks_fixture("callout-page.json"),
+        HTML_TPL % blocks_fixture("grid_block.json"),
+        HTML_TPL % blocks_fixture("statistic_block.json"),
+        HTML_TPL % blocks_fixture("teaser.json"),
+        HTML_TPL % read_fixture("teaser.html"),
+        HTML_TPL % read_fixture("statistic_block.html"),
+        HERO_HTML,
+        FIELDS_HTML,
+    ],
+)
+def test_backends_parity(html, stable_ids):
+    contents = []
+    for backend in ("bs4", "lxml"):
+        contents.append(convert_html_to_content(html, backend=backend))
+
+    assert contents[0] == contents[1]
+    assert contents[0]
+
+
+def test_no_body():
+    assert convert_html_to_content("<div data-field='blocks'></div>", backend="lxml") == {}
+    assert convert_html_to_content("", backend="lxml") == {}
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        convert_html_to_content(HERO_HTML, backend="html5lib")
@@ -1,20 +1,7 @@
 import pytest
 from app.html2content import convert_html_to_content
+from helpers import HERO_HTML
 
-# HTML matching the serialization of a hero block with nested blocks
-HERO_HTML = """
-<html><body>
-<div data-field="blocks">
-<div data-block-type="hero" data-volto-block="{}">
-    <div data-fieldname="buttonLabel">Click me</div>
-    <div data-fieldname="copyright">© 2026</div>
-    <div data-volto-section="blocks">
-        <div data-block-type="slate" data-volto-block="{}"><p>Nested text</p></div>
-    </div>
-</div>
-</div>
-</body></html>
-"""
 
 def test_hero_html2content():
     # This should crash with KeyError: 'data-fieldname' if not handled
@@ -69,3 +56,23 @@ def test_grid_html2content():
     teaser = grid['blocks'][teaser_uid]
     assert teaser['@type'] == 'teaser'
     assert teaser['title'] == 'Teaser Title'
+
+
+TABS_FRAGMENTS_HTML = (
+    "<html><body><div data-field='blocks'>"
+    '<ul class="nav nav-tabs"><li><a href="#t1">One</a></li></ul>'
+    '<div class="tab-content"><div id="t1"><p>Pane</p></div></div>'
+    "</div></body></html>"
+)
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_tabs_sibling_fragments(backend):
+    # each fragment is converted on its own, the tab list without its panes
+    data = convert_html_to_content(TABS_FRAGMENTS_HTML, backend=backend)
+
+    blocks = data["blocks"]["blocks"]
+    items = data["blocks"]["blocks_layout"]["items"]
+    assert [blocks[uid]["@type"] for uid in items] == ["slate", "slate"]
+    assert blocks[items[0]]["value"][0]["type"] == "ul"
+    assert blocks[items[1]]["plaintext"] == "Pane"
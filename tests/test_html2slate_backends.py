@@ -0,0 +1,47 @@
+import pytest
+
+from app.html2slate import text_to_slate
+from conftest import blocks_fixture, read_fixture
+
+
+SNIPPETS = [
+    "<p>a<!-- c -->b</p><p>x<!----> y</p>",
+    "<!-- top -->x<p>y</p>",
+    "lead<p>x</p>tail",
+    "<p>a<script>var x=1;</script> b</p>",
+    """<p><span data-slate-node='{"type":"q"}'>hi <ruby>r<rt>rt</rt></ruby></span></p>""",
+    '<span class="">x</span><p class=" a  b ">y</p>',
+    '<p><a rel="nofollow noopener" class="a b" href="u"> l </a></p>',
+    '<table class="listing"><tr><td>a</td></tr></table>',
+    "<p> a <b> b </b> <i> c<u> d </u></i> e <br> f </p>  <p>\n\t g \n</p>",
+    "<p>Please find below<span>&nbsp;</span><strong>past  webinars</strong>. "
+    "<strong>upcoming<span> <a href='x'>here</a></span></strong></p>",
+    "<div> <span> x </span> <span><strong><span> deep </span></strong></span> </div>",
+    "<span> <em> a</em></span><span> b</span>",
+    "<pre>  a\n   b  </pre><p>   </p><pre>  <br><!----> e</pre>",
+    '<p><img src="x/@@images/image/large" style="float: left"> text</p>',
+    '<p style="text-align: center"> c </p>'
+    """<div data-slate-node='{"type":"callout"}'> z <b>q</b></div>""",
+    "<h2>A</h2>\n\n<voltoblock data-voltoblock='{\"@type\": \"maps\"}'></voltoblock>",
+]
+
+
+@pytest.mark.parametrize(
+    "html",
+    [
+        read_fixture("payload-t1.html"),
+        read_fixture("statistic_block.html"),
+        read_fixture("teaser.html"),
+        blocks_fixture("payload-t1.json"),
+        blocks_fixture("callout-page.json"),
+        blocks_fixture("grid_block.json"),
+    ]
+    + SNIPPETS,
+)
+def test_backends_parity(html):
+    assert text_to_slate(html, backend="lxml") == text_to_slate(html, backend="bs4")
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        text_to_slate("<p>x</p>", backend="html5lib")
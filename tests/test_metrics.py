@@ -0,0 +1,35 @@
+import asyncio
+
+from litestar import Response
+
+from app import metrics
+from app.html2blocks import text_to_blocks
+from app.main import report_counters
+
+HTML = "<p>Hello <strong>world</strong></p><ul><li>one</li><li>two</li></ul>"
+
+
+def test_text_to_blocks_parses_input_once():
+    with metrics.collect() as counters:
+        blocks = text_to_blocks(HTML)
+
+    assert len(blocks) == 2
+    assert counters["parse"] == 1
+    assert counters["serialize"] == 0
+
+
+def test_counters_outside_request_are_ignored():
+    assert metrics.current() is None
+    metrics.incr("parse")
+    assert metrics.current() is None
+
+
+def test_response_reports_counters():
+    async def respond():
+        counters = metrics.start()
+        counters["parse"] += 2
+        counters["serialize"] += 1
+        return await report_counters(Response(content={}))
+
+    response = asyncio.run(respond())
+    assert response.headers["X-Conversion-Counters"] == "parse=2,serialize=1"
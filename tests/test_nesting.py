@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from app.html2blocks import text_to_blocks
+from helpers import nested_page
+
+
+def nested_blocks(block):
+    """The blocks of a container, whatever the container stores them in"""
+
+    if block["@type"] == "gridBlock":
+        return [block["blocks"]]
+    if block["@type"] == "hero":
+        return [block["data"]["blocks"]]
+    # tabs and accordions store their tabs/panels in data
+    return [panel["blocks"] for panel in block["data"]["blocks"].values()]
+
+
+def depth_of(blocks):
+    depths = [0]
+    for _, block in blocks:
+        if block["@type"] == "slate":
+            continue
+        for children in nested_blocks(block):
+            depths.append(1 + depth_of(children.items()))
+    return max(depths)
+
+
+def test_nested_containers():
+    blocks = text_to_blocks(nested_page(6))
+
+    # two paragraphs and the outer container, which holds one panel/tab
+    assert [b["@type"] for _, b in blocks] == ["slate", "slate", "tabs_block"]
+    assert len(blocks[2][1]["data"]["blocks"]) == 1
+    assert depth_of(blocks) == 6
+
+
+def conversion_time(html):
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        text_to_blocks(html)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@pytest.mark.benchmark
+def test_linear_with_nesting_depth():
+    text_to_blocks(nested_page(6))  # warm up
+
+    costs = []
+    for depth in range(1, 7):
+        html = nested_page(depth, width=5)
+        costs.append(conversion_time(html) / html.count("<"))
+
+    # the cost per node doesn't grow with the nesting depth
+    assert max(costs) / min(costs) < 3
@@ -0,0 +1,56 @@
+import json
+from copy import deepcopy
+
+import pytest
+from lxml.html import document_fromstring
+
+from app.blocks2html import convert_blocks_to_html
+from app.html2blocks import extract_text
+from app.html2slate import text_to_slate
+from app.main import Blocks
+from app.slate2html import elements_to_text, slate_to_elements
+
+
+def html_text(slate_node):
+    """The plaintext as it was extracted before, through html"""
+
+    html = elements_to_text(slate_to_elements([deepcopy(slate_node)]))
+    if not (html and html.strip()):
+        return ""
+    return document_fromstring(html).text_content()
+
+
+def fixture_html():
+    with open("tests/fixtures/payload-t1.json") as f:
+        yield convert_blocks_to_html(Blocks(**json.load(f)))
+    for name in ["payload-t1.html", "teaser.html", "statistic_block.html"]:
+        with open(f"tests/fixtures/{name}") as f:
+            yield f.read()
+
+
+SNIPPETS = [
+    "<p>a <b>b</b><br>c<a href='x'>link</a></p>",
+    "<ul><li>one</li><li>two<br> <em>three</em></li></ul>",
+    "<table><tbody><tr><td>a</td><td> b </td></tr></tbody></table>",
+    "<p>x<span data-slate-data='{\"type\": \"footnote\", \"data\": {}}'>y</span></p>",
+    "<h2>title</h2> loose <b>text</b> ",
+    "  leading text",
+    "&nbsp;",
+]
+
+
+@pytest.mark.parametrize("html", list(fixture_html()) + SNIPPETS)
+def test_same_as_html_text(html):
+    for node in text_to_slate(html):
+        assert extract_text(node) == html_text(node)
+
+
+@pytest.mark.parametrize(
+    "node",
+    [
+        {"text": " \n x\n "},
+        {"type": "p", "children": [{"text": "a\nb"}, {"type": "voltoblock", "data": {}}]},
+    ],
+)
+def test_line_breaks(node):
+    assert extract_text(node) == html_text(node)
@@ -0,0 +1,139 @@
+import pytest
+
+from app import metrics
+from app.html2blocks import (
+    PREPROCESSORS,
+    applicable_preprocessors,
+    block_tag,
+    convert_iframe,
+    element_to_blocks,
+    preprocessor,
+    text_to_blocks,
+)
+from conftest import blocks_fixture
+from helpers import nested_page
+
+HTML = (
+    '<div data-block-type="box" id="outer"><p>outer</p>'
+    '<div data-block-type="box" id="inner"><p>inner</p></div></div>'
+    '<div class="box other" id="classes"><p>by class</p></div>'
+)
+
+
+@pytest.fixture
+def converted():
+    seen = []
+
+    @preprocessor("div", block_type="box")
+    def convert_box(div):
+        seen.append(div["id"])
+        data = {"@type": "box", "blocks": element_to_blocks(div)}
+        div.replace_with(block_tag(data, div))
+
+    @preprocessor("div", class_="box other")
+    def convert_classes(div):
+        seen.append(div["id"])
+
+    yield seen
+
+    del PREPROCESSORS["block-type"]["box"]
+    del PREPROCESSORS["class"]["box"]
+
+
+def test_innermost_first(converted):
+    blocks = text_to_blocks(HTML)
+
+    assert converted == ["classes", "inner", "outer"]
+
+    outer = blocks[0][1]
+    assert outer["@type"] == "box"
+    nested = [block["@type"] for _, block in outer["blocks"]]
+    assert nested == ["slate", "box"]
+
+
+def test_requires_all_classes(converted):
+    text_to_blocks('<div class="box" id="one"></div>')
+
+    assert converted == []
+
+
+def test_skips_preprocessors_without_markers():
+    total = sum(
+        len(entries) for kind in PREPROCESSORS.values() for entries in kind.values()
+    )
+
+    with metrics.collect() as counters:
+        blocks = text_to_blocks("<p>Nothing <b>special</b> here</p>")
+
+    assert blocks[0][1]["@type"] == "slate"
+    assert counters["skipped_preprocessors"] == total
+
+
+def test_markers_are_case_insensitive():
+    applicable = applicable_preprocessors('<P><IFRAME SRC="http://x"></IFRAME></P>')
+
+    assert applicable == {convert_iframe}
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+@pytest.mark.parametrize(
+    "inner",
+    [
+        '<iframe src="x"></iframe>',
+        '<a class="accordion-toggle" href="#">Read more</a>',
+    ],
+)
+def test_inside_replaced_block(inner, backend):
+    # the button replaces its whole paragraph, the blocks converted later
+    # inside it are in a detached subtree and are skipped
+    html = f'<p>{inner}<a class="bluebutton" href="y">b</a></p>'
+
+    blocks = text_to_blocks(html, backend=backend)
+
+    assert [block["@type"] for _, block in blocks] == ["callToActionBlock"]
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_classes_in_any_order(backend):
+    html = '<ul class="nav-tabs foo nav"><li><a href="#t1">One</a></li></ul>'
+    html += '<div class="tab-content"><div id="t1"><p>1</p></div></div>'
+
+    blocks = text_to_blocks(html, backend=backend)
+
+    assert [block["@type"] for _, block in blocks] == ["tabs_block"]
+
+
+SNIPPETS = [
+    '<p>Go <a class="bluebutton x" href="/u" target="_blank">there</a> now</p>',
+    '<a class="bluebutton" href="/u">top <b>level</b></a> tail',
+    '<p>a<iframe src="http://map"></iframe> b</p>',
+    '<p><a class="accordion-toggle" href="#">Read more</a></p>',
+    '<div class="panel-group"><div class="panel">'
+    '<div class="panel-heading" id="p1-heading"><h4 class="panel-title">'
+    '<a class="accordion-toggle">Read more</a></h4></div>'
+    '<div class="panel-body"><p>x</p></div></div></div>',
+    '<ul class="nav nav-tabs"><li><a href="#t1">One</a></li><li>broken</li>'
+    '<li><a href="#t2">Two <i>2</i></a></li></ul> between '
+    '<div class="tab-content"><div id="t1"><p>1</p></div><div id="t2">'
+    '<iframe src="http://map"></iframe></div></div><p>after</p>',
+]
+
+
+@pytest.mark.parametrize(
+    "html",
+    [
+        nested_page(6, width=2),
+        blocks_fixture("payload-t1.json"),
+        blocks_fixture("grid_block.json"),
+        blocks_fixture("teaser.json"),
+        blocks_fixture("statistic_block.json"),
+    ]
+    + SNIPPETS,
+)
+def test_lxml_preprocessors_parity(html, stable_ids):
+    results = []
+    for backend in ("bs4", "lxml"):
+        results.append(text_to_blocks(html, backend=backend))
+
+    assert results[0] == results[1]
+    assert results[0]
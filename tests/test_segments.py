@@ -0,0 +1,173 @@
+import json
+
+import pytest
+
+import app.main
+from app import metrics, segments
+from app.cache import ResultCache, TranslationMemory
+from app.main import Segments
+from app.segments import (
+    extract_segments,
+    inject_segments,
+    segments_to_translate,
+    translate_segments,
+)
+from helpers import post
+
+
+def page(*blocks):
+    return {
+        "blocks": {f"b{i}": block for i, block in enumerate(blocks)},
+        "blocks_layout": {"items": [f"b{i}" for i in range(len(blocks))]},
+    }
+
+
+PARAGRAPH = {
+    "@type": "slate",
+    "value": [
+        {
+            "type": "p",
+            "children": [
+                {"text": "Read "},
+                {"text": "the <report>", "bold": True},
+                {"text": " and "},
+                {"type": "link", "data": {"url": "x"}, "children": [{"text": "this"}]},
+                {"text": ""},
+            ],
+        }
+    ],
+    "plaintext": "Read the <report> and this",
+}
+
+
+@pytest.mark.parametrize(
+    "fixture", ["payload-t1.json", "callout-page.json", "statistic_block.json"]
+)
+def test_untranslated_roundtrip(fixture):
+    with open(f"tests/fixtures/{fixture}") as f:
+        data = json.load(f)
+    if "blocks" not in data:
+        data = page(data)
+
+    segments = extract_segments(data)
+
+    assert segments
+    assert inject_segments(data, segments) == data
+
+
+def test_placeholders():
+    data = page(PARAGRAPH, {"@type": "teaser", "title": "A & B"})
+
+    assert extract_segments(data) == [
+        {
+            "key": "b0:value:0",
+            "text": 'Read <g id="1">the &lt;report&gt;</g> and <g id="2">this</g>',
+        },
+        {"key": "b1:title", "text": "A &amp; B"},
+    ]
+
+
+def test_inject_translation():
+    data = page(PARAGRAPH)
+    translated = [
+        {"key": "b0:value:0", "text": 'Lire <g id="2">ceci</g> et <g id="1">le rapport</g>'}
+    ]
+
+    with metrics.collect() as counters:
+        result = inject_segments(data, translated)
+
+    assert counters["parse"] == 0
+    assert result["blocks"]["b0"]["value"][0]["children"] == [
+        {"text": "Lire "},
+        {"type": "link", "data": {"url": "x"}, "children": [{"text": "ceci"}]},
+        {"text": " et "},
+        {"text": "le rapport", "bold": True},
+    ]
+    assert result["blocks"]["b0"]["plaintext"] == "Lire ceci et le rapport"
+    assert data == page(PARAGRAPH)
+
+
+@pytest.mark.parametrize("text", ['<g id="1">open', "closed</g>", '<x id="9"/>'])
+def test_broken_segments(text):
+    with pytest.raises(ValueError):
+        inject_segments(page(PARAGRAPH), [{"key": "b0:value:0", "text": text}])
+
+
+def test_segments_endpoints():
+    data = page(PARAGRAPH)
+    status, response = post("/blocks2html", dict(data, segments=True))
+    assert status == 200
+    assert set(response) == {"html", "segments"}
+
+    segments = [dict(s, text=s["text"].replace("Read", "Lire")) for s in response["segments"]]
+    status, content = post("/segments2content", dict(data, segments=segments))
+    assert status == 200
+    assert content["data"]["blocks"]["blocks"]["b0"]["plaintext"] == (
+        "Lire the <report> and this")
+
+    status, error = post("/segments2content", dict(data, segments=[
+        {"key": "b0:value:0", "text": "</g>"}]))
+    assert status == 400
+
+
+def teasers(*titles):
+    return page(*[{"@type": "teaser", "title": t, "head_title": "News"} for t in titles])
+
+
+def test_duplicate_segments():
+    data = teasers("One", "Two")
+
+    with metrics.collect() as counters:
+        to_translate = segments_to_translate(data)
+
+    assert [s["text"] for s in to_translate] == ["One", "News", "Two"]
+    assert counters["duplicate_segments"] == 1
+
+    translated = [dict(s, text=s["text"].upper()) for s in to_translate]
+    result = translate_segments(data, translated)
+    assert [b["head_title"] for b in result["blocks"].values()] == ["NEWS", "NEWS"]
+    assert [b["title"] for b in result["blocks"].values()] == ["ONE", "TWO"]
+
+
+def test_translation_memory(monkeypatch, tmp_path):
+    memory = TranslationMemory(str(tmp_path / "memory.db"))
+    monkeypatch.setattr(segments, "translation_memory", memory)
+
+    data = teasers("One")
+    translated = [dict(s, text=s["text"].upper()) for s in segments_to_translate(data, "fr")]
+    translate_segments(data, translated, "fr")
+
+    # the same labels on another page aren't sent again
+    data = teasers("One", "Three")
+    with metrics.collect() as counters:
+        to_translate = segments_to_translate(data, "fr")
+    assert [s["text"] for s in to_translate] == ["Three"]
+    assert counters["remembered_segments"] == 2
+    assert len(segments_to_translate(data, "de")) == 3
+
+    result = segments.convert_segments_to_content(Segments(
+        segments=[{"key": to_translate[0]["key"], "text": "TROIS"}], language="fr", **data))
+    blocks = result["blocks"]["blocks"]
+    assert [(b["title"], b["head_title"]) for b in blocks.values()] == [
+        ("ONE", "NEWS"), ("TROIS", "NEWS")]
+
+
+def test_cached_segments_follow_memory(monkeypatch, tmp_path):
+    monkeypatch.setattr(app.main, "result_cache", ResultCache(max_bytes=100000))
+    memory = TranslationMemory(str(tmp_path / "memory.db"))
+    monkeypatch.setattr(segments, "translation_memory", memory)
+    data = dict(page(PARAGRAPH), segments=True, language="fr")
+
+    status, response = post("/blocks2html", data)
+    assert [s["key"] for s in response["segments"]] == ["b0:value:0"]
+    translated = [dict(s, text=s["text"].replace("Read", "Lire"))
+                  for s in response["segments"]]
+    status, _ = post("/segments2content", dict(data, segments=translated))
+    assert status == 200
+
+    # the html comes from the results cache, the segments from the memory
+    status, response = post("/blocks2html", data)
+    assert response["segments"] == []
+    status, response = post("/blocks2html/batch", {"documents": [data]})
+    assert response["results"][0]["segments"] == []
+    assert app.main.result_cache.stats["hits"] == 2
@@ -0,0 +1,41 @@
+import json
+
+from app.blocks2html import convert_blocks_to_html, convert_blocks_to_html_and_metadata
+from app.html2content import convert_html_to_content
+from app.main import Blocks
+from conftest import HTML_TPL
+from helpers import post, without_ids
+
+
+def payload():
+    with open("tests/fixtures/payload-t1.json") as f:
+        return json.load(f)
+
+
+def test_sidecar_roundtrip():
+    data = Blocks(**payload())
+    inline = convert_blocks_to_html(data)
+    response = convert_blocks_to_html_and_metadata(data)
+
+    assert "data-volto-block='{" not in response["html"]
+    assert len(response["html"]) < len(inline)
+
+    content = convert_html_to_content(HTML_TPL % response["html"], response["metadata"])
+    expected = convert_html_to_content(HTML_TPL % inline)
+    assert without_ids(content) == without_ids(expected)
+
+
+def test_sidecar_endpoints():
+    status, response = post("/blocks2html", dict(payload(), sidecar=True))
+    assert status == 200
+    assert set(response) == {"html", "metadata"}
+
+    status, content = post(
+        "/html2content",
+        {"html": HTML_TPL % response["html"], "metadata": response["metadata"]},
+    )
+    status, expected = post(
+        "/html2content",
+        {"html": HTML_TPL % convert_blocks_to_html(Blocks(**payload()))},
+    )
+    assert without_ids(content) == without_ids(expected)
@@ -0,0 +1,60 @@
+import json
+from copy import deepcopy
+
+import pytest
+
+from app.blocks2html import convert_block_to_elements, convert_blocks_to_html
+from app.html2slate import text_to_slate
+from app.main import Blocks
+from app.slate2html import elements_to_text, slate_to_elements, slate_to_html
+
+
+def elements_html(value):
+    return elements_to_text(slate_to_elements(deepcopy(value)))
+
+
+def fixture_pages():
+    for name in ["payload-t1.json", "callout-page.json"]:
+        with open(f"tests/fixtures/{name}") as f:
+            yield json.load(f)
+
+
+def slate_values():
+    for page in fixture_pages():
+        for block in page["blocks"].values():
+            if block.get("@type") == "slate":
+                yield block["value"]
+
+    with open("tests/fixtures/payload-t1.html") as f:
+        yield text_to_slate(f.read())
+
+
+VALUES = [
+    [{"text": "top <level> & é"}],
+    [{"text": "a\nb", "bold": True}, {"text": "c\nd", "bold": True, "italic": True}],
+    [{"type": "p", "styleName": "it's", "children": [{"text": "\"quoted\" & 'quoted'"}]}],
+    [{"type": "link", "data": {"url": " http://x.eu/a b/é?x=1&y=2"}, "children": [{"text": "link"}]}],
+    [{"type": "ul", "children": [{"type": "li", "children": []}, {"type": "li", "children": [{"text": ""}]}]}],
+    [{"type": "p", "children": [{"type": "img", "children": [{"text": "ignored"}]}, {"text": "x"}]}],
+    [{"type": "footnote", "data": {"uid": "x"}, "children": [{"text": "😀"}]}],
+    [{"type": "voltoblock", "data": {}}, {"children": [{"text": "no type"}]}],
+]
+
+
+@pytest.mark.parametrize("value", list(slate_values()) + VALUES)
+def test_same_as_elements(value):
+    original = deepcopy(value)
+
+    assert slate_to_html(value) == elements_html(value)
+    assert value == original
+
+
+@pytest.mark.parametrize("page", list(fixture_pages()))
+def test_blocks_same_as_elements(page):
+    fragments = []
+    for uid in page["blocks_layout"]["items"]:
+        elements = convert_block_to_elements(deepcopy(page["blocks"][uid]))
+        if elements:
+            fragments.append(elements_to_text(elements))
+
+    assert convert_blocks_to_html(Blocks(**deepcopy(page))) == "\n".join(fragments)
@@ -0,0 +1,167 @@
+import json
+
+import pytest
+
+from app import html2content
+from app.blocks2html import (
+    DOCUMENT_HEAD,
+    DOCUMENT_TAIL,
+    convert_blocks_to_html,
+    stream_blocks_document,
+)
+from app.html2content import convert_html_to_content, convert_html_to_records
+from app.main import Blocks
+from conftest import HTML_TPL
+from helpers import HERO_HTML, post_raw
+
+
+def page():
+    with open("tests/fixtures/payload-t1.json") as f:
+        return json.load(f)
+
+
+def page_html():
+    return HTML_TPL % convert_blocks_to_html(Blocks(**page()))
+
+
+def records_to_content(records):
+    """The html2content result, rebuilt from its records"""
+
+    data = {}
+    blocks = {}
+    for record in records:
+        if "field" in record:
+            data[record["field"]] = record["value"]
+        elif "uid" in record:
+            blocks[record["uid"]] = record["block"]
+        else:
+            data["blocks"] = {"blocks": blocks, "blocks_layout": record["blocks_layout"]}
+    return data
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml"])
+def test_records(stable_ids, backend):
+    html = page_html()
+    records = list(convert_html_to_records(html, backend=backend))
+
+    assert records_to_content(records) == convert_html_to_content(html)
+    assert list(records[-1]) == ["blocks_layout"]
+    assert all("uid" in record for record in records[:-1])
+
+
+def test_records_are_lazy():
+    records = convert_html_to_records(page_html())
+
+    first = next(records)
+    assert "uid" in first
+    records.close()
+
+
+def test_bad_document_fails_before_streaming():
+    with pytest.raises(ValueError):
+        convert_html_to_records(HERO_HTML, backend="html5lib")
+
+
+def test_html2content_stream(stable_ids):
+    status, headers, chunks = post_raw("/html2content/stream", {"html": HERO_HTML})
+
+    assert status == 200
+    assert headers["content-type"].startswith("application/x-ndjson")
+    lines = b"".join(chunks).splitlines()
+    assert len(chunks) == len(lines) == 2
+    content = records_to_content(json.loads(line) for line in lines)
+    assert content == convert_html_to_content(HERO_HTML)
+
+
+def test_stream_through_executor(app_executor):
+    status, _, chunks = post_raw("/html2content/stream", {"html": page_html()})
+
+    assert status == 200
+    records = [json.loads(line) for line in b"".join(chunks).splitlines()]
+    assert list(records[-1]) == ["blocks_layout"]
+    # the stream gave its place in the queue back
+    assert app_executor.pending == 0
+
+
+@pytest.mark.parametrize("path", ["/html2content/stream", "/blocks2html/stream"])
+def test_stream_client_disconnects(app_executor, path):
+    payload = {"html": page_html()} if path.startswith("/html2content") else page()
+
+    post_raw(path, payload, disconnect=True)
+
+    # the response is cancelled, the stream gave its place back
+    assert app_executor.pending == 0
+
+
+def test_stream_error_record(app_executor):
+    broken = HTML_TPL % (
+        '<div data-block-type="slate"><p>ok</p></div>'
+        '<div data-block-type="listing" data-volto-block="{broken"></div>'
+    )
+
+    status, _, chunks = post_raw("/html2content/stream", {"html": broken})
+
+    assert status == 200
+    records = [json.loads(line) for line in b"".join(chunks).splitlines()]
+    assert "uid" in records[0]
+    assert records[-1]["error"].startswith("JSONDecodeError")
+    assert app_executor.pending == 0
+
+
+def test_stream_fails_before_streaming(monkeypatch):
+    monkeypatch.setattr(html2content, "HTML2CONTENT_BACKEND", "html5lib")
+
+    status, _, _ = post_raw("/html2content/stream", {"html": HERO_HTML})
+
+    assert status == 500
+
+
+def test_blocks_document_chunks():
+    data = Blocks(**page())
+    chunks = list(stream_blocks_document(data))
+
+    assert chunks[0] == DOCUMENT_HEAD
+    assert chunks[-1] == DOCUMENT_TAIL
+    assert "".join(chunks[1:-1]) == convert_blocks_to_html(data)
+    assert len(chunks) > 3
+
+
+def test_blocks2html_stream(app_executor, stable_ids):
+    status, headers, chunks = post_raw("/blocks2html/stream", page())
+
+    assert status == 200
+    assert headers["content-type"].startswith("text/html")
+    document = b"".join(chunks).decode("utf-8")
+    assert document == HTML_TPL % convert_blocks_to_html(Blocks(**page()))
+    assert convert_html_to_content(document) == convert_html_to_content(page_html())
+    assert app_executor.pending == 0
+
+
+def test_blocks2html_stream_error(app_executor):
+    blocks = {
+        "a": {"@type": "slate", "value": [{"text": "x"}]},
+        "b": {"value": []},
+    }
+    payload = {"blocks": blocks, "blocks_layout": {"items": ["a", "b"]}}
+
+    status, _, chunks = post_raw("/blocks2html/stream", payload)
+
+    assert status == 200
+    document = b"".join(chunks).decode("utf-8")
+    assert document.startswith(DOCUMENT_HEAD)
+    assert document.endswith("-->")
+    assert "conversion failed" in document
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        dict(page(), sidecar=True),
+        dict(page(), segments=True),
+        {"blocks": {}, "blocks_layout": {}},
+    ],
+)
+def test_blocks2html_stream_bad_request(payload):
+    status, _, _ = post_raw("/blocks2html/stream", payload)
+
+    assert status == 400
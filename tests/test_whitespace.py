@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from app.html2slate import (
+    WhitespaceCollapser,
+    body_fromstring,
+    child_nodes,
+    collapse_inline_space,
+    fragments_fromstring,
+    is_element,
+    is_textnode,
+)
+
+SNIPPETS = [
+    "<p> a <b> b </b> <i> c<u> d </u></i> e <br> f </p>  <p>\n\t g \n</p>",
+    "<p>Please find below<span>&nbsp;</span><strong>past  webinars</strong>. "
+    "<strong>upcoming<span> <a href='x'>here</a></span></strong></p>",
+    "<div> <span> x </span> <span><strong><span> deep </span></strong></span> </div>",
+    "<span> <em> a</em></span><span> b</span>",
+    "<p><span></span> x<span> </span><span>y </span> z</p>",
+    "<p>x<!----> y</p><p><span>a</span><!-- c --> b</p><pre>  <br><!----> e</pre>",
+    "<p> a<script> b </script> <ruby> c<rt> d </rt></ruby> e</p>",
+]
+
+
+def nested_html(depth):
+    tags = ["span", "strong", "span", "em"]
+    opening = "".join(f"<{tags[i % 4]}> x{i} " for i in range(depth))
+    closing = "".join(f" y{i} </{tags[i % 4]}>" for i in reversed(range(depth)))
+    return f"<p>{opening}{closing}</p>"
+
+
+def text_nodes(nodes):
+    for node in nodes:
+        if is_textnode(node):
+            yield node
+        elif is_element(node):
+            yield from text_nodes(child_nodes(node))
+
+
+def trees(html):
+    yield fragments_fromstring(html)
+    yield list(child_nodes(body_fromstring(html)))
+
+
+@pytest.mark.parametrize("html", SNIPPETS + [nested_html(6)])
+def test_same_as_whitespace_rules(html):
+    for fragments in trees(html):
+        collapser = WhitespaceCollapser()
+        for node in text_nodes(fragments):
+            assert collapser.collapse(node) == collapse_inline_space(node)
+
+
+def collapse_time(depth):
+    nodes = list(text_nodes(fragments_fromstring(nested_html(depth))))
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        collapser = WhitespaceCollapser()
+        for node in nodes:
+            collapser.collapse(node)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@pytest.mark.benchmark
+def test_linear_with_nesting_depth():
+    # four times the depth, four times the text nodes: linear is ~4x, the
+    # recursive rules are ~16x
+    collapse_time(40)  # warm up
+    ratio = collapse_time(160) / collapse_time(40)
+    assert ratio < 10